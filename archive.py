@@ -0,0 +1,349 @@
+import bisect
+import hashlib
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("archive")
+
+# One index record per compressed block:
+# raw offset, raw length, segment number, offset in the segment, compressed length
+_RECORD = struct.Struct('<QIIQI')
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class _Block:
+    __slots__ = ('raw_offset', 'raw_length', 'segment', 'file_offset', 'length')
+
+    def __init__(self, raw_offset: int, raw_length: int, segment: int, file_offset: int, length: int):
+        self.raw_offset = raw_offset
+        self.raw_length = raw_length
+        self.segment = segment
+        self.file_offset = file_offset
+        self.length = length
+
+
+class SessionArchive:
+    """Complete output history of one session on disk.
+
+    Output is buffered until ``block_size`` bytes, compressed as an
+    independent zlib block and appended to the current segment file; a new
+    segment starts once it holds ``segment_bytes`` compressed bytes. An
+    append-only index of fixed-size records maps every block's offset in
+    the uncompressed stream to its place on disk, so any range is read by
+    seeking to and inflating just the blocks it covers. Blocks are numbered
+    from the start of the session; when the archive grows past ``max_bytes``
+    the oldest segments are deleted.
+    """
+
+    def __init__(self, path: str, block_size: int = 64 << 10, segment_bytes: int = 8 << 20,
+                 max_bytes: int = 1 << 30, compression_level: int = 6):
+        self.path = path
+        self.block_size = block_size
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        self._blocks: List[_Block] = []
+        self._offsets: List[int] = []  # raw offset of each block, for bisect
+        self._first_seq = 0            # sequence number of self._blocks[0]
+        self._index_size = 0           # bytes of the index file loaded
+        self._index_inode = None       # None until loaded; changes when the index is rewritten
+        self._stored = 0               # compressed bytes on disk
+        self._pending = []
+        self._pending_size = 0
+        os.makedirs(path, exist_ok=True)
+        self._refresh()
+
+    @property
+    def end(self) -> int:
+        """Bytes of output archived so far, including what is still buffered"""
+        with self.lock:
+            return self._written_end() + self._pending_size
+
+    @property
+    def stored_bytes(self) -> int:
+        return self._stored
+
+    def append(self, data: bytes) -> int:
+        """Add output, returning its offset in the session's stream"""
+        with self.lock:
+            offset = self._written_end() + self._pending_size
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self.block_size:
+                self._write_block()
+        return offset
+
+    def flush(self):
+        """Write buffered output as a (possibly short) block"""
+        with self.lock:
+            if self._pending_size:
+                self._write_block()
+
+    def read(self, offset: Optional[int] = None, length: int = 64 << 10) -> Tuple[int, bytes]:
+        """Up to `length` bytes starting at `offset` (default: the last `length` bytes).
+
+        Returns (actual start, data); the start moves forward when the
+        requested range begins before the oldest output still kept.
+        """
+        with self.lock:
+            self._refresh()
+            start = self._blocks[0].raw_offset if self._blocks else self._written_end()
+            end = self._written_end() + self._pending_size
+            if offset is None:
+                offset = max(start, end - length)
+            offset = min(max(offset, start), end)
+            stop = min(end, offset + length)
+            data = self._read_range(offset, stop)
+        return offset, data
+
+    def read_blocks(self, seq: int, count: int = 1) -> Tuple[int, int, int, bytes]:
+        """Blocks `seq` up to `seq + count` (buffered output counts as the last block).
+
+        Returns (first block actually read, next block, raw start offset, data).
+        """
+        with self.lock:
+            self._refresh()
+            seq = max(seq, self._first_seq)
+            last = self._first_seq + len(self._blocks)  # the buffered block
+            blocks = self._blocks[seq - self._first_seq:seq - self._first_seq + max(count, 0)]
+            data = [self._inflate(block) for block in blocks]
+            next_seq = seq + len(blocks)
+            if next_seq == last and len(blocks) < count and self._pending_size:
+                data.append(b''.join(self._pending))
+                next_seq += 1
+            offset = blocks[0].raw_offset if blocks else self._written_end()
+        return seq, next_seq, offset, b''.join(data)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'start': self._blocks[0].raw_offset if self._blocks else self._written_end(),
+                'end': self._written_end() + self._pending_size,
+                'first_seq': self._first_seq,
+                'next_seq': self._first_seq + len(self._blocks) + (1 if self._pending_size else 0),
+                'stored_bytes': self._stored,
+            }
+
+    # Writing
+    def _written_end(self) -> int:
+        if not self._blocks:
+            return 0
+        last = self._blocks[-1]
+        return last.raw_offset + last.raw_length
+
+    def _write_block(self):
+        self._refresh()
+        raw = b''.join(self._pending)
+        self._pending, self._pending_size = [], 0
+        compressed = zlib.compress(raw, self.compression_level)
+        segment = self._blocks[-1].segment if self._blocks else 0
+        if self._blocks and self._segment_size(segment) >= self.segment_bytes:
+            segment += 1
+        try:
+            with open(self._segment_path(segment), 'ab') as f:
+                file_offset = f.tell()
+                f.write(compressed)
+            block = _Block(self._written_end(), len(raw), segment, file_offset, len(compressed))
+            with open(self._index_path(), 'ab') as f:
+                f.write(_RECORD.pack(block.raw_offset, block.raw_length, block.segment, block.file_offset, block.length))
+                self._index_inode = os.fstat(f.fileno()).st_ino
+        except OSError as e:
+            logger.error(f"Failed to archive output to {self.path}: {e}")
+            return
+        self._index_size += _RECORD.size
+        self._add(block)
+        if self._stored > self.max_bytes:
+            self._drop_oldest_segments()
+
+    def _add(self, block: _Block):
+        self._blocks.append(block)
+        self._offsets.append(block.raw_offset)
+        self._stored += block.length
+
+    def _drop_oldest_segments(self):
+        # Always keep the segment being written
+        while self._stored > self.max_bytes and self._blocks[0].segment != self._blocks[-1].segment:
+            segment = self._blocks[0].segment
+            count = 0
+            while self._blocks[count].segment == segment:
+                self._stored -= self._blocks[count].length
+                count += 1
+            del self._blocks[:count]
+            del self._offsets[:count]
+            self._first_seq += count
+            try:
+                os.remove(self._segment_path(segment))
+            except OSError as e:
+                logger.error(f"Failed to remove archive segment {segment} of {self.path}: {e}")
+        self._rewrite_index()
+
+    def _rewrite_index(self):
+        # The first record's sequence number is kept in a header so numbering survives trimming
+        temporary = self._index_path() + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(_RECORD.pack(self._first_seq, 0, 0, 0, 0))
+            for block in self._blocks:
+                f.write(_RECORD.pack(block.raw_offset, block.raw_length, block.segment, block.file_offset, block.length))
+        os.replace(temporary, self._index_path())
+        stat = os.stat(self._index_path())
+        self._index_size, self._index_inode = stat.st_size, stat.st_ino
+
+    # Reading
+    def _refresh(self):
+        """Load index records written since the last look, e.g. by a previous owner"""
+        try:
+            stat = os.stat(self._index_path())
+            size, inode = stat.st_size, stat.st_ino
+        except OSError:
+            size, inode = 0, 0
+        if inode == self._index_inode and size == self._index_size:
+            return
+        if inode != self._index_inode or size < self._index_size:
+            # First load, or the index was rewritten after trimming
+            self._blocks, self._offsets, self._stored, self._first_seq = [], [], 0, 0
+            self._index_size = 0
+            self._index_inode = inode
+        if size == self._index_size:
+            return
+        with open(self._index_path(), 'rb') as f:
+            f.seek(self._index_size)
+            records = f.read(size - self._index_size)
+        for position in range(0, len(records) - len(records) % _RECORD.size, _RECORD.size):
+            raw_offset, raw_length, segment, file_offset, length = _RECORD.unpack_from(records, position)
+            if self._index_size + position == 0 and raw_length == 0 and length == 0:
+                self._first_seq = raw_offset  # header written when trimming
+                continue
+            self._add(_Block(raw_offset, raw_length, segment, file_offset, length))
+        self._index_size += len(records) - len(records) % _RECORD.size
+
+    def _read_range(self, start: int, stop: int) -> bytes:
+        if start >= stop:
+            return b''
+        parts = []
+        first = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+        for block in self._blocks[first:]:
+            if block.raw_offset >= stop:
+                break
+            raw = self._inflate(block)
+            parts.append(raw[max(0, start - block.raw_offset):stop - block.raw_offset])
+        pending_start = self._written_end()
+        if stop > pending_start:
+            pending = b''.join(self._pending)
+            parts.append(pending[max(0, start - pending_start):stop - pending_start])
+        return b''.join(parts)
+
+    def _inflate(self, block: _Block) -> bytes:
+        try:
+            with open(self._segment_path(block.segment), 'rb') as f:
+                f.seek(block.file_offset)
+                return zlib.decompress(f.read(block.length))
+        except (OSError, zlib.error) as e:
+            logger.error(f"Failed to read archive block at {block.raw_offset} of {self.path}: {e}")
+            return b''
+
+    def _segment_size(self, segment: int) -> int:
+        try:
+            return os.path.getsize(self._segment_path(segment))
+        except OSError:
+            return 0
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:08d}.seg")
+
+    def _index_path(self) -> str:
+        return os.path.join(self.path, 'index')
+
+
+class OutputArchive:
+    """Per-session output archives under one directory"""
+
+    def __init__(self, root: str, **options):
+        self.root = root
+        self.options = options
+        self._sessions: Dict[str, SessionArchive] = {}
+        self._closing: Dict[str, SessionArchive] = {}  # closed, maybe still writing their last block
+        self._lock = threading.Lock()
+
+    def session(self, session_id: str) -> SessionArchive:
+        archive = self._sessions.get(session_id)
+        if archive is None:
+            with self._lock:
+                archive = self._sessions.get(session_id)
+                if archive is None:
+                    closing = self._closing.pop(session_id, None)
+                    if closing is not None:
+                        # Its last block must be on disk before a new writer reads the index
+                        closing.flush()
+                    archive = self._sessions[session_id] = SessionArchive(self._path(session_id), **self.options)
+        return archive
+
+    def reader(self, session_id: str) -> SessionArchive:
+        """The session's archive for reading: its open one, or else a fresh one that is not kept"""
+        with self._lock:
+            archive = self._sessions.get(session_id)
+        return archive if archive is not None else SessionArchive(self._path(session_id), **self.options)
+
+    def exists(self, session_id: str) -> bool:
+        return session_id in self._sessions or os.path.isdir(self._path(session_id))
+
+    def append(self, session_id: str, text: str) -> int:
+        return self.session(session_id).append(text.encode('utf-8', 'replace'))
+
+    def flush(self, session_id: Optional[str] = None):
+        """Write buffered output to disk (all sessions if session_id is None)"""
+        with self._lock:
+            archives = list(self._sessions.values()) if session_id is None else [self._sessions.get(session_id)]
+        for archive in archives:
+            if archive is not None:
+                archive.flush()
+
+    def close(self, session_id: str):
+        """Flush a session's output and drop its in-memory state"""
+        with self._lock:
+            archive = self._sessions.pop(session_id, None)
+            if archive is not None:
+                self._closing[session_id] = archive
+        if archive is not None:
+            archive.flush()
+            with self._lock:
+                if self._closing.get(session_id) is archive:
+                    del self._closing[session_id]
+
+    def delete(self, session_id: str):
+        """Remove a session's archive from disk"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._closing.pop(session_id, None)
+        shutil.rmtree(self._path(session_id), ignore_errors=True)
+
+    def _path(self, session_id: str) -> str:
+        # Session ids come from clients, so only plain names are used as directory names
+        name = session_id if _SAFE_NAME.match(session_id) else hashlib.sha256(session_id.encode()).hexdigest()
+        return os.path.join(self.root, name)
+
+
+def utf8_page(start: int, data: bytes, at_end: bool) -> Tuple[int, int, str]:
+    """Trim a byte page to whole UTF-8 characters: (start, end, text)"""
+    skip = 0
+    while skip < min(len(data), 3) and data[skip] & 0xC0 == 0x80:
+        skip += 1
+    data = data[skip:]
+    if not at_end:
+        # Drop a character cut off at the end of the page
+        cut = len(data)
+        for back in range(1, min(len(data), 4) + 1):
+            byte = data[-back]
+            if byte & 0xC0 != 0x80:
+                width = 4 if byte >= 0xF0 else 3 if byte >= 0xE0 else 2 if byte >= 0xC0 else 1
+                if width > back:
+                    cut = len(data) - back
+                break
+        data = data[:cut]
+    return start + skip, start + skip + len(data), data.decode('utf-8', 'replace')
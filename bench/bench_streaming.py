@@ -0,0 +1,378 @@
+"""Load test for the command output streaming path.
+
+Starts the terminal server in a subprocess against the embedded SQLite
+backend in a temporary directory (or a real mongod with --mongo-uri), drives concurrent
+Socket.IO clients that run high-output commands, and writes the results as
+JSON so runs can be compared:
+
+    python bench/bench_streaming.py --clients 8 --lines 1000000 --output results.json
+
+Reported: end-to-end throughput (MB/s, lines/s), p50/p99 output latency for
+bursty and slow producers, reconnect replay time (delta and snapshot), DB
+writes per second, peak server RSS, and TerminalFilter throughput.
+Requires websocket-client for the Socket.IO clients.
+
+TerminalFilter throughput alone, without starting a server:
+
+    python bench/bench_streaming.py filter --size 8 --repeat 9
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_TOKEN = 'bench'
+WRITE_METHODS = ('create', 'update', 'delete', 'add_to_array', 'push_to_array', 'increment', 'replace_all')
+
+
+# --- Server side ---
+def serve(args):
+    sys.path.insert(0, ROOT)
+    os.environ['METRICS_TOKEN'] = METRICS_TOKEN
+    os.environ.setdefault('PROCESS_METRICS_INTERVAL', '0')
+    if args.mongo_uri:
+        os.environ['DB_BACKEND'] = 'mongo'
+        os.environ['MONGO_URI'] = args.mongo_uri
+    else:
+        os.environ['DB_BACKEND'] = 'sqlite'
+    import main
+    main.socketio.run(main.app, host='127.0.0.1', port=args.port, allow_unsafe_werkzeug=True,
+                      use_reloader=False, log_output=False)
+
+
+# --- Client side ---
+class BenchClient:
+    """One Socket.IO client driving one session"""
+
+    _float_line = re.compile(r'^\d{10}\.\d+$')
+
+    def __init__(self, url: str, session_id: str):
+        import socketio
+        self.session_id = session_id
+        self.bytes = 0
+        self.lines = 0
+        self.latencies = []
+        self.batched_frames = 0  # frames received in command_output_batch while lagging
+        self.skipped_bytes = 0   # output the server dropped because this client fell too far behind
+        self.epoch = None
+        self.last_seq = 0
+        self.done = threading.Event()
+        self.first_output = None
+        self.last_output = None
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('command_output', self._on_output)
+        self.sio.on('command_output_batch', self._on_batch)
+        self.sio.on('output_skipped', self._on_skipped)
+        self.sio.on('process_status', self._on_status)
+        self.sio.connect(url, transports=['websocket'])
+        self.sio.emit('reconnect_session', {'session_id': session_id})
+
+    def run(self, command: str, measure_latency: bool = False):
+        self.measure_latency = measure_latency
+        self.done.clear()
+        self.sio.emit('run_command', {'session_id': self.session_id, 'command': command})
+
+    def _on_output(self, data):
+        if data.get('session_id') != self.session_id:
+            return
+        self._record(data.get('epoch'), data.get('seq', self.last_seq), data.get('output', ''))
+
+    def _on_batch(self, data):
+        if data.get('session_id') != self.session_id:
+            return
+        for seq, text in data.get('frames', []):
+            self._record(data.get('epoch'), seq, text)
+        self.batched_frames += len(data.get('frames', []))
+
+    def _on_skipped(self, data):
+        if data.get('session_id') != self.session_id:
+            return
+        self.skipped_bytes += data.get('skipped', 0)
+        self.epoch, self.last_seq = data.get('epoch'), data.get('seq', self.last_seq)
+
+    def _record(self, epoch, seq, text):
+        now = time.time()
+        self.epoch, self.last_seq = epoch, seq
+        if self.first_output is None:
+            self.first_output = now
+        self.last_output = now
+        self.bytes += len(text.encode('utf-8'))
+        self.lines += text.count('\n')
+        if getattr(self, 'measure_latency', False):
+            for line in text.splitlines():
+                if self._float_line.match(line):
+                    self.latencies.append(now - float(line))
+
+    def _on_status(self, data):
+        if data.get('session_id') == self.session_id and not data.get('running') and 'exit_code' in data:
+            self.done.set()
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.proc = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.peak = max(self.peak, self.proc.memory_info().rss)
+            except psutil.Error:
+                return
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+def dal_writes(url: str) -> tuple:
+    """(DAL write calls, group-committed bulk writes) so far"""
+    request = urllib.request.Request(f"{url}/metrics", headers={'Authorization': f'Bearer {METRICS_TOKEN}'})
+    text = urllib.request.urlopen(request, timeout=10).read().decode()
+    writes = bulk_writes = 0
+    for line in text.splitlines():
+        match = re.match(r'terminal_dal_call_seconds_count\{method="(\w+)",collection="[^"]*"\} (\d+)', line)
+        if match and match.group(1) in WRITE_METHODS:
+            writes += int(match.group(2))
+        match = re.match(r'terminal_dal_batch_writes_count\{collection="[^"]*"\} (\d+)', line)
+        if match:
+            bulk_writes += int(match.group(1))
+    return writes, bulk_writes
+
+
+def run_scenario(clients, command, timeout, measure_latency=False):
+    for client in clients:
+        client.bytes = client.lines = client.batched_frames = client.skipped_bytes = 0
+        client.latencies = []
+        client.first_output = client.last_output = None
+    start = time.time()
+    for client in clients:
+        client.run(command, measure_latency)
+    finished = all(client.done.wait(max(0.0, start + timeout - time.time())) for client in clients)
+    elapsed = time.time() - start
+    total_bytes = sum(client.bytes for client in clients)
+    total_lines = sum(client.lines for client in clients)
+    latencies = [value for client in clients for value in client.latencies]
+    result = {
+        'command': command,
+        'completed': finished,
+        'seconds': round(elapsed, 3),
+        'bytes': total_bytes,
+        'lines': total_lines,
+        'mb_per_s': round(total_bytes / elapsed / 1e6, 2),
+        'lines_per_s': round(total_lines / elapsed),
+        # Slow consumers: frames that arrived coalesced, and output they never got
+        'batched_frames': sum(client.batched_frames for client in clients),
+        'skipped_bytes': sum(client.skipped_bytes for client in clients),
+    }
+    if measure_latency:
+        result.update({
+            'latency_samples': len(latencies),
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        })
+    return result
+
+
+def measure_reconnect(url, client):
+    """Time for a new connection to get the frames a session missed, then a full snapshot"""
+    import socketio
+    results = {}
+    for mode in ('delta', 'snapshot'):
+        got = threading.Event()
+        sio = socketio.Client(reconnection=False)
+        sio.on('command_output_batch', lambda data: got.set())
+        sio.on('output_snapshot', lambda data: got.set())
+        sio.connect(url, transports=['websocket'])
+        payload = {'session_id': client.session_id}
+        if mode == 'delta':
+            payload.update({'epoch': client.epoch, 'last_seq': max(0, client.last_seq - 10)})
+        start = time.time()
+        sio.emit('reconnect_session', payload)
+        results[f'{mode}_ms'] = round((time.time() - start) * 1000, 2) if got.wait(10) else None
+        sio.disconnect()
+    return results
+
+
+def filter_benchmark(size: int = 8 << 20, repeat: int = 3):
+    """TerminalFilter MB/s per sample (median of `repeat` runs over `size` characters in 64 KB chunks)"""
+    sys.path.insert(0, ROOT)
+    from streaming import TerminalFilter
+    samples = {
+        'plain': 'building module 42 of 97 ... ok\n',
+        # A few colour codes repeated on every line: the common case
+        'ansi': '\x1b[32mok\x1b[0m \x1b[1mbuilding\x1b[22m module\n',
+        # Redrawn status lines: erase and cursor moves mixed with colours and non-ASCII text
+        'ansi_mixed': '\x1b[2K\x1b[1G\x1b[32m\u2714\x1b[0m compiled \x1b[1msrc/module.c\x1b[22m in 42ms\n',
+        'erase_line': '\x1b[2K\x1b[1Gbuilding module 42 of 97\n',
+        # Full-screen programs: many distinct cursor positions
+        'cursor': ''.join(f'\x1b[{row};{col}Hcell {row}:{col}' for row in range(1, 9) for col in (1, 20, 40)) + '\n',
+        # More distinct sequences than a filter remembers
+        'colors_256': ''.join(f'\x1b[38;5;{i}mX' for i in range(256)) + '\x1b[0m\n',
+        'progress': ''.join(f'\r{i}% [{"#" * (i // 5):<20}]' for i in range(0, 101, 5)) + '\n',
+    }
+    results = {}
+    for name, line in samples.items():
+        data = line * (size // len(line))
+        chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+        rates = []
+        for _ in range(repeat):
+            term_filter = TerminalFilter()
+            start = time.perf_counter()
+            for chunk in chunks:
+                term_filter.feed(chunk)
+            term_filter.flush()
+            rates.append(len(data) / (time.perf_counter() - start) / 1e6)
+        results[f'{name}_mb_per_s'] = round(percentile(rates, 0.5), 1)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url: str, timeout: float = 20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"{url}/", timeout=1)
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def bench(args):
+    port = args.port or free_port()
+    url = f"http://127.0.0.1:{port}"
+    # Measure streaming, not admission control: every client's command runs at once by default
+    max_running = args.max_running or args.clients
+    data_dir = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ, MAX_RUNNING_COMMANDS=str(max_running),
+               ADMISSION_MAX_CPU=str(args.admission_max_cpu),
+               SQLITE_PATH=os.path.join(data_dir, 'terminal.sqlite3'))
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port)]
+                              + (['--mongo-uri', args.mongo_uri] if args.mongo_uri else []),
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None)
+    rss = None
+    clients = []
+    try:
+        wait_for_server(url)
+        rss = RssSampler(server.pid)
+        rss.start()
+        clients = [BenchClient(url, f"bench-{i}") for i in range(args.clients)]
+        time.sleep(0.5)
+        writes_before, started = dal_writes(url), time.time()
+        scenarios = {
+            'throughput': run_scenario(clients, f"yes | head -n {args.lines}", args.timeout),
+            'bursty': run_scenario(
+                clients,
+                "python3 -c \"import sys,time\nfor b in range(10):\n for i in range(2000): sys.stdout.write('%.6f\\n' % time.time())\n sys.stdout.flush(); time.sleep(0.2)\"",
+                args.timeout, measure_latency=True),
+            'slow': run_scenario(
+                clients,
+                "python3 -c \"import sys,time\nfor i in range(200): sys.stdout.write('%.6f\\n' % time.time()); sys.stdout.flush(); time.sleep(0.01)\"",
+                args.timeout, measure_latency=True),
+        }
+        # Let the write-behind buffer catch up before counting writes
+        time.sleep(1.5)
+        write_seconds = time.time() - started
+        writes, bulk_writes = (after - before for after, before in zip(dal_writes(url), writes_before))
+        reconnect = measure_reconnect(url, clients[0])
+    finally:
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+        if rss is not None:
+            rss.stop()
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'config': {'clients': args.clients, 'lines': args.lines, 'backend': 'mongo' if args.mongo_uri else 'sqlite',
+                   'max_running': max_running, 'admission_max_cpu': args.admission_max_cpu, 'cpus': os.cpu_count()},
+        'scenarios': scenarios,
+        'reconnect': reconnect,
+        'db': {'writes': writes, 'writes_per_s': round(writes / write_seconds, 1),
+               'bulk_writes': bulk_writes, 'bulk_writes_per_s': round(bulk_writes / write_seconds, 1)},
+        'server': {'peak_rss_bytes': rss.peak if rss else None},
+        'filter': filter_benchmark(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=4, help='concurrent Socket.IO clients, one session each')
+    parser.add_argument('--lines', type=int, default=1000000, help='lines per client in the throughput run')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds allowed per scenario')
+    parser.add_argument('--max-running', type=int, default=0, help='server concurrency limit (default: --clients)')
+    parser.add_argument('--admission-max-cpu', type=float, default=101,
+                        help='server CPU admission threshold in percent (default: off)')
+    parser.add_argument('--mongo-uri', help='use this mongod instead of embedded SQLite')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true', help='show server logs')
+    commands = parser.add_subparsers(dest='command')
+    filter_parser = commands.add_parser('filter', help='only measure TerminalFilter throughput')
+    filter_parser.add_argument('--size', type=int, default=8, help='MB of output per sample')
+    filter_parser.add_argument('--repeat', type=int, default=9, help='runs per sample; the median is reported')
+    filter_parser.add_argument('--output', default=argparse.SUPPRESS, help='where to write the JSON results')
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+    if args.command == 'filter':
+        results = {'timestamp': datetime.now(timezone.utc).isoformat(), 'git_revision': git_revision(),
+                   'filter': filter_benchmark(args.size << 20, args.repeat)}
+    else:
+        results = bench(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+import socketio
+
+from storage import DuplicateKeyError
+
+logger = logging.getLogger("cluster")
+
+# Internal event used to run a handler on another worker; never sent to clients
+WORKER_EVENT = '__worker_call'
+
+
+def worker_room(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+
+class _RoutingMixin:
+    """Deliver worker calls published on the message queue instead of emitting them,
+    and session output through the worker's OutputFanout"""
+
+    worker_room: Optional[str] = None
+    on_call: Optional[Callable[[dict], None]] = None
+    fanout = None
+
+    def _handle_emit(self, message):
+        data = message.get('data')
+        data = data[0] if isinstance(data, list) and len(data) == 1 else data
+        if message.get('event') != WORKER_EVENT:
+            if self.fanout is not None and self.fanout.deliver(
+                    self, message.get('event'), data, message.get('namespace'), message.get('room'),
+                    message.get('skip_sid'), message.get('callback')):
+                return
+            return super()._handle_emit(message)
+        if message.get('room') == self.worker_room and self.on_call is not None:
+            self.server.start_background_task(self.on_call, data)
+
+
+class _LocalHub:
+    """In-process stand-in for a message broker: every subscriber gets every message"""
+
+    _channels = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def subscribe(cls, channel: str) -> queue.Queue:
+        inbox = queue.Queue()
+        with cls._lock:
+            cls._channels.setdefault(channel, []).append(inbox)
+        return inbox
+
+    @classmethod
+    def publish(cls, channel: str, message: str):
+        with cls._lock:
+            inboxes = list(cls._channels.get(channel, ()))
+        for inbox in inboxes:
+            inbox.put(message)
+
+
+class LocalManager(socketio.PubSubManager):
+    """Socket.IO client manager for several servers in one process (``local://<name>``).
+
+    Behaves like the Redis or Kombu managers, so multi-worker behaviour can be
+    exercised without a broker.
+    """
+
+    name = 'local'
+
+    def __init__(self, url: str = 'local://', channel: str = 'socketio', write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.hub_channel = f"{url}#{channel}"
+        self._inbox = None if write_only else _LocalHub.subscribe(self.hub_channel)
+
+    def _publish(self, data):
+        _LocalHub.publish(self.hub_channel, json.dumps(data))
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+def make_client_manager(url: str, channel: str = 'socketio') -> socketio.PubSubManager:
+    """Build the pub/sub client manager for a message queue URL, with worker call routing"""
+    if url.startswith('local://'):
+        base = LocalManager
+    elif url.startswith(('redis://', 'rediss://', 'valkey://', 'valkeys://', 'unix://')):
+        base = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        base = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        base = socketio.ZmqManager
+    else:
+        base = socketio.KombuManager
+    manager_class = type(f"Routing{base.__name__}", (_RoutingMixin, base), {})
+    return manager_class(url, channel=channel)
+
+
+class SessionRegistry:
+    """Records which worker owns each session's processes, in the database.
+
+    Every worker writes a heartbeat to ``workers_collection``. A session whose
+    owner has not sent one for ``ttl`` seconds (or has shut down) is claimed
+    by the next worker that receives an event for it.
+    """
+
+    def __init__(self, dal, worker_id: str, collection: str = "session_owners",
+                 workers_collection: str = "cluster_workers", ttl: float = 30.0):
+        self.dal = dal
+        self.worker_id = worker_id
+        self.collection = collection
+        self.workers_collection = workers_collection
+        self.ttl = ttl
+        self._periodic = None
+
+    def start(self):
+        """Start heartbeating"""
+        if self._periodic is None:
+            self._periodic = self.dal.submit(self._heartbeat_periodically())
+
+    def stop(self, timeout: Optional[float] = 5):
+        """Stop heartbeating and give up every session this worker owns"""
+        if self._periodic is None:
+            return
+        self._periodic.cancel()
+        self._periodic = None
+        try:
+            self.dal.run(self.dal.delete(self.workers_collection, {"worker_id": self.worker_id}), timeout)
+        except Exception as e:
+            logger.error(f"Failed to deregister worker {self.worker_id}: {e}")
+
+    async def _heartbeat_periodically(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Worker heartbeat failed: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+    async def heartbeat(self):
+        await self.dal.update(self.workers_collection, {"worker_id": self.worker_id},
+                              {"worker_id": self.worker_id, "heartbeat": time.time()}, upsert=True,
+                              return_document=False)
+
+    async def is_alive(self, worker_id: str) -> bool:
+        if worker_id == self.worker_id:
+            return True
+        doc = await self.dal.get(self.workers_collection, {"worker_id": worker_id}, use_cache=False)
+        return bool(doc) and time.time() - doc.get('heartbeat', 0) < self.ttl
+
+    async def owner(self, session_id: str) -> Optional[str]:
+        doc = await self.dal.get(self.collection, {"session_id": session_id}, use_cache=False)
+        return doc.get('worker_id') if doc else None
+
+    async def claim(self, session_id: str) -> str:
+        """Return the session's live owner, taking ownership if it has none"""
+        for _ in range(3):
+            current = await self.owner(session_id)
+            if current is not None and await self.is_alive(current):
+                return current
+            # Compare-and-set on the previous owner so only one worker wins a takeover
+            try:
+                claimed = await self.dal.update(
+                    self.collection, {"session_id": session_id, "worker_id": current},
+                    {"session_id": session_id, "worker_id": self.worker_id, "claimed_at": time.time()},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                continue
+            if claimed:
+                logger.info(f"Worker {self.worker_id} claimed session {session_id} from {current}")
+                return self.worker_id
+        return await self.owner(session_id) or self.worker_id
@@ -1,13 +1,19 @@
 import os
 import json
+import asyncio
+import functools
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from typing import Any, Optional, List
+from typing import Any, Callable, Coroutine, Optional, List
 
 from dotenv import load_dotenv
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ReturnDocument
-from cryptography.fernet import Fernet
+
+from metrics import registry
+from storage import create_backend
 
 load_dotenv()
 
@@ -15,6 +21,251 @@ load_dotenv()
 logger = logging.getLogger("database")
 logger.setLevel(logging.INFO)
 
+DAL_LATENCY = registry.histogram("terminal_dal_call_seconds", "DataAccessLayer call latency", labels=("method", "collection"))
+
+
+def timed(method):
+    """Record the latency of a DAL call per method and collection"""
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self, collection, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(self, collection, *args, **kwargs)
+        finally:
+            DAL_LATENCY.observe(time.perf_counter() - start, name, collection)
+    return wrapper
+
+DAL_BATCH_SIZE = registry.histogram("terminal_dal_batch_writes", "Writes per group-committed bulk write",
+                                    labels=("collection",), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+DAL_COALESCED = registry.counter("terminal_dal_coalesced_writes_total",
+                                 "Writes merged into another pending write to the same document", labels=("collection",))
+
+
+class _PendingWrite:
+    """One document's queued update, possibly several coalesced writes"""
+
+    __slots__ = ('collection', 'query', 'update', 'upsert', 'array_filters', 'waiters')
+
+    def __init__(self, collection: str, query: dict, update: dict, upsert: bool, array_filters: Optional[List[dict]]):
+        self.collection = collection
+        self.query = query
+        self.update = update
+        self.upsert = upsert
+        self.array_filters = array_filters
+        self.waiters = []
+
+    def merge(self, update: dict, upsert: bool, array_filters: Optional[List[dict]]) -> bool:
+        """Fold another write to the same document into this one, if they commute"""
+        if upsert != self.upsert or array_filters or self.array_filters or '$push' in update or '$push' in self.update:
+            return False
+        for operator, spec in update.items():
+            for field in spec:
+                for other_operator, other_spec in self.update.items():
+                    for other in other_spec:
+                        if field == other and operator == other_operator:
+                            continue
+                        if field == other or field.startswith(other + '.') or other.startswith(field + '.'):
+                            return False
+        for operator, spec in update.items():
+            target = self.update.setdefault(operator, {})
+            for field, value in spec.items():
+                if operator == '$set':
+                    target[field] = value
+                elif operator == '$inc':
+                    target[field] = target.get(field, 0) + value
+                elif operator == '$addToSet':
+                    values = target.setdefault(field, {'$each': []})['$each']
+                    values.extend(v for v in value['$each'] if v not in values)
+        return True
+
+
+class WriteBatcher:
+    """Group commit for writes that don't need the updated document back.
+
+    Writes arriving within ``window`` seconds are coalesced per document
+    ($set fields are merged with the last value winning, $inc amounts are
+    summed, $addToSet values are combined) and flushed as one unordered bulk
+    write per collection. A write that cannot be merged with the pending one
+    for its document goes into the next batch, and batches are flushed in
+    order, so per-document ordering holds. Writes queued while a flush is in
+    flight make up the next batch, which is sent as soon as it completes.
+    Everything runs on the database loop.
+    """
+
+    def __init__(self, flush: Callable[[str, List[_PendingWrite]], Coroutine], window: float = 0.005,
+                 max_writes: int = 1000):
+        self.flush = flush
+        self.window = window
+        self.max_writes = max_writes
+        self._batches = []  # dicts of document key -> _PendingWrite, oldest first
+        self._timer = None
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return sum(len(batch) for batch in self._batches)
+
+    async def write(self, collection: str, query: dict, update: dict, upsert: bool = False,
+                    array_filters: Optional[List[dict]] = None, wait: bool = True):
+        """Queue a write; with ``wait`` return once it is in the database, raising its error if it failed"""
+        key = (collection, QueryCache.query_key(query))
+        batch = self._batches[-1] if self._batches else None
+        entry = batch.get(key) if batch is not None else None
+        if entry is not None and entry.merge(update, upsert, array_filters):
+            DAL_COALESCED.inc(1, collection)
+        else:
+            if batch is None or entry is not None:
+                batch = {}
+                self._batches.append(batch)
+            entry = batch[key] = _PendingWrite(collection, query, update, upsert, array_filters)
+        waiter = None
+        if wait:
+            waiter = asyncio.get_running_loop().create_future()
+            entry.waiters.append(waiter)
+        self._schedule(len(batch) >= self.max_writes)
+        if waiter is not None:
+            await waiter
+
+    async def drain(self):
+        """Flush everything queued and wait for it"""
+        self._schedule(now=True)
+        while self._task is not None:
+            await asyncio.shield(self._task)
+
+    def _schedule(self, now: bool = False):
+        if self._task is not None:
+            return  # the running flush picks up new batches when it finishes
+        if now:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._start()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start)
+
+    def _start(self):
+        self._timer = None
+        if self._task is None and self._batches:
+            self._task = asyncio.get_running_loop().create_task(self._flush_batches())
+
+    async def _flush_batches(self):
+        try:
+            while self._batches:
+                by_collection = {}
+                for entry in self._batches.pop(0).values():
+                    by_collection.setdefault(entry.collection, []).append(entry)
+                for collection, entries in by_collection.items():
+                    error = None
+                    try:
+                        await self.flush(collection, entries)
+                    except Exception as e:
+                        error = e
+                        logger.error(f"Batched write to {collection} failed: {e}")
+                    for entry in entries:
+                        for waiter in entry.waiters:
+                            if waiter.done():
+                                continue
+                            if error is None:
+                                waiter.set_result(None)
+                            else:
+                                waiter.set_exception(error)
+        finally:
+            self._task = None
+
+
+class QueryCache:
+    """Bounded LRU cache of query results with TTL expiry.
+
+    Entries are keyed by (collection, query) and indexed per collection, so
+    invalidating a query or a whole collection never scans the cache.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttl: float = 60, disabled_collections: Optional[List[str]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disabled_collections = set(disabled_collections or [])
+        self._entries = OrderedDict()  # (collection, query_key) -> (expires_at, doc)
+        self._by_collection = {}  # collection -> set of query keys
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def query_key(query: dict) -> str:
+        return json.dumps(query, sort_keys=True, default=str)
+    
+    def enabled_for(self, collection: str) -> bool:
+        return self.max_entries > 0 and collection not in self.disabled_collections
+    
+    def get(self, collection: str, query: dict) -> Optional[dict]:
+        """Return a cached document, or None on a miss"""
+        key = (collection, self.query_key(query))
+        item = self._entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, doc = item
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return doc
+    
+    def set(self, collection: str, query: dict, doc: dict):
+        """Cache a document, evicting the least recently used entries if full"""
+        if not self.enabled_for(collection):
+            return
+        key = (collection, self.query_key(query))
+        self._entries[key] = (time.monotonic() + self.ttl, doc)
+        self._entries.move_to_end(key)
+        self._by_collection.setdefault(collection, set()).add(key[1])
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._unindex(old_key)
+            self.evictions += 1
+    
+    def invalidate(self, collection: str, query: dict):
+        """Drop the cached result for one query"""
+        if collection in self._by_collection:
+            self._remove((collection, self.query_key(query)))
+    
+    def invalidate_collection(self, collection: str):
+        """Drop every cached result for a collection"""
+        for query_key in self._by_collection.pop(collection, ()):
+            self._entries.pop((collection, query_key), None)
+    
+    def clear(self):
+        self._entries.clear()
+        self._by_collection.clear()
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+    
+    def _remove(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._unindex(key)
+    
+    def _unindex(self, key):
+        keys = self._by_collection.get(key[0])
+        if keys is not None:
+            keys.discard(key[1])
+            if not keys:
+                del self._by_collection[key[0]]
+
 class DataAccessLayer:
     _instance = None
     
@@ -29,21 +280,56 @@ class DataAccessLayer:
             return
         self._initialized = True
         
-        # Initialize MongoDB connection
-        self.mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+        # Storage backend: MongoDB (default) or embedded SQLite
         self.db_name = db_name or os.getenv("MONGO_DB_NAME", "test")
-        self.client = None
-        self.db = None
+        self.backend = create_backend(
+            os.getenv("DB_BACKEND", "mongo").lower(),
+            uri=os.getenv("MONGO_URI", "mongodb://localhost:27017"),
+            db_name=self.db_name,
+            # Connection pool settings
+            pool_options={
+                "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 50)),
+                "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 1)),
+                "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+                "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+                "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 20000)),
+            },
+            path=os.getenv("SQLITE_PATH", f"{self.db_name}.sqlite3"),
+        )
+        
+        # Dedicated event loop shared by every caller, so the Motor client
+        # and its connection pool (or the SQLite connection) stay on one thread
+        self.loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
         
-        # Encryption setup
-        self.cipher = self._get_cipher()
+        # Encryption cipher, set up on first use (only ever on the database loop)
+        self._cipher = None
+        self.indexes_ready = False
+        
+        # In-memory query cache (write-heavy collections are not cached)
+        self.cache = QueryCache(
+            max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 1024)),
+            ttl=float(os.getenv("CACHE_TTL", 60)),
+            disabled_collections=[c.strip() for c in os.getenv("CACHE_DISABLED_COLLECTIONS", "session_buffers").split(",") if c.strip()]
+        )
         
-        # In-memory cache
-        self.cache = {}
-        self.cache_ttl = 60  # seconds
+        # Group commit for writes whose result is not needed
+        self.batcher = WriteBatcher(
+            self._bulk_write,
+            window=float(os.getenv("DB_BATCH_WINDOW_MS", 5)) / 1000,
+            max_writes=int(os.getenv("DB_BATCH_MAX_WRITES", 1000))
+        )
+    
+    @property
+    def cipher(self):
+        if self._cipher is None:
+            self._cipher = self._get_cipher()
+        return self._cipher
     
     def _get_cipher(self):
         """Initialize encryption cipher"""
+        from cryptography.fernet import Fernet
         key = os.getenv("ENCRYPTION_KEY")
         if not key:
             key = Fernet.generate_key().decode()
@@ -51,122 +337,186 @@ class DataAccessLayer:
             logger.warning("Generated new encryption key")
         return Fernet(key.encode())
     
+    # Event loop management
+    def start_loop(self):
+        """Start the background database event loop thread"""
+        with self._loop_lock:
+            if self._loop_thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._run_loop, name="database-loop", daemon=True)
+            self._loop_thread.start()
+    
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule a coroutine on the database loop from any thread"""
+        self.start_loop()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Run a coroutine on the database loop and wait for its result"""
+        if threading.current_thread() is self._loop_thread:
+            coro.close()
+            raise RuntimeError("DataAccessLayer.run() cannot be called from the database loop; await instead.")
+        return self.submit(coro).result(timeout)
+    
+    def stop_loop(self, timeout: float = 5):
+        """Close the connection pool and stop the database loop thread"""
+        with self._loop_lock:
+            thread, loop = self._loop_thread, self.loop
+            if thread is None:
+                return
+            self._loop_thread = None
+        try:
+            asyncio.run_coroutine_threadsafe(self.close(), loop).result(timeout)
+        except Exception as e:
+            logger.error(f"Failed to close database connection: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        self.loop = None
+    
     async def connect(self):
         """Establish database connection"""
-        if self.client is None:
-            try:
-                self.client = AsyncIOMotorClient(self.mongo_uri)
-                self.db = self.client[self.db_name]
-                logger.info(f"Database connection established (db: {self.db_name})")
-                await self.initialize_indexes()
-            except Exception as e:
-                logger.error(f"Failed to connect to MongoDB: {e}")
-                self.client = None
-                self.db = None
-                raise
-        if self.db is None:
-            logger.error(f"MongoDB database object is None after connection attempt. URI: {self.mongo_uri}, DB: {self.db_name}")
-            raise RuntimeError("MongoDB database object is None after connection attempt.")
+        if not self.backend.connected:
+            await self.backend.connect()
+            self.indexes_ready = await self.initialize_indexes()
+    
+    async def warm_up(self):
+        """Connect, create indexes and make a round trip, so the first real query pays for none of it"""
+        await self.connect()
+        if not self.indexes_ready:
+            self.indexes_ready = await self.initialize_indexes()
+            if not self.indexes_ready:
+                raise RuntimeError("Index initialization failed")
+        await self.backend.ping()
     
     async def close(self):
         """Close database connection"""
-        if self.client:
-            self.client.close()
-            self.client = None
-            logger.info("Database connection closed")
+        await self.batcher.drain()
+        await self.backend.close()
     
     # Unified CRUD operations
+    @timed
     async def create(self, collection: str, data: dict) -> str:
         """Create a new document"""
         await self.connect()
         data = self._process_data(data, encrypt=True)
-        result = await self.db[collection].insert_one(data)
-        doc_id = str(result.inserted_id)
+        doc_id = await self.backend.insert_one(collection, data)
         logger.debug(f"Created document in {collection}: {doc_id}")
         return doc_id
     
+    @timed
     async def get(self, collection: str, query: dict, use_cache: bool = True) -> Optional[dict]:
         """Get a single document"""
         await self.connect()
-        if self.db is None:
-            logger.error("MongoDB database object is None in get(). Connection failed or not established.")
-            raise RuntimeError("MongoDB database object is None in get(). Connection failed or not established.")
         
         # Try cache first
-        cache_key = f"{collection}:{json.dumps(query, sort_keys=True)}"
-        if use_cache and cache_key in self.cache:
-            return self.cache[cache_key]
+        use_cache = use_cache and self.cache.enabled_for(collection)
+        if use_cache:
+            cached = self.cache.get(collection, query)
+            if cached is not None:
+                return cached
         
-        doc = await self.db[collection].find_one(query)
+        doc = await self.backend.find_one(collection, query)
         if doc:
             doc = self._process_data(doc, decrypt=True)
-            doc['_id'] = str(doc['_id'])  # Convert ObjectId to string
-            self.cache[cache_key] = doc
+            if use_cache:
+                self.cache.set(collection, query, doc)
             return doc
         return None
     
-    async def update(self, collection: str, query: dict, update: dict, upsert: bool = False) -> Optional[dict]:
-        """Update a document"""
+    @timed
+    async def update(self, collection: str, query: dict, update: dict, upsert: bool = False,
+                     return_document: bool = True, wait: bool = True) -> Optional[dict]:
+        """Update a document and return it as updated.
+
+        With return_document=False nothing is returned and the write is
+        group-committed with other writes; wait=False returns as soon as it
+        is queued (fire-and-forget) instead of once it is written.
+        """
         await self.connect()
         update = self._process_data(update, encrypt=True)
-        result = await self.db[collection].find_one_and_update(
-            query,
-            {'$set': update},
-            return_document=ReturnDocument.AFTER,
-            upsert=upsert
-        )
+        if not return_document:
+            await self.batcher.write(collection, query, {'$set': update}, upsert, wait=wait)
+            return None
+        result = await self.backend.set_fields(collection, query, update, upsert)
         if result:
             result = self._process_data(result, decrypt=True)
-            result['_id'] = str(result['_id'])
             self._clear_cache(collection, query)
             return result
         return None
     
+    @timed
     async def delete(self, collection: str, query: dict) -> bool:
         """Delete a document"""
         await self.connect()
-        result = await self.db[collection].delete_one(query)
+        deleted = await self.backend.delete_one(collection, query)
         self._clear_cache(collection, query)
-        return result.deleted_count > 0
+        return deleted
     
+    @timed
+    async def delete_many(self, collection: str, query: dict) -> int:
+        """Delete every matching document, returning how many were deleted"""
+        await self.connect()
+        deleted = await self.backend.delete_many(collection, query)
+        self.cache.invalidate_collection(collection)
+        return deleted
+    
+    @timed
     async def find(self, collection: str, query: dict = {}, limit: int = 100) -> List[dict]:
         """Find multiple documents"""
         await self.connect()
-        cursor = self.db[collection].find(query).limit(limit)
-        results = []
-        async for doc in cursor:
-            doc = self._process_data(doc, decrypt=True)
-            doc['_id'] = str(doc['_id'])
-            results.append(doc)
-        return results
+        docs = await self.backend.find(collection, query, limit)
+        return [self._process_data(doc, decrypt=True) for doc in docs]
     
     # Specialized methods
-    async def add_to_array(self, collection: str, query: dict, array_field: str, value: Any) -> bool:
-        """Add item to an array field"""
+    @timed
+    async def add_to_array(self, collection: str, query: dict, array_field: str, value: Any, wait: bool = True):
+        """Add item to an array field (group-committed, see update())"""
         await self.connect()
-        result = await self.db[collection].update_one(
-            query,
-            {'$addToSet': {array_field: value}}
-        )
-        self._clear_cache(collection, query)
-        return result.modified_count > 0
+        await self.batcher.write(collection, query, {'$addToSet': {array_field: {'$each': [value]}}}, wait=wait)
     
-    async def increment(self, collection: str, query: dict, field: str, amount: int) -> bool:
-        """Increment a numeric field"""
+    @timed
+    async def push_to_array(self, collection: str, query: dict, array_field: str, values: list,
+                            slice: Optional[int] = None, array_filters: Optional[List[dict]] = None,
+                            upsert: bool = False, fields: Optional[dict] = None, wait: bool = True):
+        """Append items to an array field, optionally trimming it to `slice` items (group-committed).
+
+        `fields` are set in the same write.
+        """
         await self.connect()
-        result = await self.db[collection].update_one(
-            query,
-            {'$inc': {field: amount}}
-        )
-        self._clear_cache(collection, query)
-        return result.modified_count > 0
+        push = {'$each': values}
+        if slice is not None:
+            push['$slice'] = slice
+        update = {'$push': {array_field: push}}
+        if fields:
+            update['$set'] = self._process_data(fields, encrypt=True)
+        await self.batcher.write(collection, query, update, upsert, array_filters, wait=wait)
+
+    @timed
+    async def increment(self, collection: str, query: dict, field: str, amount: int, wait: bool = True):
+        """Increment a numeric field (group-committed)"""
+        await self.connect()
+        await self.batcher.write(collection, query, {'$inc': {field: amount}}, wait=wait)
     
+    @timed
     async def replace_all(self, collection: str, data: list):
         """Replace all documents in a collection"""
         await self.connect()
-        await self.db[collection].delete_many({})
-        if data:
-            await self.db[collection].insert_many(data)
+        await self.backend.replace_all(collection, data)
+        self.cache.invalidate_collection(collection)
+    
+    async def _bulk_write(self, collection: str, writes: list):
+        DAL_BATCH_SIZE.observe(len(writes), collection)
+        try:
+            await self.backend.bulk_update(
+                collection, [(w.query, w.update, w.upsert, w.array_filters) for w in writes])
+        finally:
+            for write in writes:
+                self._clear_cache(collection, write.query)
     
     # Helper methods
     def _process_data(self, data: dict, encrypt: bool = False, decrypt: bool = False) -> dict:
@@ -189,23 +539,29 @@ class DataAccessLayer:
         return processed
     
     def _clear_cache(self, collection: str, query: dict):
-        """Clear cache entries matching pattern"""
-        pattern = f"{collection}:{json.dumps(query, sort_keys=True)}"
-        keys = [k for k in self.cache.keys() if k.startswith(pattern)]
-        for key in keys:
-            del self.cache[key]
-    
-    async def initialize_indexes(self):
-        """Create essential database indexes for your project"""
+        """Clear the cache entry for a query"""
+        self.cache.invalidate(collection, query)
+    
+    async def initialize_indexes(self) -> bool:
+        """Create essential database indexes for your project, returning whether that worked"""
         try:
             # Index for terminal_states collection: ensure 'user_key' is unique
-            await self.db.terminal_states.create_index("user_key", unique=True)
+            await self.backend.create_index("terminal_states", "user_key", unique=True)
+            # Session ownership registry used when running several workers
+            await self.backend.create_index("session_owners", "session_id", unique=True)
+            await self.backend.create_index("cluster_workers", "worker_id", unique=True)
+            # Persisted output, looked up by session on every flush and reconnect
+            await self.backend.create_index("session_buffers", "session_id")
+            # Abandoned buffers are expired by last write time
+            await self.backend.create_index("session_buffers", "updated_at")
             # If you use URLs collection, keep the following line:
             # await self.db.urls.create_index("url", unique=True)
             # Add more indexes as needed for your project
             logger.info("Database indexes initialized for terminal_states.")
+            return True
         except Exception as e:
             logger.error(f"Index initialization failed: {e}")
+            return False
 
 # Global database instance
 # To use a custom db name: db = DataAccessLayer(db_name="mydb")
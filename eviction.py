@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger("eviction")
+
+
+class SessionEvictor:
+    """Drops idle sessions from memory, so it tracks active sessions only.
+
+    Every ``interval`` seconds a background thread asks ``sessions()`` for
+    ``(session_id, last_active, size, busy)`` of each session held in memory,
+    where ``last_active`` is a ``time.monotonic()`` timestamp and ``size`` the
+    characters of output held. Sessions that are not busy are evicted through
+    ``evict(session_id, last_active)``:
+
+    - every session idle for more than ``idle_timeout`` seconds (0 disables),
+    - then, while all sessions together hold more than ``max_bytes``
+      characters (0 disables), the least recently active ones that have been
+      idle for at least ``min_idle`` seconds.
+
+    ``evict`` must leave the session alone, returning False, if it has been
+    active since ``last_active``; an evicted session is reloaded from the
+    database by its next event.
+    """
+
+    def __init__(self, sessions: Callable[[], List[Tuple[str, float, int, bool]]],
+                 evict: Callable[[str, float], bool], idle_timeout: float = 900, max_bytes: int = 0,
+                 min_idle: float = 10, interval: float = 30):
+        self.sessions = sessions
+        self.evict = evict
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes
+        self.min_idle = min_idle
+        self.interval = interval
+        self.evicted = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="session-evictor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Session eviction failed: {e}")
+
+    def sweep(self) -> int:
+        """Evict what the policy allows now, returning how many sessions were evicted"""
+        now = time.monotonic()
+        sessions = self.sessions()
+        total = sum(size for _, _, size, _ in sessions)
+        idle = sorted((s for s in sessions if not s[3]), key=lambda s: s[1])  # least recently active first
+        evicted = 0
+        for session_id, last_active, size, _ in idle:
+            idle_for = now - last_active
+            expired = self.idle_timeout > 0 and idle_for > self.idle_timeout
+            over_budget = 0 < self.max_bytes < total and idle_for >= self.min_idle
+            if not expired and not over_budget:
+                # Sorted by activity, so no later session qualifies either
+                break
+            if self._evict(session_id, last_active):
+                total -= size
+                evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions ({total} characters of output still held)")
+        return evicted
+
+    def _evict(self, session_id: str, last_active: float) -> bool:
+        try:
+            evicted = self.evict(session_id, last_active)
+        except Exception as e:
+            logger.error(f"Failed to evict session {session_id}: {e}")
+            return False
+        if evicted:
+            self.evicted += 1
+        return evicted
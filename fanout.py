@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+logger = logging.getLogger("fanout")
+
+# Sequenced session output; every other event is emitted as usual
+OUTPUT_EVENT = 'command_output'
+OUTPUT_BATCH_EVENT = 'command_output_batch'
+SKIPPED_EVENT = 'output_skipped'
+
+
+class _Subscriber:
+    """Output queued for one client that is not keeping up"""
+
+    __slots__ = ('sid', 'eio_sid', 'namespace', 'session_id', 'frames', 'size', 'skipped', 'skipped_epoch',
+                 'skipped_seq')
+
+    def __init__(self, sid, eio_sid, namespace, session_id):
+        self.sid = sid
+        self.eio_sid = eio_sid
+        self.namespace = namespace
+        self.session_id = session_id
+        self.frames = deque()  # (epoch, seq, output)
+        self.size = 0
+        self.skipped = 0       # characters dropped since the last marker
+        self.skipped_epoch = None
+        self.skipped_seq = None
+
+
+class OutputFanout:
+    """Broadcast of session output frames to the clients in each session's room.
+
+    A frame is encoded once and handed straight to every subscriber whose
+    Engine.IO send queue holds fewer than ``max_in_flight`` packets. Frames
+    for a subscriber that is further behind wait in its own queue instead,
+    and a background thread sends them, coalesced into one
+    ``command_output_batch`` per epoch, once it catches up. When a queue
+    would exceed ``max_queue_bytes`` characters its frames are dropped and
+    the subscriber is sent an ``output_skipped`` marker with the number of
+    characters skipped, after which the client resyncs. Publishing never
+    waits for a subscriber, so a slow viewer cannot hold up the command or
+    the other viewers.
+
+    This relies on python-socketio and python-engineio internals (the
+    server's ``_send_eio_packet`` and each socket's send queue), pinned in
+    requirements.txt. If they are missing, output is emitted as usual
+    through the client manager, without per-subscriber backpressure.
+    """
+
+    def __init__(self, max_queue_bytes: int = 1 << 20, max_in_flight: int = 8, poll_interval: float = 0.02):
+        self.max_queue_bytes = max_queue_bytes
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.server = None
+        self.supported = True
+        self.skipped_bytes = 0
+        self.coalesced_frames = 0
+        self._lagging = {}  # session_id -> {sid: _Subscriber}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def lagging(self) -> int:
+        """Subscribers with output waiting in their own queue"""
+        with self._cond:
+            return sum(len(subscribers) for subscribers in self._lagging.values())
+
+    def bind(self, server: socketio.Server):
+        self.server = server
+        eio = getattr(server, 'eio', None)
+        if not callable(getattr(server, '_send_eio_packet', None)) or not isinstance(getattr(eio, 'sockets', None), dict):
+            self._unsupported("the Socket.IO server cannot send Engine.IO packets directly")
+
+    def _unsupported(self, reason: str):
+        if self.supported:
+            self.supported = False
+            logger.warning(f"Output fanout disabled, {reason}; output is emitted without backpressure")
+
+    def deliver(self, manager, event: str, data, namespace: Optional[str], room, skip_sid=None, callback=None) -> bool:
+        """Fan an output frame emitted to a session room out to its local subscribers.
+
+        Returns False, leaving delivery to the client manager, for anything else.
+        """
+        if (event != OUTPUT_EVENT or self.server is None or not self.supported or callback or skip_sid or not isinstance(room, str)
+                or not isinstance(data, dict) or 'seq' not in data):
+            return False
+        namespace = namespace or '/'
+        frame = (data.get('epoch'), data['seq'], data.get('output', ''))
+        packets = None
+        with self._cond:
+            lagging = self._lagging.get(room)
+            for sid, eio_sid in manager.get_participants(namespace, room):
+                subscriber = lagging.get(sid) if lagging else None
+                if subscriber is None:
+                    if self._backlog(eio_sid) < self.max_in_flight:
+                        if packets is None:
+                            packets = self._encode(namespace, OUTPUT_EVENT, data)
+                        self._send(eio_sid, packets)
+                        continue
+                    subscriber = _Subscriber(sid, eio_sid, namespace, room)
+                    lagging = self._lagging.setdefault(room, {})
+                    lagging[sid] = subscriber
+                    self._ensure_started()
+                self._queue(subscriber, frame)
+            if lagging:
+                self._cond.notify()
+        return True
+
+    def resynced(self, session_id: str, sid: str):
+        """Forget output queued for a client that has just been resent everything it missed"""
+        with self._cond:
+            subscriber = self._lagging.get(session_id, {}).get(sid)
+            if subscriber is not None:
+                subscriber.frames.clear()
+                subscriber.size = 0
+                subscriber.skipped = 0
+
+    # Queues
+    def _queue(self, subscriber: _Subscriber, frame: tuple):
+        size = len(frame[2])
+        if subscriber.size + size > self.max_queue_bytes:
+            # Too far behind to be worth catching up frame by frame
+            subscriber.skipped += subscriber.size + size
+            self.skipped_bytes += subscriber.size + size
+            subscriber.skipped_epoch, subscriber.skipped_seq = frame[0], frame[1]
+            subscriber.frames.clear()
+            subscriber.size = 0
+            return
+        subscriber.frames.append(frame)
+        subscriber.size += size
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="output-fanout", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._lagging:
+                    self._cond.wait()
+                subscribers = [s for session in self._lagging.values() for s in session.values()]
+            for subscriber in subscribers:
+                try:
+                    self._catch_up(subscriber)
+                except Exception as e:
+                    logger.error(f"Failed to send output to {subscriber.sid}: {e}")
+            # Engine.IO reports no progress, so poll until the laggards catch up
+            time.sleep(self.poll_interval)
+
+    def _catch_up(self, subscriber: _Subscriber):
+        connected = self._connected(subscriber.eio_sid)
+        with self._cond:
+            if connected and self._backlog(subscriber.eio_sid) >= self.max_in_flight:
+                return
+            frames, subscriber.frames, subscriber.size = subscriber.frames, deque(), 0
+            skipped, subscriber.skipped = subscriber.skipped, 0
+        if connected:
+            if skipped:
+                self._send(subscriber.eio_sid, self._encode(subscriber.namespace, SKIPPED_EVENT, {
+                    'session_id': subscriber.session_id, 'epoch': subscriber.skipped_epoch,
+                    'seq': subscriber.skipped_seq, 'skipped': skipped}))
+            batch, epoch = [], None
+            for frame_epoch, seq, output in frames:
+                if batch and frame_epoch != epoch:
+                    self._send_batch(subscriber, epoch, batch)
+                    batch = []
+                epoch = frame_epoch
+                batch.append([seq, output])
+            if batch:
+                self._send_batch(subscriber, epoch, batch)
+        with self._cond:
+            if not connected or (not subscriber.frames and not subscriber.skipped):
+                # Caught up: output goes straight to the client again
+                session = self._lagging.get(subscriber.session_id, {})
+                if session.get(subscriber.sid) is subscriber:
+                    del session[subscriber.sid]
+                    if not session:
+                        del self._lagging[subscriber.session_id]
+
+    def _send_batch(self, subscriber: _Subscriber, epoch, frames: list):
+        self.coalesced_frames += len(frames)
+        self._send(subscriber.eio_sid, self._encode(subscriber.namespace, OUTPUT_BATCH_EVENT, {
+            'session_id': subscriber.session_id, 'epoch': epoch, 'frames': frames}))
+
+    # Engine.IO
+    def _encode(self, namespace: str, event: str, data: dict) -> list:
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event, data]).encode()
+        return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in (encoded if isinstance(encoded, list) else [encoded])]
+
+    def _send(self, eio_sid: str, packets: list):
+        for p in packets:
+            self.server._send_eio_packet(eio_sid, p)
+
+    def _backlog(self, eio_sid: str) -> int:
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            return 0
+        queue = getattr(socket, 'queue', None)
+        if not callable(getattr(queue, 'qsize', None)):
+            # This frame still goes out directly; later ones through the client manager
+            self._unsupported("Engine.IO sockets have no send queue")
+            return 0
+        return queue.qsize()
+
+    def _connected(self, eio_sid: str) -> bool:
+        socket = self.server.eio.sockets.get(eio_sid)
+        return socket is not None and not getattr(socket, 'closed', False)
+
+
+class FanoutManager(socketio.Manager):
+    """In-process client manager that sends session output through an OutputFanout"""
+
+    fanout: Optional[OutputFanout] = None
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        if self.fanout is not None and self.fanout.deliver(self, event, data, namespace, to or room, skip_sid, callback):
+            return
+        return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, to=to, **kwargs)
@@ -1,117 +1,189 @@
-from flask import Flask, render_template, request, redirect, url_for, session
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, g, render_template, request, redirect, url_for, session
+from flask_socketio import SocketIO, emit, join_room
 from dotenv import load_dotenv
 import os
+import socket
+import functools
+import hmac
+import logging
+import time
 import threading
 import signal
-import time
-import asyncio
 import atexit
-import re
 import json
-from collections import deque
+import zlib
+from archive import OutputArchive, utf8_page
+from cluster import SessionRegistry, WORKER_EVENT, make_client_manager, worker_room
 from database import db
+from eviction import SessionEvictor
+from fanout import FanoutManager, OutputFanout
+from metrics import registry as metrics_registry
+from persistence import SessionBufferWriter
+from sampler import ResourceSampler
+from scheduler import CommandScheduler
+from scrollback import ReplayLog, Scrollback, ScrollbackBudget
+from search import SearchIndex
+from shell import ShellSession
+from startup import Startup
+from streaming import OutputBatcher, TerminalFilter
+from supervisor import ProcessSupervisor
 from flask import jsonify
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Command output is logged line by line at DEBUG
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING').upper())
+logger = logging.getLogger("terminal")
+output_log = logging.getLogger("terminal.output")
+
 SECRET_KEY = os.getenv('SECRET_KEY', 'changeme')
 PORT = int(os.getenv('PORT', 5001))
+# Output is flushed from a background thread, so default to native threads
+SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+# Message queue shared by all workers (redis://, amqp://, kafka://, zmq+tcp://, or local:// within one process).
+# When set, events reach clients on any worker and session events run on the worker that owns the session.
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# Seconds without a heartbeat after which a worker's sessions can be taken over
+SESSION_OWNER_TTL = float(os.getenv('SESSION_OWNER_TTL', 30))
+# Output characters queued for a client that is not keeping up; beyond this it skips ahead and resyncs
+SUBSCRIBER_QUEUE_BYTES = int(os.getenv('SUBSCRIBER_QUEUE_BYTES', 1 << 20))
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
-socketio = SocketIO(app)
+startup = Startup()
+output_fanout = OutputFanout(max_queue_bytes=SUBSCRIBER_QUEUE_BYTES)
+client_manager = make_client_manager(SOCKETIO_MESSAGE_QUEUE) if SOCKETIO_MESSAGE_QUEUE else FanoutManager()
+client_manager.fanout = output_fanout
+socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, client_manager=client_manager)
+output_fanout.bind(socketio.server)
+db.start_loop()
+registry = SessionRegistry(db, WORKER_ID, ttl=SESSION_OWNER_TTL) if SOCKETIO_MESSAGE_QUEUE else None
+if registry is not None:
+    registry.start()
 
 OUTPUT_BUFFER_SIZE = 100
+# Scrollback limits (characters): per session, per command and across all sessions
+SCROLLBACK_SESSION_BYTES = int(os.getenv('SCROLLBACK_SESSION_BYTES', 1 << 20))
+SCROLLBACK_ENTRY_BYTES = int(os.getenv('SCROLLBACK_ENTRY_BYTES', 512 << 10))
+SCROLLBACK_GLOBAL_BYTES = int(os.getenv('SCROLLBACK_GLOBAL_BYTES', 256 << 20))
+SCROLLBACK_CHUNK_SIZE = 4096
+# Recent output kept per session for delta resync on reconnect (characters)
+REPLAY_LOG_BYTES = int(os.getenv('REPLAY_LOG_BYTES', 256 << 10))
+# Command output is sent in chunks of up to this many characters...
+OUTPUT_BATCH_BYTES = int(os.getenv('OUTPUT_BATCH_BYTES', 16384))
+# ...or after this many seconds, whichever comes first
+OUTPUT_BATCH_DELAY = float(os.getenv('OUTPUT_BATCH_DELAY', 0.02))
+# Run commands on a pseudo-terminal (POSIX only) so they stream like in a real terminal
+COMMAND_PTY = os.name != 'nt' and os.getenv('COMMAND_PTY', '1').lower() not in ('0', 'false', 'no')
+# Run a session's commands in one long-lived shell so cd/export/source persist (per session via 'session_options')
+PERSISTENT_SHELL = os.name != 'nt' and os.getenv('PERSISTENT_SHELL', '0').lower() not in ('0', 'false', 'no')
+# Strip terminal escape sequences from output by default (per session via 'session_options')
+STRIP_ANSI = os.getenv('STRIP_ANSI', '1').lower() not in ('0', 'false', 'no')
+# Queue a new command behind the running one instead of killing it (per session via 'session_options')
+QUEUE_COMMANDS = os.getenv('QUEUE_COMMANDS', '0').lower() not in ('0', 'false', 'no')
+# Commands running at once on this worker, across all sessions (default: CPU count)
+MAX_RUNNING_COMMANDS = int(os.getenv('MAX_RUNNING_COMMANDS', 0)) or None
+# Further commands wait while system CPU use is at or above this percentage...
+ADMISSION_MAX_CPU = float(os.getenv('ADMISSION_MAX_CPU', 90))
+# ...or less than this much memory (MB) is available
+ADMISSION_MIN_MEMORY_MB = int(os.getenv('ADMISSION_MIN_MEMORY_MB', 256))
+# Seconds between process_metrics samples of running commands (0 disables sampling)
+PROCESS_METRICS_INTERVAL = float(os.getenv('PROCESS_METRICS_INTERVAL', 2.0))
+# Bearer token that lets a scraper read /metrics without logging in
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Seconds a stopped process gets to exit before it is killed
+TERMINATE_GRACE = float(os.getenv('TERMINATE_GRACE', 1.0))
+# Total seconds allowed for stopping every process at shutdown
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 3.0))
+# Session buffer deltas are written to the database at this interval (seconds)
+BUFFER_FLUSH_INTERVAL = float(os.getenv('BUFFER_FLUSH_INTERVAL', 1.0))
+# Sessions with nothing running are dropped from memory after this many idle seconds and
+# reloaded from the database on their next event (0 disables)
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', 900))
+# Output characters held by all in-memory sessions beyond which the least recently used idle ones are dropped (0 disables)
+SESSION_MEMORY_BYTES = int(os.getenv('SESSION_MEMORY_BYTES', 128 << 20))
+# Stored session buffers not written for this many seconds are deleted (0 disables)
+SESSION_BUFFER_TTL = float(os.getenv('SESSION_BUFFER_TTL', 7 * 24 * 3600))
+# Every session's full output is archived, compressed, under this directory (empty disables the archive)
+OUTPUT_ARCHIVE_DIR = os.getenv('OUTPUT_ARCHIVE_DIR', 'output_archive')
+# Compressed bytes kept per session; the oldest segments are deleted beyond this
+OUTPUT_ARCHIVE_MAX_BYTES = int(os.getenv('OUTPUT_ARCHIVE_MAX_BYTES', 1 << 30))
+OUTPUT_ARCHIVE_SEGMENT_BYTES = int(os.getenv('OUTPUT_ARCHIVE_SEGMENT_BYTES', 8 << 20))
+# Largest page the scrollback API returns (bytes)
+SCROLLBACK_PAGE_MAX_BYTES = 1 << 20
+# Characters of recent output, across all sessions, kept in the search index (0 disables search)
+SEARCH_INDEX_MAX_BYTES = int(os.getenv('SEARCH_INDEX_MAX_BYTES', 32 << 20))
+# Share of one core the indexer may use; output arriving faster than it can index is skipped
+SEARCH_INDEX_MAX_CPU = float(os.getenv('SEARCH_INDEX_MAX_CPU', 0.25))
+
+# Per-session settings changed through 'session_options'
+SESSION_OPTIONS = ('strip_ansi', 'persistent_shell', 'queue_commands')
 
+# process_lock only guards membership of running_processes; each session's
+# process state is guarded by its own 'lock' so sessions never block each other
 process_lock = threading.Lock()
-running_processes = {}  # session_id -> {'proc': ..., 'cwd': ..., 'output_buffer': deque}
+running_processes = {}  # session_id -> {'proc': ..., 'lock': RLock, 'cwd': ..., 'output_buffer': Scrollback, 'replay': ReplayLog, 'shell': ShellSession, 'last_active': monotonic time}
+scrollback_budget = ScrollbackBudget(SCROLLBACK_GLOBAL_BYTES)
+supervisor = ProcessSupervisor(terminate_grace=TERMINATE_GRACE)
+buffer_writer = SessionBufferWriter(db, max_entries=OUTPUT_BUFFER_SIZE, flush_interval=BUFFER_FLUSH_INTERVAL,
+                                    chunk_size=SCROLLBACK_CHUNK_SIZE, max_entry_bytes=SCROLLBACK_ENTRY_BYTES)
+output_archive = OutputArchive(OUTPUT_ARCHIVE_DIR, max_bytes=OUTPUT_ARCHIVE_MAX_BYTES,
+                               segment_bytes=OUTPUT_ARCHIVE_SEGMENT_BYTES) if OUTPUT_ARCHIVE_DIR else None
+search_index = SearchIndex(max_bytes=SEARCH_INDEX_MAX_BYTES, max_cpu=SEARCH_INDEX_MAX_CPU) if SEARCH_INDEX_MAX_BYTES > 0 else None
+
+EMIT_LATENCY = metrics_registry.histogram('terminal_emit_seconds', 'Time to hand a session event to Socket.IO', labels=('event',))
+OUTPUT_BYTES = metrics_registry.counter('terminal_output_bytes_total', 'Command output bytes streamed', labels=('session_id',))
+OUTPUT_LINES = metrics_registry.counter('terminal_output_lines_total', 'Command output lines streamed', labels=('session_id',))
+SPAWN_LATENCY = metrics_registry.histogram('terminal_spawn_seconds', 'Time to start a command', labels=('mode',))
+QUEUE_WAIT = metrics_registry.histogram('terminal_queue_wait_seconds', 'Time a command waited for admission')
 
 def kill_running_process(session_id):
+    """Signal the session's process group and return; the supervisor escalates to SIGKILL"""
     with process_lock:
         proc_info = running_processes.get(session_id)
-        proc = proc_info['proc'] if proc_info else None
-        if proc and proc.poll() is None:
-            try:
-                if os.name == 'nt':
-                    try:
-                        proc.send_signal(signal.CTRL_BREAK_EVENT)
-                        time.sleep(0.5)
-                    except Exception:
-                        pass
-                    try:
-                        proc.terminate()
-                        time.sleep(0.5)
-                    except Exception:
-                        pass
-                    try:
-                        proc.kill()
-                    except Exception:
-                        pass
-                else:
-                    try:
-                        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-                        time.sleep(0.5)
-                    except Exception:
-                        pass
-                    try:
-                        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
-                    except Exception:
-                        pass
-                try:
-                    import psutil
-                    parent = psutil.Process(proc.pid)
-                    children = parent.children(recursive=True)
-                    for child in children:
-                        try:
-                            child.terminate()
-                        except psutil.NoSuchProcess:
-                            pass
-                    time.sleep(0.5)
-                    for child in children:
-                        try:
-                            child.kill()
-                        except psutil.NoSuchProcess:
-                            pass
-                    try:
-                        parent.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            finally:
-                running_processes[session_id]['proc'] = None
+    if proc_info is None:
+        return
+    with proc_info['lock']:
+        proc, proc_info['proc'] = proc_info['proc'], None
+        shell = proc_info.get('shell')
+        if proc is not None and shell is not None and proc is shell.proc:
+            if not shell.busy:
+                return  # the command already finished; the shell stays
+            proc_info['shell'] = None
+    if proc is not None:
+        supervisor.terminate(proc)
+
+def get_shell(proc_info):
+    """Return the session's shell, starting a new one if there is none or it exited"""
+    with proc_info['lock']:
+        shell = proc_info.get('shell')
+        if shell is None or not shell.alive:
+            shell = ShellSession(supervisor, proc_info['cwd'], use_pty=COMMAND_PTY)
+            proc_info['shell'] = shell
+        return shell
+
+def close_shell(proc_info):
+    with proc_info['lock']:
+        shell, proc_info['shell'] = proc_info.get('shell'), None
+    if shell is not None:
+        supervisor.terminate(shell.proc)
 
 def cleanup_all_processes():
+    resource_sampler.stop()
+    session_evictor.stop()
+    supervisor.shutdown(timeout=SHUTDOWN_TIMEOUT)
     with process_lock:
-        for session_id, proc_info in running_processes.items():
-            if proc_info['proc'] and proc_info['proc'].poll() is None:
-                try:
-                    import psutil
-                    parent = psutil.Process(proc_info['proc'].pid)
-                    children = parent.children(recursive=True)
-                    for child in children:
-                        try:
-                            child.terminate()
-                        except psutil.NoSuchProcess:
-                            pass
-                    time.sleep(0.5)
-                    for child in children:
-                        try:
-                            child.kill()
-                        except psutil.NoSuchProcess:
-                            pass
-                    try:
-                        parent.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-                except Exception:
-                    pass
-                finally:
-                    proc_info['proc'] = None
+        sessions = list(running_processes.values())
+    for proc_info in sessions:
+        proc_info['proc'] = None
+    buffer_writer.stop()
+    if output_archive is not None:
+        output_archive.flush()
+    if registry is not None:
+        registry.stop()
+    db.stop_loop()
 
 atexit.register(cleanup_all_processes)
 
@@ -124,61 +196,377 @@ if hasattr(signal, 'SIGTERM'):
     signal.signal(signal.SIGTERM, handle_exit_signal)
 
 # --- DB-backed session buffer ---
+def new_scrollback():
+    return Scrollback(max_entries=OUTPUT_BUFFER_SIZE, max_bytes=SCROLLBACK_SESSION_BYTES,
+                      max_entry_bytes=SCROLLBACK_ENTRY_BYTES, chunk_size=SCROLLBACK_CHUNK_SIZE,
+                      budget=scrollback_budget)
+
+def append_buffer_entry(session_id, proc_info, command, output=''):
+    entry = proc_info['output_buffer'].start_entry(proc_info['cwd'], command, output)
+    buffer_writer.start_entry(session_id, entry)
+    return entry
+
+def append_output(session_id, proc_info, entry, text):
+    proc_info['output_buffer'].append(entry, text)
+    buffer_writer.append(session_id, entry, text)
+
 async def db_load_session_buffer(session_id):
-    data = await db.get("session_buffers", {"session_id": session_id})
+    """Load a session's stored (scrollback, cwd, options)"""
+    await buffer_writer.write_pending(session_id)
+    data = await db.get("session_buffers", {"session_id": session_id}, use_cache=False)
+    scrollback = new_scrollback()
     if data:
-        buf = data.get('output_buffer', [])
-        if buf and isinstance(buf, list) and buf and isinstance(buf[0], str):
-            buf = [{'cwd': data.get('cwd', os.getcwd()), 'command': '', 'output': line} for line in buf]
-        return deque(buf, maxlen=OUTPUT_BUFFER_SIZE), data.get('cwd', os.getcwd())
-    return deque(maxlen=OUTPUT_BUFFER_SIZE), os.getcwd()
-
-async def db_save_session_buffer(session_id, output_buffer, cwd):
-    await db.update("session_buffers", {"session_id": session_id}, {
-        "session_id": session_id,
-        "output_buffer": list(output_buffer),
-        "cwd": cwd
-    }, upsert=True)
-
-async def db_clear_session_buffer(session_id, cwd):
-    await db.update("session_buffers", {"session_id": session_id}, {
-        "session_id": session_id,
-        "output_buffer": [],
-        "cwd": cwd
-    }, upsert=True)
+        options = {key: value for key, value in (data.get('options') or {}).items() if key in SESSION_OPTIONS}
+        cwd = data.get('cwd') or os.getcwd()
+        for item in data.get('output_buffer', []):
+            if isinstance(item, str):
+                scrollback.start_entry(cwd, '', item)
+            else:
+                output = ''.join(item['chunks']) + item.get('tail', '') if 'chunks' in item else item.get('output', '')
+                scrollback.start_entry(item.get('cwd', cwd), item.get('command', ''), output, item.get('id'),
+                                       item.get('truncated', 0))
+        return scrollback, cwd, options
+    return scrollback, os.getcwd(), {}
 
 async def db_delete_session_buffer(session_id):
+    await buffer_writer.drop_pending(session_id)
     await db.delete("session_buffers", {"session_id": session_id})
 
+def get_session(session_id):
+    """Return the in-memory session, loading its buffer from the database if needed"""
+    with process_lock:
+        proc_info = running_processes.get(session_id)
+        if proc_info is not None:
+            proc_info['last_active'] = time.monotonic()
+    if proc_info is None:
+        output_buffer, cwd, options = db.run(db_load_session_buffer(session_id))
+        if os.name == 'nt':
+            options.pop('persistent_shell', None)
+        with process_lock:
+            proc_info = running_processes.setdefault(session_id, {
+                'proc': None, 'lock': threading.RLock(), 'cwd': cwd, 'output_buffer': output_buffer, 'replay': ReplayLog(REPLAY_LOG_BYTES),
+                'strip_ansi': STRIP_ANSI, 'persistent_shell': PERSISTENT_SHELL, 'shell': None, 'run_id': None,
+                'queue_commands': QUEUE_COMMANDS, **options
+            })
+            proc_info['last_active'] = time.monotonic()
+        # Keep the stored buffer from expiring while the session is in use
+        buffer_writer.touch(session_id)
+    return proc_info
+
+# --- Sequenced session output ---
+def send_frame(session_id, proc_info, text):
+    """Send text to every client of a session as the next sequenced frame; returns its archive offset"""
+    replay = proc_info['replay']
+    offset = None
+    with replay.lock:
+        seq = replay.record(text)
+        if output_archive is not None:
+            offset = output_archive.append(session_id, text)
+        start = time.perf_counter()
+        socketio.emit('command_output', {'output': text, 'session_id': session_id, 'seq': seq, 'epoch': replay.epoch}, to=session_id)
+        EMIT_LATENCY.observe(time.perf_counter() - start, 'command_output')
+    return offset
+
+def publish_output(session_id, proc_info, entry, text):
+    """Append command output to the scrollback and send it, atomically"""
+    with proc_info['replay'].lock:
+        append_output(session_id, proc_info, entry, text)
+        offset = send_frame(session_id, proc_info, text)
+        if search_index is not None:
+            search_index.add_output(session_id, entry, text, offset)
+    OUTPUT_BYTES.inc(len(text) if text.isascii() else len(text.encode('utf-8', 'replace')), session_id)
+    OUTPUT_LINES.inc(text.count('\n'), session_id)
+
+def start_command(session_id, proc_info, command, output=''):
+    """Add a buffer entry for a command and send its prompt and any immediate output"""
+    with proc_info['replay'].lock:
+        entry = append_buffer_entry(session_id, proc_info, command, output)
+        offset = send_frame(session_id, proc_info, f"\n{entry.cwd}\n$ {command}\n")
+        if search_index is not None:
+            search_index.add_command(session_id, entry, offset)
+        if output:
+            offset = send_frame(session_id, proc_info, output)
+            if search_index is not None:
+                search_index.add_output(session_id, entry, output, offset)
+    return entry
+
+def render_scrollback(proc_info):
+    parts = []
+    for entry in proc_info['output_buffer']:
+        if entry.command:
+            parts.append(f"\n{entry.cwd}\n$ {entry.command}\n")
+        parts.append(entry.output)
+    return ''.join(parts) or f"\n{proc_info['cwd']}\n$ "
+
+def resync_client(session_id, proc_info, epoch, last_seq):
+    """Send a reconnecting client only what it missed, or a compressed snapshot"""
+    replay = proc_info['replay']
+    with replay.lock:
+        # What is sent here covers any output still queued for this client
+        output_fanout.resynced(session_id, request.sid)
+        frames = replay.since(epoch, last_seq)
+        start = time.perf_counter()
+        if frames is None:
+            snapshot = zlib.compress(render_scrollback(proc_info).encode('utf-8'))
+            emit('output_snapshot', {'session_id': session_id, 'seq': replay.seq, 'epoch': replay.epoch,
+                                     'encoding': 'deflate', 'data': snapshot})
+            EMIT_LATENCY.observe(time.perf_counter() - start, 'output_snapshot')
+        elif frames:
+            emit('command_output_batch', {'session_id': session_id, 'epoch': replay.epoch, 'frames': frames})
+            EMIT_LATENCY.observe(time.perf_counter() - start, 'command_output_batch')
+
+def start_job(session_id, proc_info, command, job):
+    """Start a command admitted by the scheduler; `job.done()` is called once it has finished"""
+    logger.info("%s: running %r in %s", session_id, command, proc_info['cwd'])
+    QUEUE_WAIT.observe(time.monotonic() - job.submitted)
+    entry = start_command(session_id, proc_info, command)
+    term_filter = TerminalFilter(strip_ansi=proc_info.get('strip_ansi', STRIP_ANSI))
+    batcher = OutputBatcher(
+        lambda chunk: publish_output(session_id, proc_info, entry, chunk),
+        max_bytes=OUTPUT_BATCH_BYTES,
+        max_delay=OUTPUT_BATCH_DELAY,
+    )
+
+    def on_output(text):
+        text = term_filter.feed(text)
+        if output_log.isEnabledFor(logging.DEBUG):
+            output_log.debug("%s: %s", session_id, text.rstrip())
+        batcher.write(text)
+
+    def finish(returncode, cwd=None):
+        batcher.write(term_filter.flush())
+        batcher.close()
+        if output_archive is not None:
+            output_archive.flush(session_id)
+        with proc_info['lock']:
+            if proc_info['run_id'] != entry.id:
+                return False  # a newer command already owns this session
+            proc_info['proc'] = None
+            proc_info['last_active'] = time.monotonic()
+            if cwd is not None and cwd != proc_info['cwd']:
+                proc_info['cwd'] = cwd
+                buffer_writer.set_cwd(session_id, cwd)
+                socketio.emit('session_state', {'cwd': cwd, 'session_id': session_id}, to=session_id)
+            socketio.emit('process_stopped', {'session_id': session_id})
+            socketio.emit('process_status', {'running': False, 'exit_code': returncode, 'session_id': session_id})
+        return True
+
+    def on_exit(proc, returncode):
+        finished = finish(returncode)
+        job.done()
+        if finished:
+            buffer_writer.flush(session_id)
+
+    def on_shell_done(status, cwd):
+        # Runs on the output reader thread, so do not wait for the write
+        finished = finish(status, cwd)
+        job.done()
+        if finished:
+            buffer_writer.flush_soon(session_id)
+
+    try:
+        with proc_info['lock']:
+            proc_info['run_id'] = entry.id
+            start = time.perf_counter()
+            if proc_info['persistent_shell']:
+                shell = get_shell(proc_info)
+                shell.run(command, on_output, on_shell_done)
+                proc = shell.proc
+                SPAWN_LATENCY.observe(time.perf_counter() - start, 'shell')
+            else:
+                proc = supervisor.spawn(command, proc_info['cwd'], on_output, on_exit, use_pty=COMMAND_PTY)
+                SPAWN_LATENCY.observe(time.perf_counter() - start, 'process')
+            proc_info['proc'] = proc
+            socketio.emit('process_status', {'running': True, 'session_id': session_id})
+    except Exception as e:
+        msg = f'Error: {e}\n'
+        logger.exception("%s: failed to start %r", session_id, command)
+        batcher.write(msg)
+        batcher.close()
+        job.done()
+        socketio.emit('process_stopped', {'session_id': session_id})
+        socketio.emit('process_status', {'running': False, 'session_id': session_id})
+        buffer_writer.flush(session_id)
+
+def report_queue_position(session_id, position):
+    with process_lock:
+        proc_info = running_processes.get(session_id)
+    running = proc_info is not None and proc_info['proc'] is not None
+    socketio.emit('process_status', {'running': running, 'queued': True, 'position': position, 'session_id': session_id},
+                  to=session_id)
+
+command_scheduler = CommandScheduler(max_running=MAX_RUNNING_COMMANDS, max_cpu_percent=ADMISSION_MAX_CPU,
+                                     min_available_memory=ADMISSION_MIN_MEMORY_MB << 20,
+                                     on_queued=report_queue_position)
+
+def running_session_pids():
+    with process_lock:
+        sessions = list(running_processes.items())
+    return {session_id: proc_info['proc'].pid for session_id, proc_info in sessions if proc_info['proc'] is not None}
+
+def send_process_metrics(session_id, metrics):
+    metrics['session_id'] = session_id
+    socketio.emit('process_metrics', metrics, to=session_id)
+
+resource_sampler = ResourceSampler(running_session_pids, send_process_metrics, interval=PROCESS_METRICS_INTERVAL)
+if PROCESS_METRICS_INTERVAL > 0:
+    resource_sampler.start()
+
+# --- Idle session eviction ---
+def session_busy(session_id, proc_info):
+    """A session with a command running or waiting, or a live shell, must stay in memory"""
+    shell = proc_info.get('shell')
+    return (proc_info['proc'] is not None or (shell is not None and shell.alive)
+            or command_scheduler.has_work(session_id))
+
+def session_activity():
+    with process_lock:
+        sessions = list(running_processes.items())
+    return [(session_id, proc_info['last_active'], proc_info['output_buffer'].size + proc_info['replay'].size,
+             session_busy(session_id, proc_info)) for session_id, proc_info in sessions]
+
+def evict_session(session_id, last_active):
+    """Drop an idle session from memory; get_session() reloads it from the database"""
+    with process_lock:
+        proc_info = running_processes.get(session_id)
+        if proc_info is None or proc_info['last_active'] != last_active or session_busy(session_id, proc_info):
+            return False
+        del running_processes[session_id]
+        if search_index is not None:
+            search_index.end_session(session_id)
+    # A reload that starts meanwhile waits in OutputArchive.session() for this flush
+    if output_archive is not None:
+        output_archive.close(session_id)
+    buffer_writer.flush(session_id)
+    OUTPUT_BYTES.remove(session_id)
+    OUTPUT_LINES.remove(session_id)
+    proc_info['output_buffer'].clear()
+    return True
+
+session_evictor = SessionEvictor(session_activity, evict_session, idle_timeout=SESSION_IDLE_TIMEOUT,
+                                 max_bytes=SESSION_MEMORY_BYTES)
+if SESSION_IDLE_TIMEOUT > 0 or SESSION_MEMORY_BYTES > 0:
+    session_evictor.start()
+
+
+def delete_archives(session_ids):
+    """Remove the output archives of sessions whose stored buffers expired"""
+    with process_lock:
+        idle = [session_id for session_id in session_ids if session_id not in running_processes]
+    for session_id in idle:
+        output_archive.delete(session_id)
+
+if SESSION_BUFFER_TTL > 0:
+    buffer_writer.start_expiry(SESSION_BUFFER_TTL, on_expired=delete_archives if output_archive is not None else None)
+
+# --- Metrics read at scrape time ---
+metrics_registry.gauge('terminal_active_sessions', 'Sessions held in memory', lambda: len(running_processes))
+metrics_registry.gauge('terminal_running_commands', 'Commands running on this worker', lambda: command_scheduler.running)
+metrics_registry.gauge('terminal_queued_commands', 'Commands waiting for admission', lambda: command_scheduler.waiting)
+metrics_registry.counter_func('terminal_evicted_sessions_total', 'Idle sessions dropped from memory',
+                              lambda: session_evictor.evicted)
+metrics_registry.counter_func('terminal_expired_buffers_total', 'Abandoned session buffers deleted from the database',
+                              lambda: buffer_writer.expired)
+metrics_registry.gauge('terminal_lagging_subscribers', 'Clients with output queued because they are not keeping up',
+                       lambda: output_fanout.lagging)
+metrics_registry.counter_func('terminal_output_skipped_bytes_total', 'Output characters dropped for clients too far behind',
+                              lambda: output_fanout.skipped_bytes)
+metrics_registry.gauge('terminal_import_seconds', 'Seconds from process start until the application was imported',
+                       lambda: startup.import_seconds)
+metrics_registry.gauge('terminal_ready_seconds', 'Seconds from process start until every warm-up check passed',
+                       lambda: startup.ready_seconds)
+metrics_registry.gauge('terminal_first_request_seconds', 'Latency of the first request served',
+                       lambda: startup.first_request_seconds)
+metrics_registry.gauge('terminal_cache_hit_ratio', 'Query cache hit rate', lambda: db.cache.stats()['hit_rate'])
+metrics_registry.counter_func('terminal_cache_hits_total', 'Query cache hits', lambda: db.cache.hits)
+metrics_registry.counter_func('terminal_cache_misses_total', 'Query cache misses', lambda: db.cache.misses)
+if search_index is not None:
+    metrics_registry.gauge('terminal_search_index_bytes', 'Output characters in the search index', lambda: search_index.size)
+    metrics_registry.counter_func('terminal_search_skipped_bytes_total', 'Output not indexed because the indexer fell behind',
+                                  lambda: search_index.skipped_bytes)
+metrics_registry.gauge('terminal_scrollback_bytes', 'Scrollback characters held across all sessions', lambda: scrollback_budget.used)
+metrics_registry.gauge('terminal_sampler_overhead_ratio', 'Fraction of one core used by the resource sampler',
+               lambda: resource_sampler.overhead)
+
+# --- Session ownership across workers ---
+routed_handlers = {}
+
+def routed(handler):
+    """Run a session event on the worker that owns the session.
+
+    Without a message queue every session is local. Otherwise the client
+    joins the session room here, so output published by the owner reaches
+    it, and the event is forwarded to the owning worker.
+    """
+    routed_handlers[handler.__name__] = handler
+
+    @functools.wraps(handler)
+    def wrapper(data):
+        session_id = (data or {}).get('session_id')
+        if registry is None or not session_id:
+            return handler(data)
+        with process_lock:
+            owned = session_id in running_processes
+        owner = WORKER_ID if owned else db.run(registry.claim(session_id))
+        if owner == WORKER_ID:
+            return handler(data)
+        join_room(session_id)
+        socketio.emit(WORKER_EVENT, {'handler': handler.__name__, 'sid': request.sid, 'data': data, 'worker': WORKER_ID},
+                      to=worker_room(owner))
+    return wrapper
+
+def handle_worker_call(call):
+    """Run an event forwarded by another worker as if its client were connected here"""
+    if 'error' in call:
+        # A call this worker forwarded failed on the session's owner
+        logger.warning("Forwarded %s failed on worker %s: %s", call.get('handler'), call.get('owner'), call['error'])
+        socketio.emit('command_error', {'session_id': (call.get('data') or {}).get('session_id'),
+                                        'error': f"\n[Error: {call['error']}]\n"}, to=call['sid'])
+        return
+    handler = routed_handlers.get(call.get('handler'))
+    if handler is None:
+        logger.error("Forwarded call to unknown handler %r", call.get('handler'))
+        reply_worker_error(call, f"unknown event {call.get('handler')}")
+        return
+    with app.test_request_context('/'):
+        request.sid = call['sid']
+        request.namespace = '/'
+        try:
+            handler(call.get('data'))
+        except Exception as e:
+            logger.exception("Forwarded %s failed", call.get('handler'))
+            reply_worker_error(call, str(e))
+
+def reply_worker_error(call, error):
+    """Tell the worker that forwarded `call` that it failed, so it can tell the client"""
+    if call.get('worker'):
+        socketio.emit(WORKER_EVENT, {'handler': call.get('handler'), 'sid': call['sid'], 'data': call.get('data'),
+                                     'owner': WORKER_ID, 'error': error},
+                      to=worker_room(call['worker']))
+
+if SOCKETIO_MESSAGE_QUEUE:
+    client_manager.worker_room = worker_room(WORKER_ID)
+    client_manager.on_call = handle_worker_call
+
 # --- SocketIO handlers ---
 @socketio.on('reconnect_session')
+@routed
 def handle_reconnect_session(data):
-    print('[SocketIO] Event: reconnect_session', data, flush=True)
+    logger.debug("reconnect_session: %s", data)
     session_id = data.get('session_id')
     if not session_id:
         emit('output', {'output': '\n[Error: No session_id provided]\n'})
         return
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    output_buffer, cwd = loop.run_until_complete(db_load_session_buffer(session_id))
-    with process_lock:
-        running_processes[session_id] = {'proc': None, 'cwd': cwd, 'output_buffer': output_buffer}
-        proc_info = running_processes[session_id]
-    if not output_buffer or len(output_buffer) == 0:
-        prompt = f"\n{proc_info['cwd']}\n$ "
-        emit('command_output', {'output': prompt, 'session_id': session_id})
-    for entry in output_buffer:
-        if isinstance(entry, dict):
-            prompt = f"\n{entry['cwd']}\n$ {entry['command']}\n" if entry['command'] else ''
-            if prompt:
-                emit('command_output', {'output': prompt, 'session_id': session_id})
-            if entry['output']:
-                emit('command_output', {'output': entry['output'], 'session_id': session_id})
-        else:
-            emit('command_output', {'output': entry, 'session_id': session_id})
+    proc_info = get_session(session_id)
+    join_room(session_id)
+    resync_client(session_id, proc_info, data.get('epoch'), data.get('last_seq'))
     emit('session_state', {'cwd': proc_info['cwd'], 'session_id': session_id})
     running = proc_info['proc'] is not None and proc_info['proc'].poll() is None
-    emit('process_status', {'running': running, 'session_id': session_id})
+    position = command_scheduler.position(session_id)
+    if position is not None:
+        emit('process_status', {'running': running, 'queued': True, 'position': position, 'session_id': session_id})
+    else:
+        emit('process_status', {'running': running, 'session_id': session_id})
 
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -197,13 +585,10 @@ def terminal():
         return redirect(url_for('login'))
     return render_template('terminal.html')
 
-def strip_ansi_codes(text):
-    ansi_escape = re.compile(r'\x1B\[[0-9;?]*[ -/]*[@-~]')
-    return ansi_escape.sub('', text)
-
 @socketio.on('run_command')
+@routed
 def handle_run_command(data):
-    print('[SocketIO] Event: run_command', data, flush=True)
+    logger.debug("run_command: %s", data)
     session_id = data.get('session_id')
     if not session_id:
         emit('output', {'output': '\n[Error: No session_id provided]\n'})
@@ -212,30 +597,22 @@ def handle_run_command(data):
     if not command:
         emit('output', {'output': '\nNo command provided.', 'session_id': session_id})
         return
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    with process_lock:
-        if session_id not in running_processes:
-            output_buffer, cwd = loop.run_until_complete(db_load_session_buffer(session_id))
-            running_processes[session_id] = {'proc': None, 'cwd': cwd, 'output_buffer': output_buffer}
-        proc_info = running_processes[session_id]
-        if 'output_buffer' not in proc_info:
-            proc_info['output_buffer'] = deque(maxlen=OUTPUT_BUFFER_SIZE)
-        if not proc_info['output_buffer'] or len(proc_info['output_buffer']) == 0:
-            emit('clear_output', {'session_id': session_id})
-    if command.strip() in ['cls', 'clear']:
-        print('[Terminal] Handling clear/cls command', flush=True)
-        proc_info['output_buffer'] = deque(maxlen=OUTPUT_BUFFER_SIZE)
-        loop.run_until_complete(db_clear_session_buffer(session_id, proc_info['cwd']))
-        proc_info['output_buffer'], _ = loop.run_until_complete(db_load_session_buffer(session_id))
-        print(f'[Terminal] Buffer after clear: {list(proc_info["output_buffer"])}', flush=True)
+    proc_info = get_session(session_id)
+    join_room(session_id)
+    if len(proc_info['output_buffer']) == 0:
         emit('clear_output', {'session_id': session_id})
-        prompt = f"\n{proc_info['cwd']}\n$ "
-        emit('command_output', {'output': prompt, 'session_id': session_id})
+    if command.strip() in ['cls', 'clear']:
+        logger.info("%s: clearing output", session_id)
+        with proc_info['replay'].lock:
+            proc_info['output_buffer'].clear()
+            buffer_writer.reset(session_id, [], proc_info['cwd'])
+            proc_info['replay'].reset()
+            socketio.emit('clear_output', {'session_id': session_id}, to=session_id)
+            send_frame(session_id, proc_info, f"\n{proc_info['cwd']}\n$ ")
         socketio.emit('process_stopped', {'session_id': session_id})
         return
-    if command.strip().startswith('cd '):
-        print('[Terminal] Handling cd command:', command, flush=True)
+    if command.strip().startswith('cd ') and not proc_info['persistent_shell']:
+        logger.info("%s: handling %r", session_id, command)
         parts = command.strip().split(maxsplit=1)
         if len(parts) == 2:
             new_dir = parts[1].strip('"')
@@ -243,79 +620,79 @@ def handle_run_command(data):
                 new_path = os.path.abspath(os.path.join(proc_info['cwd'], new_dir))
                 if os.path.isdir(new_path):
                     proc_info['cwd'] = new_path
-                    msg = f''
-                    proc_info['output_buffer'].append({'cwd': proc_info['cwd'], 'command': command, 'output': msg})
-                    emit('command_output', {'output': f"\n{proc_info['cwd']}\n$ {command}\n", 'session_id': session_id})
-                    emit('command_output', {'output': msg, 'session_id': session_id})
+                    buffer_writer.set_cwd(session_id, new_path)
+                    start_command(session_id, proc_info, command)
                 else:
                     msg = f'No such directory: {new_dir}\n'
-                    proc_info['output_buffer'].append({'cwd': proc_info['cwd'], 'command': command, 'output': msg})
-                    emit('command_output', {'output': f"\n{proc_info['cwd']}\n$ {command}\n", 'session_id': session_id})
-                    emit('command_output', {'output': msg, 'session_id': session_id})
+                    start_command(session_id, proc_info, command, msg)
             except Exception as e:
                 msg = f'Error changing directory: {e}\n'
-                proc_info['output_buffer'].append({'cwd': proc_info['cwd'], 'command': command, 'output': msg})
-                emit('command_output', {'output': f"\n{proc_info['cwd']}\n$ {command}\n", 'session_id': session_id})
-                emit('command_output', {'output': msg, 'session_id': session_id})
+                start_command(session_id, proc_info, command, msg)
         else:
             msg = 'Usage: cd <directory>\n'
-            proc_info['output_buffer'].append({'cwd': proc_info['cwd'], 'command': command, 'output': msg})
-            emit('command_output', {'output': f"\n{proc_info['cwd']}\n$ {command}\n", 'session_id': session_id})
-            emit('command_output', {'output': msg, 'session_id': session_id})
-        loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
+            start_command(session_id, proc_info, command, msg)
+        buffer_writer.flush(session_id)
         socketio.emit('process_stopped', {'session_id': session_id})
         return
     else:
-        print('[Terminal] Running command:', command, 'in', proc_info['cwd'], flush=True)
-        kill_running_process(session_id)
-        entry = {'cwd': proc_info['cwd'], 'command': command, 'output': ''}
-        proc_info['output_buffer'].append(entry)
-        prompt = f"\n{entry['cwd']}\n$ {entry['command']}\n"
-        emit('command_output', {'output': prompt, 'session_id': session_id})
-        loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
-        try:
-            import subprocess
-            if os.name == 'nt':
-                proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=proc_info['cwd'], creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, bufsize=1, universal_newlines=True)
-            else:
-                proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=proc_info['cwd'], preexec_fn=os.setsid, bufsize=1, universal_newlines=True)
-            with process_lock:
-                running_processes[session_id]['proc'] = proc
-            socketio.emit('process_status', {'running': True, 'session_id': session_id})
-            for line in proc.stdout:
-                line = strip_ansi_codes(line)
-                print('[Terminal] Output:', line.strip(), flush=True)
-                entry['output'] += line
-                emit('command_output', {'output': line, 'session_id': session_id})
-                loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
-            proc.wait()
-            loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
-        except Exception as e:
-            msg = f'Error: {e}\n'
-            print('[Terminal] Exception:', e, flush=True)
-            entry['output'] += msg
-            emit('command_output', {'output': msg, 'session_id': session_id})
-            loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
-        finally:
-            with process_lock:
-                running_processes[session_id]['proc'] = None
-            socketio.emit('process_stopped', {'session_id': session_id})
-            socketio.emit('process_status', {'running': False, 'session_id': session_id})
-            loop.run_until_complete(db_save_session_buffer(session_id, proc_info['output_buffer'], proc_info['cwd']))
+        if data.get('queue', proc_info['queue_commands']):
+            logger.info("%s: queueing %r", session_id, command)
+        else:
+            command_scheduler.cancel(session_id)
+            kill_running_process(session_id)
+        command_scheduler.submit(session_id, lambda job: start_job(session_id, proc_info, command, job))
 
 @socketio.on('stop_command')
+@routed
 def handle_stop_command(data):
     session_id = data.get('session_id')
     if not session_id:
         return
+    command_scheduler.cancel(session_id)
     kill_running_process(session_id)
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(db_delete_session_buffer(session_id))
-    socketio.emit('command_output', {'output': '\n[Process stopped]\n', 'session_id': session_id})
+    db.run(db_delete_session_buffer(session_id))
+    OUTPUT_BYTES.remove(session_id)
+    OUTPUT_LINES.remove(session_id)
+    with process_lock:
+        proc_info = running_processes.get(session_id)
+    if proc_info is not None:
+        close_shell(proc_info)
+        # The session stays in memory with its options, so store them again
+        buffer_writer.set_options(session_id, {key: proc_info[key] for key in SESSION_OPTIONS})
+        with proc_info['replay'].lock:
+            send_frame(session_id, proc_info, '\n[Process stopped]\n')
+            # The stored history goes with the buffer; later output starts a new archive
+            if output_archive is not None:
+                output_archive.delete(session_id)
+    else:
+        if output_archive is not None:
+            output_archive.delete(session_id)
+        socketio.emit('command_output', {'output': '\n[Process stopped]\n', 'session_id': session_id})
     socketio.emit('process_stopped', {'session_id': session_id})
     socketio.emit('process_status', {'running': False, 'session_id': session_id})
 
+@socketio.on('session_options')
+@routed
+def handle_session_options(data):
+    session_id = data.get('session_id')
+    if not session_id:
+        return
+    proc_info = get_session(session_id)
+    if 'strip_ansi' in data:
+        # Applies from the next command on
+        proc_info['strip_ansi'] = bool(data['strip_ansi'])
+    if 'persistent_shell' in data:
+        proc_info['persistent_shell'] = os.name != 'nt' and bool(data['persistent_shell'])
+        if not proc_info['persistent_shell']:
+            close_shell(proc_info)
+    if 'queue_commands' in data:
+        proc_info['queue_commands'] = bool(data['queue_commands'])
+    # Stored with the buffer so they survive eviction
+    buffer_writer.set_options(session_id, {key: proc_info[key] for key in SESSION_OPTIONS})
+    emit('session_options', {'session_id': session_id, 'strip_ansi': proc_info['strip_ansi'],
+                             'persistent_shell': proc_info['persistent_shell'],
+                             'queue_commands': proc_info['queue_commands']})
+
 @socketio.on('send_command')
 def handle_send_command(data):
     handle_run_command(data)
@@ -326,7 +703,7 @@ def get_user_key():
 @app.route('/api/terminal_state', methods=['GET'])
 def api_get_terminal_state():
     user_key = get_user_key()
-    state = asyncio.run(db.get("terminal_states", {"user_key": user_key}))
+    state = db.run(db.get("terminal_states", {"user_key": user_key}))
     return jsonify(state or {})
 
 @app.route('/api/terminal_state', methods=['POST'])
@@ -334,15 +711,109 @@ def api_set_terminal_state():
     user_key = get_user_key()
     state = request.json
     state['user_key'] = user_key
-    asyncio.run(db.update("terminal_states", {"user_key": user_key}, state, upsert=True))
+    db.run(db.update("terminal_states", {"user_key": user_key}, state, upsert=True, return_document=False))
     return jsonify({"success": True})
 
+@app.route('/api/scrollback', methods=['GET'])
+def api_get_scrollback():
+    """A page of a session's archived output.
+
+    By byte range: ``offset`` and ``length`` (default: the last ``length``
+    bytes). By block: ``seq`` and ``count``, where blocks are the archive's
+    compressed units of about 64 KB numbered from the session's start.
+    Pages are trimmed to whole UTF-8 characters; ``start``/``end`` give the
+    byte range actually returned and ``next_seq`` the block to ask for next.
+    """
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Forbidden'}), 403
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'session_id is required'}), 400
+    if output_archive is None:
+        return jsonify({'error': 'Output archive is disabled'}), 404
+    if not output_archive.exists(session_id):
+        return jsonify({'error': 'Unknown session'}), 404
+    archive = output_archive.reader(session_id)
+    try:
+        if 'seq' in request.args:
+            seq, next_seq, start, data = archive.read_blocks(int(request.args['seq']),
+                                                             max(1, min(int(request.args.get('count', 1)), 16)))
+        else:
+            offset = request.args.get('offset')
+            length = max(0, min(int(request.args.get('length', 64 << 10)), SCROLLBACK_PAGE_MAX_BYTES))
+            start, data = archive.read(int(offset) if offset is not None else None, length)
+            seq = next_seq = None
+    except ValueError:
+        return jsonify({'error': 'offset, length, seq and count must be integers'}), 400
+    stats = archive.stats()
+    start, end, text = utf8_page(start, data, start + len(data) >= stats['end'])
+    return jsonify({'session_id': session_id, 'start': start, 'end': end, 'data': text,
+                    'seq': seq, 'next_seq': next_seq, 'archive': stats})
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Lines of recent output, commands and working directories containing ``q``.
+
+    Case-insensitive, newest first, optionally limited to one ``session_id``.
+    ``offset`` in a result is the line's byte offset for /api/scrollback.
+    """
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Forbidden'}), 403
+    if search_index is None:
+        return jsonify({'error': 'Search is disabled'}), 404
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+        results = search_index.search(request.args.get('q', ''), request.args.get('session_id'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results, 'index': search_index.stats()})
+
+@app.before_request
+def time_first_request():
+    if startup.first_request_seconds is None:
+        g.request_started = time.perf_counter()
+
+@app.after_request
+def record_first_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        startup.request_served(time.perf_counter() - started, request.path)
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok', 'uptime_seconds': round(startup.since_start(), 3)})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: the database connection and indexes are warm; 503 until then"""
+    status = startup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    token = request.headers.get('Authorization', '')
+    authorized = session.get('logged_in') or (
+        METRICS_TOKEN and hmac.compare_digest(token.encode(), f'Bearer {METRICS_TOKEN}'.encode()))
+    if not authorized:
+        return 'Forbidden', 403
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/logout')
 def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+# --- Startup ---
+# Connect to the database and compile templates in the background, so neither is paid by the first user
+startup.warm('database', lambda: db.run(db.warm_up(), timeout=30))
+startup.warm('templates', lambda: [app.jinja_env.get_template(name) for name in ('login.html', 'terminal.html')])
+startup.start()
+startup.imported()
+
 if __name__ == '__main__':
-    import eventlet
-    import eventlet.wsgi
-    socketio.run(app, host='0.0.0.0', port=PORT)
+    if SOCKETIO_ASYNC_MODE == 'eventlet':
+        import eventlet
+        import eventlet.wsgi
+    socketio.run(app, host='0.0.0.0', port=PORT, allow_unsafe_werkzeug=True)
@@ -0,0 +1,164 @@
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, Tuple
+
+# Latency buckets in seconds, from 50µs to 10s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def remove(self, *label_values):
+        """Forget one label combination, e.g. a closed session"""
+        with self._lock:
+            self._values.pop(label_values, None)
+
+    def collect(self) -> Iterable[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+class Histogram:
+    """Distribution of observed values in fixed cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self) -> Iterable[str]:
+        with self._lock:
+            snapshot = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(series[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackMetric:
+    """Value read from the application at scrape time.
+
+    ``fn`` returns a number, or a dict mapping label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], object], labels: Iterable[str] = (), kind: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def collect(self) -> Iterable[str]:
+        value = self.fn()
+        if isinstance(value, dict):
+            for label_values, sample in value.items():
+                yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(sample)}"
+        elif value is not None:
+            yield f"{self.name} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """Named metrics rendered together in the Prometheus text exposition format.
+
+    Recording a value takes one short lock and no allocation once a label
+    combination exists, so counters and histograms can stay on hot paths.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, fn: Callable[[], object], labels: Iterable[str] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric(name, documentation, fn, labels))
+
+    def counter_func(self, name: str, documentation: str, fn: Callable[[], object], labels: Iterable[str] = ()) -> CallbackMetric:
+        """A counter whose total is kept elsewhere and read at scrape time"""
+        return self._register(CallbackMetric(name, documentation, fn, labels, kind='counter'))
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry served by the metrics route
+registry = MetricsRegistry()
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+logger = logging.getLogger("persistence")
+
+
+def stored_entry(entry) -> dict:
+    """Convert a scrollback entry to its stored form; the writer splits `chunks` into full chunks and a tail"""
+    output = ''.join(entry.chunks) + ''.join(entry.tail)
+    return {
+        'id': entry.id,
+        'cwd': entry.cwd,
+        'command': entry.command,
+        'chunks': [output] if output else [],
+        'truncated': entry.truncated,
+    }
+
+
+class _StoredOutput:
+    """What the database holds of one entry's output"""
+
+    __slots__ = ('entry_id', 'chunks', 'tail', 'truncated')
+
+    def __init__(self, entry_id: str, chunks: int = 0, tail: str = '', truncated: int = 0):
+        self.entry_id = entry_id
+        self.chunks = chunks        # full chunks stored
+        self.tail = tail            # output after the last full chunk
+        self.truncated = truncated  # characters dropped from the start
+
+
+class _PendingBuffer:
+    """Changes to one session buffer that have not been written yet"""
+
+    def __init__(self):
+        self.reset = None       # full list of stored entries replacing the buffer
+        self.new_entries = {}   # entry id -> stored entry not yet in the database
+        self.appends = {}       # entry id -> chunks for entries already stored
+        self.cwd = None
+        self.options = None
+
+
+class SessionBufferWriter:
+    """Write-behind persistence for session output buffers.
+
+    Handlers record changes (new entries, output appended to an entry, cwd
+    changes) and the writer sends only those deltas to the database every
+    ``flush_interval`` seconds, or immediately on ``flush()``. Writes run on
+    the data access layer's event loop and are serialized, so they are
+    applied in order. Sessions are written concurrently so the DAL can group
+    their writes into a few bulk writes.
+
+    An entry's output is stored as full ``chunk_size`` chunks plus the
+    shorter ``tail`` after them, and only the last ``max_entry_bytes`` of
+    full chunks are kept; ``truncated`` counts the characters dropped, as in
+    the in-memory scrollback.
+
+    Every write stamps the buffer's ``updated_at``; ``start_expiry()``
+    periodically deletes buffers of sessions nobody has used for a while.
+    """
+
+    def __init__(self, dal, collection: str = "session_buffers", max_entries: int = 100,
+                 flush_interval: float = 1.0, chunk_size: int = 4096, max_entry_bytes: int = 512 << 10):
+        self.dal = dal
+        self.collection = collection
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.max_entry_chunks = max(1, max_entry_bytes // chunk_size)
+        self.max_tracked = 1024
+        self._lock = threading.Lock()
+        self._pending = {}
+        # session id -> _StoredOutput of the entry last written, so appends
+        # can extend its tail; anything else is read back from the database
+        self._stored = OrderedDict()
+        self._write_lock = None
+        self._periodic = None
+        self._expiry = None
+        self.expired = 0
+
+    # Recording changes
+    def start_entry(self, session_id: str, entry):
+        """Record a new buffer entry"""
+        with self._lock:
+            pending = self._pending.setdefault(session_id, _PendingBuffer())
+            pending.new_entries[entry.id] = stored_entry(entry)
+        self._ensure_started()
+
+    def append(self, session_id: str, entry, text: str):
+        """Record output appended to an entry"""
+        if not text:
+            return
+        with self._lock:
+            pending = self._pending.setdefault(session_id, _PendingBuffer())
+            new_entry = pending.new_entries.get(entry.id)
+            if new_entry is not None:
+                new_entry['chunks'].append(text)
+            else:
+                pending.appends.setdefault(entry.id, []).append(text)
+        self._ensure_started()
+
+    def set_cwd(self, session_id: str, cwd: str):
+        """Record a working directory change"""
+        with self._lock:
+            self._pending.setdefault(session_id, _PendingBuffer()).cwd = cwd
+        self._ensure_started()
+
+    def set_options(self, session_id: str, options: dict):
+        """Record the session's options, which are stored with its buffer"""
+        with self._lock:
+            self._pending.setdefault(session_id, _PendingBuffer()).options = dict(options)
+        self._ensure_started()
+
+    def touch(self, session_id: str):
+        """Record that a session is in use, so its stored buffer does not expire"""
+        with self._lock:
+            self._pending.setdefault(session_id, _PendingBuffer())
+        self._ensure_started()
+
+    def reset(self, session_id: str, entries: list, cwd: str):
+        """Replace the whole stored buffer, dropping any pending deltas"""
+        with self._lock:
+            pending = _PendingBuffer()
+            pending.reset = [stored_entry(entry) for entry in entries]
+            pending.cwd = cwd
+            previous = self._pending.get(session_id)
+            if previous is not None:
+                pending.options = previous.options
+            self._pending[session_id] = pending
+        self._ensure_started()
+
+    # Writing
+    def flush(self, session_id: Optional[str] = None, timeout: Optional[float] = 10):
+        """Write pending changes now (all sessions if session_id is None) and wait"""
+        try:
+            self.dal.run(self.write_pending(session_id), timeout)
+        except Exception as e:
+            logger.error(f"Session buffer flush failed: {e}")
+
+    def flush_soon(self, session_id: Optional[str] = None):
+        """Start writing pending changes without waiting for them"""
+        self.dal.submit(self.write_pending(session_id))
+
+    def start_expiry(self, max_age: float, interval: float = 3600,
+                     on_expired: Optional[Callable[[List[str]], None]] = None):
+        """Delete buffers not written for `max_age` seconds, every `interval` seconds.
+
+        `on_expired` is called, on a worker thread, with the session ids of
+        the buffers deleted.
+        """
+        if self._expiry is None:
+            self._expiry = self.dal.submit(self._expire_periodically(max_age, interval, on_expired))
+
+    def stop(self, timeout: Optional[float] = 10):
+        """Flush everything and stop the periodic jobs"""
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if self._periodic is None:
+            return
+        self._periodic.cancel()
+        self._periodic = None
+        self.flush(timeout=timeout)
+
+    def _ensure_started(self):
+        if self._periodic is not None:
+            return
+        with self._lock:
+            if self._periodic is None:
+                self._periodic = self.dal.submit(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.write_pending()
+            except Exception as e:
+                logger.error(f"Periodic session buffer flush failed: {e}")
+
+    async def _expire_periodically(self, max_age: float, interval: float,
+                                   on_expired: Optional[Callable[[List[str]], None]]):
+        while True:
+            try:
+                expired = await self.expire(max_age)
+                if expired:
+                    logger.info(f"Expired {len(expired)} abandoned session buffers")
+                    if on_expired is not None:
+                        await asyncio.get_running_loop().run_in_executor(None, on_expired, expired)
+            except Exception as e:
+                logger.error(f"Session buffer expiry failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def expire(self, max_age: float, limit: int = 100) -> List[str]:
+        """Delete buffers not written for `max_age` seconds, returning their session ids"""
+        now = time.time()
+        # Buffers stored before updated_at existed start their clock now
+        unstamped = await self.dal.find(self.collection, {"updated_at": None}, limit=limit)
+        await asyncio.gather(*(
+            self.dal.update(self.collection, {"session_id": doc.get("session_id")}, {"updated_at": now},
+                            return_document=False)
+            for doc in unstamped
+        ))
+        stale = {"updated_at": {"$lt": now - max_age}}
+        expired = []
+        while True:
+            found = await self.dal.find(self.collection, stale, limit=limit)
+            for doc in found:
+                session_id = doc.get("session_id")
+                # Unless it has been written since it was found
+                if await self.dal.delete_many(self.collection, {"session_id": session_id, **stale}):
+                    expired.append(session_id)
+            if len(found) < limit:
+                break
+        self.expired += len(expired)
+        return expired
+
+    async def write_pending(self, session_id: Optional[str] = None):
+        """Write pending changes (all sessions if session_id is None)"""
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            with self._lock:
+                if session_id is None:
+                    batch, self._pending = self._pending, {}
+                else:
+                    pending = self._pending.pop(session_id, None)
+                    batch = {session_id: pending} if pending else {}
+            await asyncio.gather(*(self._write_logged(sid, pending) for sid, pending in batch.items()))
+
+    async def drop_pending(self, session_id: str):
+        """Drop pending changes for a session"""
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            with self._lock:
+                self._pending.pop(session_id, None)
+            self._stored.pop(session_id, None)
+
+    async def _write_logged(self, session_id: str, pending: _PendingBuffer):
+        try:
+            await self._write(session_id, pending)
+        except Exception as e:
+            logger.error(f"Failed to persist buffer for session {session_id}: {e}")
+
+    async def _write(self, session_id: str, pending: _PendingBuffer):
+        # Each write is awaited before the next so a session's changes land in order
+        query = {"session_id": session_id}
+        if pending.reset is not None:
+            self._stored.pop(session_id, None)
+            fields = {
+                "session_id": session_id,
+                "output_buffer": [self._store(session_id, entry) for entry in pending.reset[-self.max_entries:]],
+                "cwd": pending.cwd,
+                "updated_at": time.time()
+            }
+        else:
+            fields = {"updated_at": time.time()}
+            if pending.cwd is not None:
+                fields["cwd"] = pending.cwd
+        if pending.options is not None:
+            fields["options"] = pending.options
+        await self.dal.update(self.collection, query, fields, upsert=True, return_document=False)
+        for entry_id, pieces in pending.appends.items():
+            stored = await self._stored_output(session_id, entry_id)
+            await self.dal.push_to_array(
+                self.collection, query, "output_buffer.$[e].chunks", self._seal(stored, pieces),
+                slice=-self.max_entry_chunks, array_filters=[{"e.id": entry_id}],
+                fields={"output_buffer.$[e].tail": stored.tail, "output_buffer.$[e].truncated": stored.truncated}
+            )
+        if pending.new_entries:
+            entries = [self._store(session_id, entry) for entry in pending.new_entries.values()]
+            await self.dal.push_to_array(
+                self.collection, query, "output_buffer", entries[-self.max_entries:],
+                slice=-self.max_entries, upsert=True
+            )
+
+    def _store(self, session_id: str, entry: dict) -> dict:
+        """Split a new entry's output into full chunks and a tail, and remember it as the session's latest"""
+        stored = _StoredOutput(entry['id'], truncated=entry.get('truncated', 0))
+        entry['chunks'] = self._seal(stored, entry['chunks'])[-self.max_entry_chunks:]
+        entry['tail'] = stored.tail
+        entry['truncated'] = stored.truncated
+        self._remember(session_id, stored)
+        return entry
+
+    def _seal(self, stored: _StoredOutput, pieces: list) -> list:
+        """Add output after an entry's tail, returning the full chunks to store (oldest first)"""
+        text = stored.tail + ''.join(pieces)
+        full = len(text) - len(text) % self.chunk_size
+        chunks = [text[i:i + self.chunk_size] for i in range(0, full, self.chunk_size)]
+        stored.tail = text[full:]
+        stored.chunks += len(chunks)
+        if stored.chunks > self.max_entry_chunks:
+            # The chunks $slice drops from the start
+            stored.truncated += (stored.chunks - self.max_entry_chunks) * self.chunk_size
+            stored.chunks = self.max_entry_chunks
+        return chunks
+
+    async def _stored_output(self, session_id: str, entry_id: str) -> _StoredOutput:
+        stored = self._stored.get(session_id)
+        if stored is None or stored.entry_id != entry_id:
+            # Not written by this writer lately: read what the database holds
+            stored = _StoredOutput(entry_id)
+            doc = await self.dal.get(self.collection, {"session_id": session_id}, use_cache=False)
+            for item in (doc or {}).get('output_buffer', []):
+                if isinstance(item, dict) and item.get('id') == entry_id:
+                    stored = _StoredOutput(entry_id, len(item.get('chunks', [])), item.get('tail', ''),
+                                           item.get('truncated', 0))
+            self._remember(session_id, stored)
+        return stored
+
+    def _remember(self, session_id: str, stored: _StoredOutput):
+        self._stored.pop(session_id, None)
+        self._stored[session_id] = stored
+        while len(self._stored) > self.max_tracked:
+            self._stored.popitem(last=False)
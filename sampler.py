@@ -0,0 +1,201 @@
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import psutil
+
+logger = logging.getLogger("sampler")
+
+
+class _SessionTotals:
+    __slots__ = ('cpu', 'rss', 'read_bytes', 'write_bytes', 'threads', 'procs')
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.threads = 0
+        self.procs = 0
+
+
+class ResourceSampler:
+    """Periodic CPU, memory, I/O and thread sampling of every running session.
+
+    One background thread samples all sessions per pass: it reads the
+    process table once (straight from /proc on Linux, through psutil
+    elsewhere), walks each session's process tree (the root process and all
+    its descendants) from it, and reports per session through
+    ``on_sample(session_id, metrics)``. ``sources()`` returns the root pid of
+    each session with a running command.
+
+    CPU and I/O figures are rates over the time since the previous pass.
+    The sampler measures its own CPU time and lengthens the interval when
+    needed to stay under ``max_overhead`` of one core.
+    """
+
+    def __init__(self, sources: Callable[[], Dict[str, int]], on_sample: Callable[[str, dict], None],
+                 interval: float = 2.0, max_overhead: float = 0.01):
+        self.sources = sources
+        self.on_sample = on_sample
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.passes = 0
+        self.cpu_time = 0.0       # CPU seconds spent sampling
+        self.last_pass_cpu = 0.0
+        self._started_at = None
+        self._previous = {}       # pid -> (cpu seconds, read bytes, write bytes)
+        self._procs = {}          # pid -> psutil.Process, for I/O counters without /proc
+        self._last_pass = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def overhead(self) -> float:
+        """Fraction of one core used by the sampler since it started"""
+        if self._started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started_at
+        return self.cpu_time / elapsed if elapsed > 0 else 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            began = time.thread_time()
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Resource sampling failed: {e}")
+            self.last_pass_cpu = time.thread_time() - began
+            self.cpu_time += self.last_pass_cpu
+            self.passes += 1
+            # Back off so a pass never costs more than max_overhead of the interval
+            self._stop.wait(max(self.interval, self.last_pass_cpu / self.max_overhead))
+
+    def sample(self):
+        """Run one pass over all sessions now"""
+        roots = self.sources()
+        now = time.monotonic()
+        elapsed = now - self._last_pass if self._last_pass is not None else None
+        self._last_pass = now
+        if not roots:
+            self._previous.clear()
+            self._procs.clear()
+            return
+        table = _process_table()
+        children = {}
+        for pid, row in table.items():
+            children.setdefault(row[0], []).append(pid)
+        seen = set()
+        for session_id, root in roots.items():
+            totals = _SessionTotals()
+            stack = [root]
+            while stack:
+                pid = stack.pop()
+                if pid in seen or pid not in table:
+                    continue
+                seen.add(pid)
+                stack.extend(children.get(pid, ()))
+                self._add_process(pid, table[pid], totals, elapsed)
+            metrics = {
+                'cpu': round(totals.cpu, 1),
+                'rss': totals.rss,
+                'read_bps': int(totals.read_bytes),
+                'write_bps': int(totals.write_bytes),
+                'threads': totals.threads,
+                'procs': totals.procs,
+            }
+            try:
+                self.on_sample(session_id, metrics)
+            except Exception as e:
+                logger.error(f"Metrics callback failed for session {session_id}: {e}")
+        for pid in list(self._previous):
+            if pid not in seen:
+                del self._previous[pid]
+                self._procs.pop(pid, None)
+
+    def _add_process(self, pid: int, row: tuple, totals: _SessionTotals, elapsed: Optional[float]):
+        _, cpu, rss, threads = row
+        read_bytes, write_bytes = self._io_counters(pid)
+        previous = self._previous.get(pid)
+        self._previous[pid] = (cpu, read_bytes, write_bytes)
+        totals.rss += rss
+        totals.threads += threads
+        totals.procs += 1
+        if previous is not None and elapsed:
+            totals.cpu += max(0.0, cpu - previous[0]) / elapsed * 100
+            totals.read_bytes += max(0, read_bytes - previous[1]) / elapsed
+            totals.write_bytes += max(0, write_bytes - previous[2]) / elapsed
+
+    def _io_counters(self, pid: int) -> tuple:
+        if _PROC_FS:
+            try:
+                with open(f"/proc/{pid}/io", 'rb') as f:
+                    fields = dict(line.split(b': ') for line in f.read().splitlines())
+                return int(fields[b'read_bytes']), int(fields[b'write_bytes'])
+            except (OSError, KeyError, ValueError):
+                return 0, 0
+        try:
+            proc = self._procs.get(pid)
+            if proc is None:
+                proc = self._procs[pid] = psutil.Process(pid)
+            io = proc.io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.Error):
+            return 0, 0
+
+
+def _process_table() -> dict:
+    """pid -> (ppid, cpu seconds, rss bytes, threads) for every process"""
+    if _PROC_FS:
+        return _proc_fs_table()
+    table = {}
+    for proc in psutil.process_iter(['ppid', 'cpu_times', 'memory_info', 'num_threads']):
+        info = proc.info
+        if info['cpu_times'] is None or info['memory_info'] is None:
+            continue
+        table[proc.pid] = (info['ppid'] or 0, info['cpu_times'].user + info['cpu_times'].system,
+                           info['memory_info'].rss, info['num_threads'] or 0)
+    return table
+
+
+def _proc_fs_table() -> dict:
+    # One read of /proc/<pid>/stat per process has everything but I/O, which
+    # is several times cheaper than going through psutil for each field
+    table = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces and parentheses
+        fields = stat[stat.rfind(b')') + 2:].split()
+        try:
+            table[int(name)] = (
+                int(fields[1]),
+                (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS,
+                int(fields[21]) * _PAGE_SIZE,
+                int(fields[17]),
+            )
+        except (IndexError, ValueError):
+            continue
+    return table
+
+
+_PROC_FS = sys.platform.startswith('linux') and os.path.isdir('/proc')
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if _PROC_FS else 100
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if _PROC_FS else 4096
@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import psutil
+
+logger = logging.getLogger("scheduler")
+
+
+class Job:
+    """A command waiting for, or holding, a run slot"""
+
+    __slots__ = ('session_id', 'start', 'scheduler', 'submitted', 'started', 'finished')
+
+    def __init__(self, scheduler: "CommandScheduler", session_id: str, start: Callable[["Job"], None]):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.start = start
+        self.submitted = time.monotonic()
+        self.started = False
+        self.finished = False
+
+    def done(self):
+        """Give the slot back once the command has exited; safe to call twice"""
+        self.scheduler._finish(self)
+
+
+class CommandScheduler:
+    """Admission control in front of process spawning.
+
+    Each session runs one command at a time and the rest of its commands
+    wait in FIFO order. Across sessions at most ``max_running`` commands run
+    at once, and a new one is only admitted while system CPU use is below
+    ``max_cpu_percent`` and at least ``min_available_memory`` bytes are free;
+    when nothing is running the next command is always admitted. Waiting
+    commands are started in submission order by a background thread, and
+    ``on_queued(session_id, position)`` is called whenever a session's place
+    in the global queue changes.
+    """
+
+    def __init__(self, max_running: Optional[int] = None, max_cpu_percent: float = 90.0,
+                 min_available_memory: int = 256 << 20, poll_interval: float = 0.25,
+                 on_queued: Optional[Callable[[str, int], None]] = None):
+        self.max_running = max_running or os.cpu_count() or 1
+        self.max_cpu_percent = max_cpu_percent
+        self.min_available_memory = min_available_memory
+        self.poll_interval = poll_interval
+        self.on_queued = on_queued
+        self._cond = threading.Condition()
+        self._waiting = []   # jobs in submission order
+        self._running = {}   # session_id -> job
+        self._positions = {}  # session_id -> last reported position
+        self._thread = None
+        psutil.cpu_percent(None)  # prime the system-wide sample
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def submit(self, session_id: str, start: Callable[[Job], None]) -> Job:
+        """Queue a command; `start(job)` spawns it and the caller must call `job.done()` when it exits"""
+        job = Job(self, session_id, start)
+        with self._cond:
+            self._waiting.append(job)
+            admitted = self._admit_locked()
+            self._ensure_started()
+        # Start what can run right away on the caller's thread, for the lowest latency
+        self._start(admitted)
+        self._report()
+        return job
+
+    def cancel(self, session_id: str) -> int:
+        """Drop a session's waiting commands, returning how many were dropped"""
+        with self._cond:
+            before = len(self._waiting)
+            self._waiting = [job for job in self._waiting if job.session_id != session_id]
+            dropped = before - len(self._waiting)
+            self._positions.pop(session_id, None)
+            self._cond.notify()
+        if dropped:
+            self._report()
+        return dropped
+
+    def position(self, session_id: str) -> Optional[int]:
+        """1-based place of a session's next command in the global queue, or None"""
+        with self._cond:
+            for index, job in enumerate(self._waiting):
+                if job.session_id == session_id:
+                    return index + 1
+        return None
+
+    def has_work(self, session_id: str) -> bool:
+        """Whether a session has a command running or waiting"""
+        with self._cond:
+            return session_id in self._running or any(job.session_id == session_id for job in self._waiting)
+
+    def _finish(self, job: Job):
+        with self._cond:
+            if job.finished:
+                return
+            job.finished = True
+            if self._running.get(job.session_id) is job:
+                del self._running[job.session_id]
+            self._cond.notify()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="command-scheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                admitted = self._admit_locked()
+                if not admitted:
+                    # Resource limits can clear without any event, so poll while jobs wait
+                    self._cond.wait(self.poll_interval if self._waiting else None)
+            self._start(admitted)
+            self._report()
+
+    def _admit_locked(self) -> list:
+        admitted = []
+        if not self._waiting or len(self._running) >= self.max_running:
+            return admitted
+        resources_ok = None
+        for job in list(self._waiting):
+            if len(self._running) >= self.max_running:
+                break
+            if job.session_id in self._running:
+                continue
+            if self._running:
+                if resources_ok is None:
+                    resources_ok = self._resources_ok()
+                if not resources_ok:
+                    break
+            self._waiting.remove(job)
+            self._running[job.session_id] = job
+            self._positions.pop(job.session_id, None)
+            job.started = True
+            admitted.append(job)
+        return admitted
+
+    def _resources_ok(self) -> bool:
+        try:
+            if psutil.cpu_percent(None) >= self.max_cpu_percent:
+                return False
+            return psutil.virtual_memory().available >= self.min_available_memory
+        except Exception as e:
+            logger.error(f"Resource sampling failed: {e}")
+            return True
+
+    def _start(self, jobs: list):
+        for job in jobs:
+            try:
+                job.start(job)
+            except Exception as e:
+                logger.error(f"Failed to start command for session {job.session_id}: {e}")
+                job.done()
+
+    def _report(self):
+        if self.on_queued is None:
+            return
+        changed = []
+        with self._cond:
+            seen = set()
+            for index, job in enumerate(self._waiting):
+                if job.session_id in seen:
+                    continue
+                seen.add(job.session_id)
+                if self._positions.get(job.session_id) != index + 1:
+                    self._positions[job.session_id] = index + 1
+                    changed.append((job.session_id, index + 1))
+        for session_id, position in changed:
+            try:
+                self.on_queued(session_id, position)
+            except Exception as e:
+                logger.error(f"Queue position callback failed: {e}")
@@ -0,0 +1,252 @@
+import threading
+import uuid
+import weakref
+from collections import deque
+from typing import Iterator, Optional
+
+TRUNCATION_MARKER = "[... {} bytes of earlier output truncated ...]\n"
+
+
+class ScrollbackEntry:
+    """Output of one command, stored as fixed-size chunks"""
+
+    __slots__ = ('id', 'cwd', 'command', 'chunks', 'tail', 'tail_size', 'size', 'truncated')
+
+    def __init__(self, cwd: str, command: str, entry_id: Optional[str] = None):
+        self.id = entry_id or uuid.uuid4().hex
+        self.cwd = cwd
+        self.command = command
+        self.chunks = deque()  # sealed chunks of `chunk_size` characters
+        self.tail = []         # pieces of the chunk currently being filled
+        self.tail_size = 0
+        self.size = 0
+        self.truncated = 0     # characters dropped from the start of the output
+
+    @property
+    def output(self) -> str:
+        text = ''.join(self.chunks) + ''.join(self.tail)
+        if self.truncated:
+            return TRUNCATION_MARKER.format(self.truncated) + text
+        return text
+
+    def _append(self, text: str, chunk_size: int):
+        self.tail.append(text)
+        self.tail_size += len(text)
+        self.size += len(text)
+        if self.tail_size >= chunk_size:
+            self._seal(chunk_size)
+
+    def _seal(self, chunk_size: int):
+        pending = ''.join(self.tail)
+        full = len(pending) - len(pending) % chunk_size
+        for start in range(0, full, chunk_size):
+            self.chunks.append(pending[start:start + chunk_size])
+        rest = pending[full:]
+        self.tail = [rest] if rest else []
+        self.tail_size = len(rest)
+
+    def _drop_oldest(self, amount: int, chunk_size: int) -> int:
+        """Drop at least `amount` characters from the start, whole chunks at a time"""
+        self._seal(chunk_size)
+        freed = 0
+        while freed < amount and self.chunks:
+            freed += len(self.chunks.popleft())
+        if freed < amount and self.tail:
+            freed += self.tail_size
+            self.tail = []
+            self.tail_size = 0
+        self.size -= freed
+        self.truncated += freed
+        return freed
+
+
+class ScrollbackBudget:
+    """Global character budget shared by every session's scrollback.
+
+    When the total goes over ``max_bytes`` the largest scrollbacks give up
+    their oldest output until usage is back under ``low_water`` of the cap.
+    """
+
+    def __init__(self, max_bytes: int, low_water: float = 0.9):
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.used = 0
+        self._lock = threading.RLock()
+        self._members = weakref.WeakSet()
+
+    def register(self, scrollback: "Scrollback"):
+        with self._lock:
+            self._members.add(scrollback)
+
+    def charge(self, amount: int):
+        with self._lock:
+            self.used += amount
+            if self.used <= self.max_bytes:
+                return
+            excess = self.used - int(self.max_bytes * self.low_water)
+            members = sorted(self._members, key=lambda sb: sb.size, reverse=True)
+        for scrollback in members:
+            if excess <= 0:
+                break
+            excess -= scrollback.trim(excess)
+
+    def release(self, amount: int):
+        with self._lock:
+            self.used -= amount
+
+
+class Scrollback:
+    """Byte-capped output history for one session.
+
+    Holds at most ``max_entries`` commands and ``max_bytes`` characters of
+    output. The oldest commands are evicted first; a single command larger
+    than ``max_entry_bytes`` keeps only its most recent output behind a
+    truncation marker. Sizes are counted in characters, which equals bytes
+    for ASCII output.
+    """
+
+    def __init__(self, max_entries: int = 100, max_bytes: int = 1 << 20, max_entry_bytes: int = 512 << 10,
+                 chunk_size: int = 4096, budget: Optional[ScrollbackBudget] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.size = 0
+        self._entries = deque()
+        self._lock = threading.Lock()
+        if budget is not None:
+            budget.register(self)
+
+    def __del__(self):
+        if self.budget is not None and self.size:
+            self.budget.release(self.size)
+
+    def __iter__(self) -> Iterator[ScrollbackEntry]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def start_entry(self, cwd: str, command: str, output: str = '', entry_id: Optional[str] = None,
+                    truncated: int = 0) -> ScrollbackEntry:
+        """Begin a new command entry, evicting the oldest one if full; `truncated` counts output already dropped"""
+        entry = ScrollbackEntry(cwd, command, entry_id)
+        entry.truncated = truncated
+        freed = 0
+        with self._lock:
+            self._entries.append(entry)
+            while len(self._entries) > self.max_entries:
+                freed += self._evict_oldest()
+        self._settle(-freed)
+        if output:
+            self.append(entry, output)
+        return entry
+
+    def append(self, entry: ScrollbackEntry, text: str):
+        """Append output to an entry, enforcing the entry and session caps"""
+        if not text:
+            return
+        freed = 0
+        with self._lock:
+            entry._append(text, self.chunk_size)
+            self.size += len(text)
+            if entry.size > self.max_entry_bytes:
+                dropped = entry._drop_oldest(entry.size - self.max_entry_bytes, self.chunk_size)
+                self.size -= dropped
+                freed += dropped
+            freed += self._trim_locked(self.size - self.max_bytes)
+        self._settle(len(text) - freed)
+
+    def trim(self, amount: int) -> int:
+        """Free at least `amount` characters of the oldest output"""
+        with self._lock:
+            freed = self._trim_locked(amount)
+        if freed and self.budget is not None:
+            self.budget.release(freed)
+        return freed
+
+    def clear(self):
+        with self._lock:
+            freed = self.size
+            self._entries.clear()
+            self.size = 0
+        self._settle(-freed)
+
+    def _trim_locked(self, amount: int) -> int:
+        freed = 0
+        while freed < amount and len(self._entries) > 1:
+            freed += self._evict_oldest()
+        if freed < amount and self._entries:
+            dropped = self._entries[0]._drop_oldest(amount - freed, self.chunk_size)
+            self.size -= dropped
+            freed += dropped
+        return freed
+
+    def _evict_oldest(self) -> int:
+        entry = self._entries.popleft()
+        self.size -= entry.size
+        return entry.size
+
+    def _settle(self, delta: int):
+        if self.budget is None or not delta:
+            return
+        if delta > 0:
+            self.budget.charge(delta)
+        else:
+            self.budget.release(-delta)
+
+
+class ReplayLog:
+    """Recent output frames of one session, numbered for delta resync.
+
+    Every frame sent to clients gets the next sequence number. A client that
+    reconnects with the ``epoch`` and last sequence number it saw can be sent
+    just the frames it missed, as long as they are still among the most
+    recent ``max_bytes`` characters. Hold ``lock`` while recording a frame
+    and sending it so that frames go out in sequence order.
+    """
+
+    def __init__(self, max_bytes: int = 256 << 10):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._frames = deque()  # (seq, text)
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """Characters of output held"""
+        return self._size
+
+    def record(self, text: str) -> int:
+        """Store a frame and return its sequence number"""
+        with self.lock:
+            self.seq += 1
+            self._frames.append((self.seq, text))
+            self._size += len(text)
+            while self._size > self.max_bytes and len(self._frames) > 1:
+                _, old = self._frames.popleft()
+                self._size -= len(old)
+            return self.seq
+
+    def since(self, epoch: Optional[str], last_seq: Optional[int]) -> Optional[list]:
+        """Frames after `last_seq`, or None if they are no longer available"""
+        with self.lock:
+            if epoch != self.epoch or last_seq is None or last_seq > self.seq:
+                return None
+            if last_seq == self.seq:
+                return []
+            if not self._frames or self._frames[0][0] > last_seq + 1:
+                return None
+            return [frame for frame in self._frames if frame[0] > last_seq]
+
+    def reset(self):
+        """Start a new stream, invalidating every client's position"""
+        with self.lock:
+            self.epoch = uuid.uuid4().hex[:12]
+            self.seq = 0
+            self._frames.clear()
+            self._size = 0
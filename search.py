@@ -0,0 +1,289 @@
+import bisect
+import logging
+import threading
+import time
+from array import array
+from collections import deque
+from typing import List, Optional
+
+logger = logging.getLogger("search")
+
+
+class _Chunk:
+    """Whole lines of one command's output, or its command line"""
+
+    __slots__ = ('session_id', 'entry_id', 'command', 'cwd', 'line', 'offset', 'text')
+
+    def __init__(self, session_id, entry_id, command, cwd, line, offset, text):
+        self.session_id = session_id
+        self.entry_id = entry_id
+        self.command = command
+        self.cwd = cwd
+        self.line = line        # 1-based line number of the first line in the command's output, 0 for the command
+        self.offset = offset    # byte offset of the text in the session's output archive, if known
+        self.text = text
+
+
+class _EntryState:
+    """Where indexing stands in one command's output"""
+
+    __slots__ = ('session_id', 'command', 'cwd', 'partial', 'partial_offset', 'line')
+
+    def __init__(self, session_id, command, cwd):
+        self.session_id = session_id
+        self.command = command
+        self.cwd = cwd
+        self.partial = ''           # output after the last newline
+        self.partial_offset = None
+        self.line = 1               # number of the line `partial` belongs to
+
+
+class SearchIndex:
+    """Case-insensitive substring search over recent command output.
+
+    Output is indexed in chunks of whole lines: the trigrams of each chunk go
+    into an inverted index of chunk numbers, and a query only looks inside
+    the chunks that contain every trigram of the query. Commands and their
+    working directories are indexed the same way.
+
+    Indexing runs on a background thread fed by ``add_command`` and
+    ``add_output``, which only queue text, and is held to ``max_cpu`` of one
+    core so it never competes much with streaming. Memory is bounded: at
+    most ``max_bytes`` of text is indexed (the oldest chunks are forgotten
+    first), and while more than ``max_pending_bytes`` is waiting to be
+    indexed, new output is skipped and counted in ``skipped_bytes``.
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20, max_pending_bytes: int = 4 << 20, max_cpu: float = 0.25,
+                 max_line_length: int = 4096, max_entries: int = 10000):
+        self.max_bytes = max_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.max_cpu = max_cpu
+        self.max_line_length = max_line_length
+        self.max_entries = max_entries
+        self.skipped_bytes = 0
+        self.indexed_bytes = 0
+        self._postings = {}     # trigram -> array of chunk ids, ascending
+        self._chunks = deque()  # _Chunk, ids first_id...
+        self._first_id = 0
+        self._size = 0
+        self._evicted_since_compaction = 0
+        self._entries = {}      # entry id -> _EntryState, insertion ordered
+        self._last_entry = {}   # session id -> entry id of its latest command
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._pending_bytes = 0
+        self._indexing = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def size(self) -> int:
+        """Characters of text in the index"""
+        return self._size
+
+    # Feeding the index (any thread)
+    def add_command(self, session_id: str, entry, offset: Optional[int] = None):
+        """Index a command line and its working directory"""
+        self._put((session_id, entry.id, entry.command, entry.cwd, None, offset))
+
+    def add_output(self, session_id: str, entry, text: str, offset: Optional[int] = None):
+        """Index output of a command; `offset` is where `text` starts in the session's archive"""
+        with self._cond:
+            if self._pending_bytes + len(text) > self.max_pending_bytes:
+                self.skipped_bytes += len(text)
+                return
+        self._put((session_id, entry.id, entry.command, entry.cwd, text, offset))
+
+    def end_session(self, session_id: str):
+        """Index the session's unterminated last line and forget its state (its chunks stay searchable)"""
+        self._put((session_id, None, None, None, None, None))
+
+    def _put(self, item):
+        with self._cond:
+            if item[4] is not None:
+                self._pending_bytes += len(item[4])
+            self._queue.append(item)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="search-indexer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                item = self._queue.popleft()
+                if item[4] is not None:
+                    self._pending_bytes -= len(item[4])
+                self._indexing = True
+            began = time.thread_time()
+            try:
+                self._index(*item)
+            except Exception as e:
+                logger.error(f"Indexing output of session {item[0]} failed: {e}")
+            cost = time.thread_time() - began
+            with self._cond:
+                self._indexing = False
+                self._cond.notify_all()
+            # Idle long enough to stay under max_cpu of one core
+            if cost > 0.001:
+                time.sleep(cost * (1 / self.max_cpu - 1))
+
+    def wait_idle(self, timeout: float = 5.0) -> bool:
+        """Block until everything queued so far has been indexed"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._indexing, timeout)
+
+    # Indexing (indexer thread)
+    def _index(self, session_id, entry_id, command, cwd, text, offset):
+        if entry_id is None:
+            previous = self._last_entry.pop(session_id, None)
+            if previous is not None and previous in self._entries:
+                self._flush_partial(previous, self._entries.pop(previous))
+            return
+        if text is None:
+            # A new command: the previous one's unterminated last line is complete now
+            previous = self._last_entry.get(session_id)
+            if previous is not None and previous in self._entries:
+                self._flush_partial(previous, self._entries[previous])
+            self._last_entry[session_id] = entry_id
+            self._add(_Chunk(session_id, entry_id, command, cwd, 0, offset, f"{cwd} $ {command}"))
+            return
+        state = self._entries.get(entry_id)
+        if state is None:
+            state = self._entries[entry_id] = _EntryState(session_id, command, cwd)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+        if state.partial:
+            text = state.partial + text
+            offset = state.partial_offset
+        end = text.rfind('\n') + 1
+        if end:
+            lines = text[:end]
+            self._add(_Chunk(session_id, entry_id, command, cwd, state.line, offset, lines))
+            state.line += lines.count('\n')
+            if offset is not None:
+                offset += len(lines.encode('utf-8', 'replace'))
+        # Keep the unterminated rest (bounded) until its newline arrives
+        rest = text[end:]
+        if len(rest) > self.max_line_length:
+            if offset is not None:
+                offset += len(rest[:-self.max_line_length].encode('utf-8', 'replace'))
+            rest = rest[-self.max_line_length:]
+        state.partial, state.partial_offset = rest, offset
+
+    def _flush_partial(self, entry_id: str, state: _EntryState):
+        if state.partial:
+            self._add(_Chunk(state.session_id, entry_id, state.command, state.cwd, state.line,
+                             state.partial_offset, state.partial))
+            state.partial = ''
+
+    def _add(self, chunk: _Chunk):
+        trigrams = _trigrams(chunk.text.lower())
+        with self._lock:
+            chunk_id = self._first_id + len(self._chunks)
+            self._chunks.append(chunk)
+            self._size += len(chunk.text)
+            self.indexed_bytes += len(chunk.text)
+            for trigram in trigrams:
+                postings = self._postings.get(trigram)
+                if postings is None:
+                    postings = self._postings[trigram] = array('Q')
+                postings.append(chunk_id)
+            while self._size > self.max_bytes and len(self._chunks) > 1:
+                self._size -= len(self._chunks.popleft().text)
+                self._first_id += 1
+                self._evicted_since_compaction += 1
+            if self._evicted_since_compaction >= max(len(self._chunks), 1024):
+                self._compact()
+
+    def _compact(self):
+        """Drop postings of forgotten chunks"""
+        for trigram in list(self._postings):
+            postings = self._postings[trigram]
+            dead = bisect.bisect_left(postings, self._first_id)
+            if dead == len(postings):
+                del self._postings[trigram]
+            elif dead:
+                del postings[:dead]
+        self._evicted_since_compaction = 0
+
+    # Searching (any thread)
+    def search(self, query: str, session_id: Optional[str] = None, limit: int = 50) -> List[dict]:
+        """Lines containing `query` (at least 3 characters, any case), newest first"""
+        folded = query.lower()
+        trigrams = _trigrams(folded)
+        if not trigrams or '\n' in query:
+            raise ValueError("Search queries need at least 3 characters on one line")
+        results = []
+        with self._lock:
+            lists = []
+            for trigram in trigrams:
+                postings = self._postings.get(trigram)
+                if postings is None:
+                    return []
+                lists.append(postings)
+            lists.sort(key=len)
+            candidates, others = lists[0], lists[1:]
+            first_live = bisect.bisect_left(candidates, self._first_id)
+            for index in range(len(candidates) - 1, first_live - 1, -1):
+                chunk_id = candidates[index]
+                if not all(_contains(other, chunk_id) for other in others):
+                    continue
+                chunk = self._chunks[chunk_id - self._first_id]
+                if session_id is not None and chunk.session_id != session_id:
+                    continue
+                results.extend(_matching_lines(chunk, folded, limit - len(results)))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'bytes': self._size,
+            'chunks': len(self._chunks),
+            'trigrams': len(self._postings),
+            'pending_bytes': self._pending_bytes,
+            'skipped_bytes': self.skipped_bytes,
+        }
+
+
+def _matching_lines(chunk: _Chunk, folded: str, limit: int) -> List[dict]:
+    """The chunk's lines containing `folded`, last first"""
+    lines = chunk.text.split('\n')
+    if chunk.text.endswith('\n'):
+        lines.pop()
+    offsets = None
+    if chunk.offset is not None:
+        offsets, offset = [], chunk.offset
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line.encode('utf-8', 'replace')) + 1
+    matches = []
+    for index in range(len(lines) - 1, -1, -1):
+        if folded not in lines[index].lower():
+            continue
+        matches.append({
+            'session_id': chunk.session_id,
+            'entry_id': chunk.entry_id,
+            'command': chunk.command,
+            'cwd': chunk.cwd,
+            'line': chunk.line + index if chunk.line else 0,
+            'offset': offsets[index] if offsets is not None else None,
+            'text': lines[index].rstrip('\r'),
+        })
+        if len(matches) >= limit:
+            break
+    return matches
+
+
+def _contains(postings: array, chunk_id: int) -> bool:
+    index = bisect.bisect_left(postings, chunk_id)
+    return index < len(postings) and postings[index] == chunk_id
+
+
+def _trigrams(text: str) -> set:
+    # zip keeps the loop in C: about twice as fast as slicing
+    return set(zip(text, text[1:], text[2:]))
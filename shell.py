@@ -0,0 +1,108 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import uuid
+from typing import Callable, Optional
+
+logger = logging.getLogger("shell")
+
+DoneCallback = Callable[[int, Optional[str]], None]
+
+
+class ShellSession:
+    """A long-lived shell that runs one session's commands in turn.
+
+    Commands are written to the shell's stdin, so ``cd``, ``export``,
+    ``source venv/bin/activate``, aliases and functions persist between
+    them. After each command the shell prints a sentinel carrying a
+    per-shell token, the exit status and ``$PWD``; it is removed from the
+    output and reported through the command's ``on_done(status, cwd)``. If
+    the shell itself exits, the running command's ``on_done`` gets the
+    shell's return code and a cwd of None.
+    """
+
+    def __init__(self, supervisor, cwd: str, use_pty: bool = False, shell_path: Optional[str] = None):
+        self.token = uuid.uuid4().hex
+        self._marker = '\x1e' + self.token
+        self._lock = threading.Lock()
+        self._pending = ''
+        self._on_output = None
+        self._on_done = None
+        self._exited = False
+        path = shell_path or shutil.which('bash') or '/bin/sh'
+        args = ' --noprofile --norc' if os.path.basename(path) == 'bash' else ''
+        self.proc = supervisor.spawn(f"exec {shlex.quote(path)}{args}", cwd, self._read, self._shell_exited,
+                                     use_pty=use_pty, stdin_pipe=True)
+        self._write("shopt -s expand_aliases 2>/dev/null\n")
+
+    @property
+    def alive(self) -> bool:
+        return not self._exited and self.proc.poll() is None
+
+    @property
+    def busy(self) -> bool:
+        return self._on_done is not None
+
+    def run(self, command: str, on_output: Callable[[str], None], on_done: DoneCallback):
+        """Feed a command to the shell; returns as soon as it is written"""
+        with self._lock:
+            if self.busy:
+                raise RuntimeError("Shell is already running a command")
+            self._on_output = on_output
+            self._on_done = on_done
+        # The command reads /dev/null so it cannot consume the commands that follow it, and
+        # goes through eval so an unbalanced quote or heredoc fails on its own instead of
+        # swallowing the sentinel; `command` keeps sh from exiting on that syntax error
+        self._write(f"{{ command eval {shlex.quote(command)}\n}} < /dev/null\n"
+                    f"printf '\\036%s %s %s\\036\\n' '{self.token}' \"$?\" \"$PWD\"\n")
+
+    def _write(self, data: str):
+        try:
+            self.proc.stdin.write(data.encode('utf-8'))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError, OSError) as e:
+            logger.error(f"Failed to write to shell {self.proc.pid}: {e}")
+
+    def _read(self, text: str):
+        data = self._pending + text
+        self._pending = ''
+        while data:
+            start = data.find(self._marker)
+            if start == -1:
+                # Hold back what may be the beginning of a sentinel
+                cut = data.rfind('\x1e')
+                if cut != -1 and self._marker.startswith(data[cut:]):
+                    self._pending = data[cut:]
+                    data = data[:cut]
+                self._forward(data)
+                return
+            end = data.find('\x1e', start + len(self._marker))
+            if end == -1:
+                self._pending = data[start:]
+                self._forward(data[:start])
+                return
+            self._forward(data[:start])
+            status, _, cwd = data[start + len(self._marker):end].strip().partition(' ')
+            data = data[end + 1:]
+            if data.startswith('\n'):
+                data = data[1:]
+            self._complete(int(status) if status.lstrip('-').isdigit() else 1, cwd or None)
+
+    def _forward(self, text: str):
+        if text and self._on_output is not None:
+            self._on_output(text)
+
+    def _complete(self, status: int, cwd: Optional[str]):
+        with self._lock:
+            on_done, self._on_done, self._on_output = self._on_done, None, None
+        if on_done is not None:
+            on_done(status, cwd)
+
+    def _shell_exited(self, proc: subprocess.Popen, returncode: int):
+        self._exited = True
+        self._forward(self._pending)
+        self._pending = ''
+        self._complete(returncode, None)
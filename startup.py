@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import psutil
+
+logger = logging.getLogger("startup")
+
+
+class _Check:
+    __slots__ = ('ready', 'seconds', 'attempts', 'error')
+
+    def __init__(self):
+        self.ready = False
+        self.seconds = None  # from process start until the check first passed
+        self.attempts = 0
+        self.error = None
+
+
+class Startup:
+    """Boot timing and background warm-up of what the server depends on.
+
+    ``warm(name, check)`` registers a check and ``start()`` runs each
+    ``check()`` on a background thread, retrying with exponential backoff
+    (up to ``max_retry_interval`` seconds) until it returns without raising;
+    the server is ready once it has started and every check has passed. Times are measured from the start of the process, so they
+    include interpreter start-up: ``import_seconds`` until the application
+    module finished importing, ``ready_seconds`` until the last check
+    passed, and the latency of the first request served.
+    """
+
+    def __init__(self, retry_interval: float = 0.5, max_retry_interval: float = 30.0):
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        try:
+            self.process_started = psutil.Process().create_time()
+        except Exception:
+            self.process_started = time.time()
+        self.import_seconds = None
+        self.ready_seconds = None
+        self.first_request_seconds = None
+        self.first_request_path = None
+        self.first_request_at = None  # seconds after process start
+        self._checks = {}
+        self._started = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self._all_ready()
+
+    def since_start(self) -> float:
+        return time.time() - self.process_started
+
+    def imported(self):
+        """Record that the application finished importing"""
+        self.import_seconds = self.since_start()
+        logger.info(f"Imported in {self.import_seconds:.3f}s")
+
+    def warm(self, name: str, check: Callable[[], None]):
+        """Register `check`, run by `start()` until it passes; not ready until then"""
+        with self._lock:
+            if self._started:
+                raise RuntimeError(f"Cannot add warm-up check {name!r} after start()")
+            self._checks[name] = (_Check(), check)
+
+    def start(self):
+        """Run every registered check in the background"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            checks = list(self._checks.items())
+        for name, (state, check) in checks:
+            threading.Thread(target=self._warm, args=(name, state, check), name=f"warm-{name}", daemon=True).start()
+
+    def request_served(self, seconds: float, path: str) -> bool:
+        """Record a request's latency if it is the first one, returning whether it was"""
+        with self._lock:
+            if self.first_request_seconds is not None:
+                return False
+            self.first_request_seconds = seconds
+            self.first_request_path = path
+            self.first_request_at = self.since_start()
+        logger.info(f"First request ({path}) served in {seconds * 1000:.1f}ms, "
+                    f"{self.first_request_at:.3f}s after start")
+        return True
+
+    def status(self) -> dict:
+        with self._lock:
+            ready = self._all_ready()
+            checks = {name: {'ready': check.ready, 'seconds': check.seconds, 'attempts': check.attempts,
+                             'error': check.error} for name, (check, _) in self._checks.items()}
+        return {
+            'ready': ready,
+            'uptime_seconds': round(self.since_start(), 3),
+            'import_seconds': self.import_seconds,
+            'ready_seconds': self.ready_seconds,
+            'first_request_seconds': self.first_request_seconds,
+            'first_request_path': self.first_request_path,
+            'first_request_at_seconds': self.first_request_at,
+            'checks': checks,
+        }
+
+    def _all_ready(self) -> bool:
+        # Called with the lock held
+        return self._started and all(check.ready for check, _ in self._checks.values())
+
+    def _warm(self, name: str, state: _Check, check: Callable[[], None]):
+        delay = self.retry_interval
+        while True:
+            state.attempts += 1
+            try:
+                check()
+                break
+            except Exception as e:
+                # Only the error type is reported: readiness is served without login
+                state.error = type(e).__name__
+                logger.warning(f"Warm-up of {name} failed (attempt {state.attempts}), retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_interval)
+        with self._lock:
+            state.ready, state.error, state.seconds = True, None, self.since_start()
+            became_ready = self.ready_seconds is None and self._all_ready()
+            if became_ready:
+                self.ready_seconds = state.seconds
+        logger.info(f"{name} warm after {state.seconds:.3f}s")
+        if became_ready:
+            logger.info(f"Ready after {self.ready_seconds:.3f}s")
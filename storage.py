@@ -0,0 +1,511 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger("storage")
+
+
+class DuplicateKeyError(Exception):
+    """A write would break a unique index"""
+
+
+class StorageBackend(ABC):
+    """Document store behind the DataAccessLayer.
+
+    Backends deal in plain documents: encryption, caching and metrics stay in
+    the DataAccessLayer. Queries are equality matches on (possibly dotted)
+    fields, where None also matches a missing field, or ``{"$lt": value}``
+    comparisons. Returned documents carry their ``_id`` as a string. Every
+    method runs on the database loop.
+    """
+
+    name = None
+
+    @property
+    @abstractmethod
+    def connected(self) -> bool:
+        """Whether connect() has succeeded"""
+
+    @abstractmethod
+    async def connect(self):
+        """Open the connection; a no-op once connected"""
+
+    @abstractmethod
+    async def close(self):
+        """Close the connection, committing anything pending"""
+
+    @abstractmethod
+    async def ping(self):
+        """Make a round trip to the database, raising if it is unreachable"""
+
+    @abstractmethod
+    async def create_index(self, collection: str, field: str, unique: bool = False):
+        """Index a (possibly dotted) field if it is not indexed yet"""
+
+    @abstractmethod
+    async def insert_one(self, collection: str, doc: dict) -> str:
+        """Insert a document and return its id, raising DuplicateKeyError on a unique index clash"""
+
+    @abstractmethod
+    async def find_one(self, collection: str, query: dict) -> Optional[dict]:
+        """Return the first match, or None"""
+
+    @abstractmethod
+    async def find(self, collection: str, query: dict, limit: int) -> List[dict]:
+        """Return up to `limit` matches"""
+
+    @abstractmethod
+    async def set_fields(self, collection: str, query: dict, fields: dict, upsert: bool = False) -> Optional[dict]:
+        """Set fields on the first match and return it as updated, or None"""
+
+    @abstractmethod
+    async def delete_one(self, collection: str, query: dict) -> bool:
+        """Delete the first match, returning whether there was one"""
+
+    @abstractmethod
+    async def delete_many(self, collection: str, query: dict) -> int:
+        """Delete every match, returning how many were deleted"""
+
+    @abstractmethod
+    async def replace_all(self, collection: str, docs: list):
+        """Replace every document in the collection with `docs`"""
+
+    @abstractmethod
+    async def bulk_update(self, collection: str, updates: list):
+        """Apply (query, update, upsert, array_filters) tuples in one unordered batch.
+
+        ``update`` is a MongoDB update document using $set, $inc, $addToSet
+        and $push. Every update is attempted; the first failure is raised
+        afterwards.
+        """
+
+
+class MongoBackend(StorageBackend):
+    """MongoDB through Motor"""
+
+    name = "mongo"
+
+    def __init__(self, uri: str, db_name: str, pool_options: Optional[dict] = None):
+        self.uri = uri
+        self.db_name = db_name
+        self.pool_options = pool_options or {}
+        self.client = None
+        self.db = None
+
+    @property
+    def connected(self) -> bool:
+        return self.db is not None
+
+    async def connect(self):
+        if self.client is not None:
+            return
+        from motor.motor_asyncio import AsyncIOMotorClient
+        try:
+            self.client = AsyncIOMotorClient(self.uri, io_loop=asyncio.get_running_loop(), **self.pool_options)
+            self.db = self.client[self.db_name]
+            logger.info(f"Database connection established (db: {self.db_name})")
+        except Exception as e:
+            logger.error(f"Failed to connect to MongoDB: {e}")
+            self.client = None
+            self.db = None
+            raise
+
+    async def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+            self.db = None
+            logger.info("Database connection closed")
+
+    async def ping(self):
+        await self.client.admin.command('ping')
+
+    async def create_index(self, collection: str, field: str, unique: bool = False):
+        await self.db[collection].create_index(field, unique=unique)
+
+    async def insert_one(self, collection: str, doc: dict) -> str:
+        from pymongo.errors import DuplicateKeyError as MongoDuplicateKeyError
+        try:
+            result = await self.db[collection].insert_one(doc)
+        except MongoDuplicateKeyError as e:
+            raise DuplicateKeyError(str(e)) from e
+        return str(result.inserted_id)
+
+    async def find_one(self, collection: str, query: dict) -> Optional[dict]:
+        return _with_str_id(await self.db[collection].find_one(query))
+
+    async def find(self, collection: str, query: dict, limit: int) -> List[dict]:
+        return [_with_str_id(doc) async for doc in self.db[collection].find(query).limit(limit)]
+
+    async def set_fields(self, collection: str, query: dict, fields: dict, upsert: bool = False) -> Optional[dict]:
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError as MongoDuplicateKeyError
+        try:
+            result = await self.db[collection].find_one_and_update(
+                query,
+                {'$set': fields},
+                return_document=ReturnDocument.AFTER,
+                upsert=upsert
+            )
+        except MongoDuplicateKeyError as e:
+            raise DuplicateKeyError(str(e)) from e
+        return _with_str_id(result)
+
+    async def delete_one(self, collection: str, query: dict) -> bool:
+        result = await self.db[collection].delete_one(query)
+        return result.deleted_count > 0
+
+    async def delete_many(self, collection: str, query: dict) -> int:
+        result = await self.db[collection].delete_many(query)
+        return result.deleted_count
+
+    async def replace_all(self, collection: str, docs: list):
+        await self.db[collection].delete_many({})
+        if docs:
+            await self.db[collection].insert_many(docs)
+
+    async def bulk_update(self, collection: str, updates: list):
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        requests = [UpdateOne(query, update, upsert=upsert, array_filters=array_filters)
+                    for query, update, upsert, array_filters in updates]
+        try:
+            await self.db[collection].bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if errors and all(error.get('code') == 11000 for error in errors):
+                raise DuplicateKeyError(errors[0].get('errmsg')) from e
+            raise
+
+
+class SQLiteBackend(StorageBackend):
+    """Embedded store: one SQLite table of JSON documents per collection.
+
+    The database runs in WAL mode with ``synchronous=NORMAL``, so a commit is
+    an append to the log rather than an fsync. Writes open an immediate
+    transaction that is committed once the current turn of the database loop
+    ends, which batches a flush of many sessions into a single commit while
+    other processes sharing the file (one per worker) still see each write
+    applied atomically. Each write returns only once that commit is done, and
+    raises if it failed. Statements are kept prepared by sqlite3's statement
+    cache, and indexes on document fields are expression indexes, which the
+    equality queries hit directly.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.conn = None
+        self._tables = set()
+        self._committed = None  # future of the open write transaction's commit
+
+    @property
+    def connected(self) -> bool:
+        return self.conn is not None
+
+    async def connect(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                    cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        logger.info(f"Database connection established (sqlite: {self.path})")
+
+    async def close(self):
+        if self.conn is not None:
+            self._commit()
+            self.conn.close()
+            self.conn = None
+            self._tables.clear()
+            logger.info("Database connection closed")
+
+    async def ping(self):
+        self.conn.execute("SELECT 1").fetchone()
+
+    async def create_index(self, collection: str, field: str, unique: bool = False):
+        table = self._table(collection)
+        name = _identifier(f"ix_{collection}_{field}".replace('.', '_'))
+        self.conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} "
+                          f"ON {table} (json_extract(doc, '{_json_path(field)}'))")
+
+    async def insert_one(self, collection: str, doc: dict) -> str:
+        table = self._table(collection)
+        return str(await self._transact(lambda: self._insert(table, doc)))
+
+    async def find_one(self, collection: str, query: dict) -> Optional[dict]:
+        row = self._select(self._table(collection), query, 1).fetchone()
+        return _load(row) if row else None
+
+    async def find(self, collection: str, query: dict, limit: int) -> List[dict]:
+        return [_load(row) for row in self._select(self._table(collection), query, limit)]
+
+    async def set_fields(self, collection: str, query: dict, fields: dict, upsert: bool = False) -> Optional[dict]:
+        return (await self._transact(lambda: self._update(collection, query, {'$set': fields}, upsert)))[0]
+
+    async def delete_one(self, collection: str, query: dict) -> bool:
+        table = self._table(collection)
+
+        def delete():
+            row = self._select(table, query, 1, columns="id").fetchone()
+            if row is not None:
+                self.conn.execute(f"DELETE FROM {table} WHERE id = ?", row)
+            return row is not None
+        return await self._transact(delete)
+
+    async def delete_many(self, collection: str, query: dict) -> int:
+        table = self._table(collection)
+        where, params = _where(query)
+        return await self._transact(lambda: self.conn.execute(f"DELETE FROM {table}{where}", params).rowcount)
+
+    async def replace_all(self, collection: str, docs: list):
+        table = self._table(collection)
+
+        def replace():
+            self.conn.execute(f"DELETE FROM {table}")
+            for doc in docs:
+                self._insert(table, doc)
+        await self._transact(replace)
+
+    async def bulk_update(self, collection: str, updates: list):
+        # Already one transaction; applying each update in turn is the whole batch
+        def apply():
+            error = None
+            for query, update, upsert, array_filters in updates:
+                try:
+                    self._update(collection, query, update, upsert, array_filters)
+                except (DuplicateKeyError, ValueError) as e:
+                    error = error or e
+            return error
+        error = await self._transact(apply)
+        if error is not None:
+            raise error
+
+    # Transactions
+    async def _transact(self, write: Callable[[], Any]) -> Any:
+        """Run `write` in the open write transaction and return its result once that is committed"""
+        committed = self._begin()
+        try:
+            result = write()
+        except Exception:
+            # This write reports its own error; a failed commit is logged either way
+            committed.add_done_callback(lambda future: future.exception())
+            raise
+        await committed
+        return result
+
+    def _begin(self) -> asyncio.Future:
+        """Join the open write transaction, or start one committed after this loop turn"""
+        if self._committed is None:
+            loop = asyncio.get_running_loop()
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._committed = loop.create_future()
+            loop.call_soon(self._commit)
+        return self._committed
+
+    def _commit(self):
+        committed, self._committed = self._committed, None
+        if committed is None:
+            return
+        try:
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"SQLite commit failed: {e}")
+            try:
+                self.conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            # Every write in the transaction is lost: each of them raises
+            committed.set_exception(e)
+        else:
+            committed.set_result(None)
+
+    # Helpers
+    def _table(self, collection: str) -> str:
+        table = _identifier(collection)
+        if collection not in self._tables:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, doc TEXT NOT NULL)")
+            self._tables.add(collection)
+        return table
+
+    def _select(self, table: str, query: dict, limit: int, columns: str = "id, doc") -> sqlite3.Cursor:
+        where, params = _where(query)
+        return self.conn.execute(f"SELECT {columns} FROM {table}{where} ORDER BY id LIMIT ?", (*params, limit))
+
+    def _insert(self, table: str, doc: dict) -> int:
+        try:
+            return self.conn.execute(f"INSERT INTO {table} (doc) VALUES (?)", (_dump(doc),)).lastrowid
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e)) from e
+
+    def _update(self, collection: str, query: dict, update: dict, upsert: bool = False,
+                array_filters: Optional[List[dict]] = None) -> tuple:
+        """Read-modify-write the first match; call inside the write transaction.
+
+        Returns (document as updated or None, whether anything changed).
+        """
+        table = self._table(collection)
+        row = self._select(table, query, 1).fetchone()
+        filters = _parse_array_filters(array_filters)
+        if row is None:
+            if not upsert:
+                return None, False
+            doc = {}
+            for key, value in query.items():
+                _set_path(doc, key, value)
+            _apply_update(doc, update, filters)
+            doc['_id'] = str(self._insert(table, doc))
+            return doc, True
+        doc = _load(row)
+        changed = _apply_update(doc, update, filters)
+        if changed:
+            try:
+                self.conn.execute(f"UPDATE {table} SET doc = ? WHERE id = ?", (_dump(doc), row[0]))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e)) from e
+        return doc, changed
+
+
+def create_backend(name: str, **options) -> StorageBackend:
+    """Build the backend selected by DB_BACKEND"""
+    if name == MongoBackend.name:
+        return MongoBackend(options['uri'], options['db_name'], options.get('pool_options'))
+    if name == SQLiteBackend.name:
+        return SQLiteBackend(options['path'])
+    raise ValueError(f"Unknown database backend: {name!r} (expected 'mongo' or 'sqlite')")
+
+
+_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+
+
+def _identifier(name: str) -> str:
+    if not _NAME.match(name):
+        raise ValueError(f"Invalid collection or field name: {name!r}")
+    return f'"{name}"'
+
+
+def _json_path(field: str) -> str:
+    _identifier(field)
+    return '$.' + field
+
+
+def _where(query: dict) -> tuple:
+    clauses, params = [], []
+    for key, value in query.items():
+        if value is None:
+            clauses.append(f"json_extract(doc, '{_json_path(key)}') IS NULL")
+        elif isinstance(value, (str, int, float)):
+            clauses.append(f"json_extract(doc, '{_json_path(key)}') = ?")
+            params.append(value)
+        elif isinstance(value, dict) and list(value) == ['$lt'] and isinstance(value['$lt'], (str, int, float)):
+            # NULL (a missing field) never compares less, as in MongoDB
+            clauses.append(f"json_extract(doc, '{_json_path(key)}') < ?")
+            params.append(value['$lt'])
+        else:
+            raise ValueError(f"Unsupported query value for {key!r}: {value!r}")
+    return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+def _with_str_id(doc: Optional[dict]) -> Optional[dict]:
+    if doc is not None:
+        doc['_id'] = str(doc['_id'])
+    return doc
+
+
+def _load(row) -> dict:
+    doc = json.loads(row[1])
+    doc.setdefault('_id', str(row[0]))
+    return doc
+
+
+def _dump(doc: dict) -> str:
+    return json.dumps({k: v for k, v in doc.items() if k != '_id'}, separators=(',', ':'), default=str)
+
+
+def _set_path(doc: dict, path: str, value: Any):
+    *parents, last = path.split('.')
+    for key in parents:
+        doc = doc.setdefault(key, {})
+    doc[last] = value
+
+
+def _get_path(doc: Any, path: str) -> Any:
+    for key in path.split('.') if path else ():
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def _apply_update(doc: dict, update: dict, filters: dict) -> bool:
+    """Apply a MongoDB update document in place, returning whether it changed anything"""
+    changed = False
+    for operator, spec in update.items():
+        for field, argument in spec.items():
+            for parent, key in _locate(doc, field.split('.'), filters):
+                if operator == '$set':
+                    changed = changed or parent.get(key) != argument
+                    parent[key] = argument
+                elif operator == '$inc':
+                    parent[key] = parent.get(key, 0) + argument
+                    changed = changed or argument != 0
+                elif operator == '$addToSet':
+                    items = parent.setdefault(key, [])
+                    for value in _each(argument):
+                        if value not in items:
+                            items.append(value)
+                            changed = True
+                elif operator == '$push':
+                    items = (parent.get(key) or []) + _each(argument)
+                    limit = argument.get('$slice') if isinstance(argument, dict) else None
+                    if limit is not None:
+                        items = items[limit:] if limit < 0 else items[:limit]
+                    parent[key] = items
+                    changed = True
+                else:
+                    raise ValueError(f"Unsupported update operator: {operator}")
+    return changed
+
+
+def _each(argument) -> list:
+    if isinstance(argument, dict) and '$each' in argument:
+        return list(argument['$each'])
+    return [argument]
+
+
+def _parse_array_filters(array_filters: Optional[List[dict]]) -> dict:
+    """[{"e.id": 3}] -> {"e": {"id": 3}}"""
+    filters = {}
+    for condition in array_filters or ():
+        for key, value in condition.items():
+            name, _, subpath = key.partition('.')
+            filters.setdefault(name, {})[subpath] = value
+    return filters
+
+
+def _locate(node: Any, parts: list, filters: dict):
+    """Yield (parent, key) for every element an update path such as
+    ``output_buffer.$[e].chunks`` refers to, creating missing objects"""
+    head, rest = parts[0], parts[1:]
+    if head.startswith('$[') and head.endswith(']'):
+        if not isinstance(node, list):
+            return
+        conditions = filters.get(head[2:-1], {})
+        keys = [i for i, item in enumerate(node)
+                if all(_get_path(item, subpath) == value for subpath, value in conditions.items())]
+    elif isinstance(node, dict):
+        keys = [head]
+    else:
+        return
+    for key in keys:
+        if not rest:
+            yield node, key
+        else:
+            child = node[key] if isinstance(node, list) else node.setdefault(key, {})
+            yield from _locate(child, rest, filters)
@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import logging
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger("streaming")
+
+# Complete escape sequences: CSI, OSC (BEL or ST terminated), DCS/SOS/PM/APC, and two-character escapes
+_ESCAPE_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[PX^_][^\x1b]*\x1b\\|[ -/]*[0-~])')
+# Control sequences (colours, cursor movement, erasing...), by far the most common escapes
+_CSI_RE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]')
+# Distinct control sequences a filter removes with str.replace before falling back to _ESCAPE_RE
+MAX_KNOWN_ESCAPES = 64
+# An escape sequence cut off by the end of a chunk
+_PARTIAL_ESCAPE_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?|[ -/]*)\Z')
+# Longest partial sequence carried to the next chunk; anything longer is not a real escape
+MAX_ESCAPE_LENGTH = 4096
+# Longest already-sent line prefix remembered for carriage-return overwrites
+MAX_LINE_PREFIX = 4096
+
+
+class _BatchFlusher:
+    """Single background thread that fires latency deadlines for every batcher"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def schedule(self, batcher: "OutputBatcher", deadline: float):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._counter), batcher))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="output-batch-flusher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, _, batcher = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            batcher._on_deadline(deadline)
+
+
+_flusher = _BatchFlusher()
+
+
+class OutputBatcher:
+    """Coalesce streamed output into chunks bounded by size and latency.
+
+    Pending text is handed to ``flush_fn`` as one string once ``max_bytes``
+    have accumulated or ``max_delay`` seconds after the first pending write,
+    whichever comes first. Call ``close()`` when the producer exits so the
+    tail is delivered immediately.
+    """
+
+    def __init__(self, flush_fn: Callable[[str], None], max_bytes: int = 16384, max_delay: float = 0.02):
+        self.flush_fn = flush_fn
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._parts = []
+        self._size = 0
+        self._deadline: Optional[float] = None
+
+    def write(self, text: str):
+        """Queue text for the next flush"""
+        if not text:
+            return
+        with self._lock:
+            self._parts.append(text)
+            self._size += len(text)
+            over_budget = self._size >= self.max_bytes
+            if not over_budget and self._deadline is None:
+                self._deadline = time.monotonic() + self.max_delay
+                _flusher.schedule(self, self._deadline)
+        if over_budget:
+            self.flush()
+
+    def flush(self):
+        """Deliver everything pending right now"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._parts:
+                    self._deadline = None
+                    return
+                chunk = ''.join(self._parts)
+                self._parts = []
+                self._size = 0
+                self._deadline = None
+            try:
+                self.flush_fn(chunk)
+            except Exception as e:
+                logger.error(f"Output flush failed: {e}")
+
+    def close(self):
+        """Flush the tail once the producer has finished"""
+        self.flush()
+
+    def _on_deadline(self, deadline: float):
+        # Stale heap entries (already flushed by size) are ignored
+        with self._lock:
+            if self._deadline is None or self._deadline > deadline:
+                return
+        self.flush()
+
+
+def _overwrite(line: str) -> str:
+    """Apply carriage returns in a line: each segment overwrites from column 0"""
+    segments = line.split('\r')
+    if len(segments[-1]) >= max(map(len, segments)):
+        # Usual for progress redraws: the last state covers every earlier one
+        return segments[-1]
+    result = segments[0]
+    for segment in segments[1:]:
+        result = segment + result[len(segment):]
+    return result
+
+
+class TerminalFilter:
+    """Stateful, chunk-safe filter for terminal output.
+
+    Escape sequences are stripped (unless ``strip_ansi`` is False) even when
+    they are split across chunks, and carriage-return redraws (progress bars,
+    spinners) are collapsed so only the final state of each line is passed on.
+    A line is held back only once it contains a carriage return; other text
+    is passed through immediately. Call ``flush()`` when the stream ends.
+    """
+
+    def __init__(self, strip_ansi: bool = True):
+        self.strip_ansi = strip_ansi
+        self._carry = ''   # partial escape sequence from the previous chunk
+        self._held = ''    # unfinished line containing carriage returns
+        self._prefix = ''  # start of the current line, already passed on
+        self._known = []   # control sequences seen in this stream
+
+    def feed(self, text: str) -> str:
+        """Filter a chunk, returning the text that is ready to be sent"""
+        if self._carry:
+            text = self._carry + text
+            self._carry = ''
+        if self.strip_ansi and '\x1b' in text:
+            start = text.rfind('\x1b')
+            if start == len(text) - 1:
+                # Possibly the first half of the ESC \ ending an OSC or DCS string
+                previous = text.rfind('\x1b', 0, start)
+                if previous != -1 and _PARTIAL_ESCAPE_RE.match(text, previous):
+                    start = previous
+            if len(text) - start <= MAX_ESCAPE_LENGTH and _PARTIAL_ESCAPE_RE.match(text, start):
+                self._carry = text[start:]
+                text = text[:start]
+            text = self._strip(text)
+        if not self._held and '\r' not in text:
+            newline = text.rfind('\n')
+            if newline == -1:
+                self._prefix = (self._prefix + text)[-MAX_LINE_PREFIX:]
+            else:
+                self._prefix = text[newline + 1:][-MAX_LINE_PREFIX:]
+            return text
+        lines = (self._held + text).split('\n')
+        self._held = ''
+        out = [self._finish_line(line) + '\n' for line in lines[:-1]]
+        tail = lines[-1]
+        if '\r' in tail:
+            self._held = tail
+        elif tail:
+            self._prefix = (self._prefix + tail)[-MAX_LINE_PREFIX:]
+            out.append(tail)
+        return ''.join(out)
+
+    def _strip(self, text: str) -> str:
+        # A handful of distinct sequences (colours, erase line, cursor moves)
+        # make up most escapes: str.replace removes those already seen several
+        # times faster than a regex substitution per match, and the regex
+        # handles whatever is left. Each replace scans the whole chunk, so
+        # they only pay off when escapes are dense enough
+        known = self._known
+        if text.count('\x1b') * 200 < len(known) * len(text):
+            return _ESCAPE_RE.sub('', text)
+        for sequence in known:
+            text = text.replace(sequence, '')
+        if '\x1b' not in text:
+            return text
+        if len(known) < MAX_KNOWN_ESCAPES:
+            known.extend(list(set(_CSI_RE.findall(text)))[:MAX_KNOWN_ESCAPES - len(known)])
+        return _ESCAPE_RE.sub('', text)
+
+    def flush(self) -> str:
+        """Return whatever is still held once the stream has ended"""
+        held, self._held, self._carry = self._held, '', ''
+        return self._finish_line(held) if held else ''
+
+    def _finish_line(self, line: str) -> str:
+        prefix, self._prefix = self._prefix, ''
+        if '\r' not in line:
+            return line
+        final = _overwrite(prefix + line)
+        if final.startswith(prefix):
+            return final[len(prefix):]
+        # The sent prefix was overwritten; show the final state on its own line
+        return '\n' + final
@@ -0,0 +1,321 @@
+import codecs
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import signal
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import psutil
+
+if os.name != 'nt':
+    import fcntl
+    import pty
+    import termios
+
+logger = logging.getLogger("supervisor")
+
+OutputCallback = Callable[[str], None]
+ExitCallback = Callable[[subprocess.Popen, int], None]
+
+
+class _Child:
+    """A supervised process and the callbacks its output is published to"""
+
+    def __init__(self, proc: subprocess.Popen, fd: int, on_output: OutputCallback, on_exit: ExitCallback):
+        self.proc = proc
+        self.fd = fd  # stdout pipe, or the PTY master
+        self.on_output = on_output
+        self.on_exit = on_exit
+        # Multi-byte characters split across reads are carried to the next read
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def close(self):
+        if self.proc.stdout is not None:
+            self.proc.stdout.close()
+        else:
+            os.close(self.fd)
+
+
+class _Termination:
+    """A process being stopped, with everything needed to force-kill it later"""
+
+    def __init__(self, proc: subprocess.Popen):
+        self.proc = proc
+        self.pgid = None
+        self.descendants = []
+        try:
+            if os.name != 'nt':
+                self.pgid = os.getpgid(proc.pid)
+            # Children may leave the process group, so remember them while they can be found
+            self.descendants = psutil.Process(proc.pid).children(recursive=True)
+        except (OSError, psutil.Error):
+            pass
+
+    def signal(self, force: bool):
+        if os.name == 'nt':
+            try:
+                if force:
+                    self.proc.kill()
+                else:
+                    self.proc.send_signal(signal.CTRL_BREAK_EVENT)
+            except OSError:
+                pass
+        elif self.pgid is not None and self.proc.poll() is None:
+            # The unreaped leader keeps its pid, and so the group id, from being
+            # reused; once it is reaped the id may name someone else's group
+            try:
+                os.killpg(self.pgid, signal.SIGKILL if force else signal.SIGTERM)
+            except OSError:
+                pass
+        elif force:
+            # Only what is provably ours: psutil checks each pid still names the same process
+            for child in list(self.descendants):
+                try:
+                    if child.is_running():
+                        self.descendants.extend(child.children(recursive=True))
+                except psutil.Error:
+                    pass
+        for child in self.descendants:
+            try:
+                if force:
+                    child.kill()
+                else:
+                    child.terminate()
+            except psutil.Error:
+                pass
+
+
+class _Reaper:
+    """Background thread that escalates SIGTERM to SIGKILL when a grace period runs out"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def schedule(self, termination: _Termination, deadline: float):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._counter), termination))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="process-reaper", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def escalate_all(self):
+        """Force-kill everything still pending, right now"""
+        with self._cond:
+            pending, self._heap = self._heap, []
+        for _, _, termination in pending:
+            termination.signal(force=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, _, termination = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            # Kill leftovers even if the leader already exited
+            termination.signal(force=True)
+
+
+class ProcessSupervisor:
+    """Owns every child process and multiplexes their output.
+
+    On POSIX a single reader thread waits on all stdout pipes with a selector
+    and publishes decoded output through each child's ``on_output`` callback;
+    Windows pipes cannot be selected, so there each child gets its own reader.
+    ``on_exit`` callbacks run on a small worker pool so slow exit handling
+    never stalls the reader.
+
+    With ``use_pty`` (POSIX only) the command runs on a pseudo-terminal, so
+    programs that block-buffer or hide progress output when stdout is not a
+    TTY stream it as they would in a real terminal.
+
+    ``terminate()`` signals a process group and returns immediately; a
+    reaper thread force-kills it if it is still around after the grace
+    period.
+    """
+
+    def __init__(self, read_size: int = 65536, exit_workers: int = 4, reap_interval: float = 0.5,
+                 pty_size: tuple = (40, 120), terminate_grace: float = 1.0):
+        self.read_size = read_size
+        self.terminate_grace = terminate_grace
+        self.pty_size = pty_size  # (rows, cols)
+        self.reap_interval = reap_interval
+        self._lock = threading.Lock()
+        self._selector = None
+        self._thread = None
+        self._wakeup_r = self._wakeup_w = None
+        self._incoming = []
+        self._exiting = []  # children whose pipe closed before the process exited
+        self._exit_pool = ThreadPoolExecutor(max_workers=exit_workers, thread_name_prefix="process-exit")
+        self._live = {}  # pid -> child, for shutdown
+        self._reaper = _Reaper()
+
+    def spawn(self, command: str, cwd: str, on_output: OutputCallback, on_exit: ExitCallback,
+              use_pty: bool = False, stdin_pipe: bool = False) -> subprocess.Popen:
+        """Start a shell command and return as soon as it is running.
+
+        With ``stdin_pipe`` the caller can write to ``proc.stdin``; otherwise
+        stdin is /dev/null, so a command that prompts for input reads end of
+        file instead of waiting for input nobody can send.
+        """
+        stdin = subprocess.PIPE if stdin_pipe else subprocess.DEVNULL
+        if os.name == 'nt':
+            proc = subprocess.Popen(command, shell=True, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, bufsize=0)
+            fd = proc.stdout.fileno()
+        elif use_pty:
+            proc, fd = self._spawn_pty(command, cwd, stdin)
+        else:
+            proc = subprocess.Popen(command, shell=True, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, preexec_fn=os.setsid, bufsize=0)
+            fd = proc.stdout.fileno()
+        self.watch(_Child(proc, fd, on_output, on_exit))
+        return proc
+
+    def _spawn_pty(self, command: str, cwd: str, stdin):
+        master, slave = pty.openpty()
+        try:
+            attrs = termios.tcgetattr(slave)
+            attrs[1] &= ~termios.ONLCR  # keep "\n" line endings
+            attrs[3] &= ~termios.ECHO
+            termios.tcsetattr(slave, termios.TCSANOW, attrs)
+            fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', self.pty_size[0], self.pty_size[1], 0, 0))
+            # Nobody can page output interactively from the browser
+            env = dict(os.environ, PAGER='cat', GIT_PAGER='cat')
+            env.setdefault('TERM', 'xterm')
+            proc = subprocess.Popen(command, shell=True, stdin=stdin, stdout=slave, stderr=slave, cwd=cwd, env=env, start_new_session=True)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        return proc, master
+
+    def terminate(self, proc: subprocess.Popen, grace: Optional[float] = None):
+        """Ask a process group to exit; it is force-killed after `grace` seconds"""
+        if proc.poll() is not None:
+            return
+        termination = _Termination(proc)
+        termination.signal(force=False)
+        grace = self.terminate_grace if grace is None else grace
+        self._reaper.schedule(termination, time.monotonic() + grace)
+
+    def shutdown(self, timeout: float = 3.0):
+        """Stop every supervised process in parallel within one total deadline"""
+        with self._lock:
+            procs = [child.proc for child in self._live.values()]
+        for proc in procs:
+            self.terminate(proc, grace=timeout)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(proc.poll() is None for proc in procs):
+            time.sleep(0.05)
+        self._reaper.escalate_all()
+
+    def watch(self, child: _Child):
+        with self._lock:
+            self._live[child.proc.pid] = child
+        if os.name == 'nt':
+            threading.Thread(target=self._read_blocking, args=(child,), daemon=True).start()
+            return
+        os.set_blocking(child.fd, False)
+        self._ensure_started()
+        with self._lock:
+            self._incoming.append(child)
+        os.write(self._wakeup_w, b'\0')
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._selector = selectors.DefaultSelector()
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            os.set_blocking(self._wakeup_r, False)
+            self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+            self._thread = threading.Thread(target=self._run, name="process-reader", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            timeout = self.reap_interval if self._exiting else None
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    self._accept_incoming()
+                else:
+                    self._read(key.data)
+            if self._exiting:
+                self._reap()
+
+    def _accept_incoming(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for child in incoming:
+            self._selector.register(child.fd, selectors.EVENT_READ, child)
+
+    def _read(self, child: _Child):
+        try:
+            data = os.read(child.fd, self.read_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            # A PTY master reports EIO once every slave end is closed
+            data = b''
+        if data:
+            self._publish(child, child.decoder.decode(data))
+            return
+        self._publish(child, child.decoder.decode(b'', final=True))
+        self._selector.unregister(child.fd)
+        child.close()
+        self._exiting.append(child)
+        self._reap()
+
+    def _reap(self):
+        still_running = []
+        for child in self._exiting:
+            returncode = child.proc.poll()
+            if returncode is None:
+                still_running.append(child)
+            else:
+                self._exit_pool.submit(self._finish, child, returncode)
+        self._exiting = still_running
+
+    def _read_blocking(self, child: _Child):
+        stream = child.proc.stdout
+        for data in iter(lambda: stream.read(self.read_size), b''):
+            self._publish(child, child.decoder.decode(data))
+        self._publish(child, child.decoder.decode(b'', final=True))
+        stream.close()
+        self._finish(child, child.proc.wait())
+
+    def _publish(self, child: _Child, text: str):
+        if not text:
+            return
+        try:
+            child.on_output(text)
+        except Exception as e:
+            logger.error(f"Output callback failed for pid {child.proc.pid}: {e}")
+
+    def _finish(self, child: _Child, returncode: int):
+        with self._lock:
+            self._live.pop(child.proc.pid, None)
+        try:
+            child.on_exit(child.proc, returncode)
+        except Exception as e:
+            logger.error(f"Exit callback failed for pid {child.proc.pid}: {e}")
@@ -0,0 +1,14 @@
+import pytest
+
+from database import DataAccessLayer
+
+
+@pytest.fixture
+def dal(tmp_path, monkeypatch):
+    """A DataAccessLayer of its own on an SQLite file, running its loop"""
+    monkeypatch.setenv('DB_BACKEND', 'sqlite')
+    monkeypatch.setenv('SQLITE_PATH', str(tmp_path / 'dal.sqlite3'))
+    monkeypatch.setattr(DataAccessLayer, '_instance', None)
+    dal = DataAccessLayer()
+    yield dal
+    dal.stop_loop()
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from archive import OutputArchive, SessionArchive, utf8_page
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return SessionArchive(str(tmp_path / 'session'), block_size=64, segment_bytes=256, max_bytes=1 << 20)
+
+
+def test_reads_span_blocks_and_buffered_output(archive):
+    data = b''.join(b'line %04d\n' % n for n in range(100))
+    for n in range(0, len(data), 30):
+        assert archive.append(data[n:n + 30]) == n
+    assert archive.stats()['next_seq'] > 10
+    assert archive.read(0, len(data)) == (0, data)
+    assert archive.read(95, 200) == (95, data[95:295])
+    # Default: the last `length` bytes, buffered output included
+    assert archive.read(length=25) == (len(data) - 25, data[-25:])
+    seq, next_seq, offset, blocks = archive.read_blocks(2, count=3)
+    assert (seq, next_seq) == (2, 5)
+    assert blocks == data[offset:offset + len(blocks)]
+
+
+def test_index_is_reloaded_by_a_new_reader(archive):
+    archive.append(b'x' * 200)
+    archive.flush()
+    reader = SessionArchive(archive.path)
+    assert reader.read(0, 1000) == (0, b'x' * 200)
+
+
+def test_oldest_segments_are_trimmed(tmp_path):
+    path = str(tmp_path / 'session')
+    archive = SessionArchive(path, block_size=64, segment_bytes=200, max_bytes=600, compression_level=0)
+    data = bytes(range(256)) * 40
+    for n in range(0, len(data), 64):
+        archive.append(data[n:n + 64])
+    archive.flush()
+
+    stats = archive.stats()
+    assert stats['stored_bytes'] <= 600 + 200
+    assert stats['first_seq'] > 0 and stats['start'] == stats['first_seq'] * 64
+    assert len([name for name in os.listdir(path) if name.endswith('.seg')]) <= 4
+    assert '00000000.seg' not in os.listdir(path)
+    # Reads before the oldest output kept start at it instead
+    start, kept = archive.read(0, len(data))
+    assert (start, kept) == (stats['start'], data[stats['start']:])
+    # Block numbering survives the index rewrite
+    reader = SessionArchive(path)
+    assert reader.stats() == stats
+    assert reader.read_blocks(0)[:3] == (stats['first_seq'], stats['first_seq'] + 1, stats['start'])
+
+
+def test_pages_split_on_character_boundaries(archive):
+    text = ''.join(f'{n} é€😀 ' for n in range(200))
+    data = text.encode('utf-8')
+    archive.append(data)
+    end = archive.stats()['end']
+    for length in (4, 5, 7, 64, 100):
+        offset, pages = 0, []
+        while offset < end:
+            start, chunk = archive.read(offset, length)
+            start, offset, page = utf8_page(start, chunk, start + len(chunk) >= end)
+            assert '�' not in page
+            pages.append(page)
+        assert ''.join(pages) == text
+
+
+def test_page_starting_inside_a_character_skips_to_the_next():
+    data = 'a😀b'.encode('utf-8')
+    assert utf8_page(2, data[2:], True) == (5, 6, 'b')
+    assert utf8_page(0, data[:3], False) == (0, 1, 'a')
+
+
+def test_delete_removes_the_session(tmp_path):
+    archives = OutputArchive(str(tmp_path), block_size=16)
+    archives.append('kept', 'other output\n')
+    archives.append('gone', 'x' * 100)
+    archives.close('gone')
+    assert archives.exists('gone')
+    archives.delete('gone')
+    assert not archives.exists('gone')
+    assert not os.path.exists(tmp_path / 'gone')
+    assert archives.exists('kept')
+
+
+def test_readers_of_closed_sessions_are_not_kept(tmp_path):
+    archives = OutputArchive(str(tmp_path))
+    archives.append('s', 'hello\n')
+    archives.close('s')
+    assert archives.reader('s').read() == (0, b'hello\n')
+    assert 's' not in archives._sessions
+    # The open archive is shared while the session is live
+    live = archives.session('s')
+    assert archives.reader('s') is live
+
+
+def test_unsafe_session_ids_stay_inside_the_root(tmp_path):
+    archives = OutputArchive(str(tmp_path / 'root'))
+    archives.append('../escape', 'x')
+    archives.close('../escape')
+    assert os.listdir(tmp_path) == ['root']
+    assert archives.reader('../escape').read() == (0, b'x')
@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+import pytest
+
+from database import QueryCache, WriteBatcher, _PendingWrite
+
+
+def pending(update, upsert=False, array_filters=None):
+    return _PendingWrite('items', {'key': 'k'}, update, upsert, array_filters)
+
+
+def test_merge_combines_commuting_writes():
+    write = pending({'$set': {'a': 1, 'b': 1}, '$inc': {'n': 1}, '$addToSet': {'tags': {'$each': ['x']}}})
+    assert write.merge({'$set': {'a': 2}, '$inc': {'n': 2}, '$addToSet': {'tags': {'$each': ['x', 'y']}}}, False, None)
+    assert write.merge({'$set': {'c.d': 3}}, False, None)
+    assert write.update == {'$set': {'a': 2, 'b': 1, 'c.d': 3}, '$inc': {'n': 3},
+                            '$addToSet': {'tags': {'$each': ['x', 'y']}}}
+
+
+@pytest.mark.parametrize('update, upsert, array_filters', [
+    ({'$inc': {'a': 1}}, False, None),                      # another operator on the same field
+    ({'$set': {'a.b': 1}}, False, None),                    # a field inside one already written
+    ({'$set': {'other': 1}}, True, None),                   # upsert differs
+    ({'$set': {'other': 1}}, False, [{'e.id': 1}]),         # array filters
+    ({'$push': {'log': {'$each': [1]}}}, False, None),      # order-dependent
+])
+def test_merge_refuses_writes_that_do_not_commute(update, upsert, array_filters):
+    write = pending({'$set': {'a': 1}})
+    assert not write.merge(update, upsert, array_filters)
+    assert write.update == {'$set': {'a': 1}}
+
+
+def batcher_run(steps, window=0.01):
+    """Run `steps(batcher)` with a batcher whose flushes are recorded as (collection, [(query, update)])"""
+    flushed = []
+
+    async def flush(collection, writes):
+        flushed.append((collection, [(write.query, write.update) for write in writes]))
+        if any(write.query.get('fail') for write in writes):
+            raise RuntimeError('write failed')
+
+    async def main():
+        batcher = WriteBatcher(flush, window=window)
+        result = await steps(batcher)
+        await batcher.drain()
+        return result
+    return asyncio.run(main()), flushed
+
+
+def test_writes_to_one_document_are_group_committed():
+    async def steps(batcher):
+        await asyncio.gather(
+            batcher.write('items', {'key': 'k'}, {'$set': {'a': 1}}),
+            batcher.write('items', {'key': 'k'}, {'$set': {'a': 2}, '$inc': {'n': 1}}),
+            batcher.write('items', {'key': 'other'}, {'$inc': {'n': 1}}),
+            batcher.write('logs', {'key': 'k'}, {'$set': {'a': 1}}),
+        )
+
+    _, flushed = batcher_run(steps)
+    assert flushed == [
+        ('items', [({'key': 'k'}, {'$set': {'a': 2}, '$inc': {'n': 1}}), ({'key': 'other'}, {'$inc': {'n': 1}})]),
+        ('logs', [({'key': 'k'}, {'$set': {'a': 1}})]),
+    ]
+
+
+def test_writes_that_cannot_merge_keep_their_order():
+    async def steps(batcher):
+        await asyncio.gather(
+            batcher.write('items', {'key': 'k'}, {'$set': {'a': 1}}),
+            batcher.write('items', {'key': 'k'}, {'$push': {'log': {'$each': [1]}}}),
+            batcher.write('items', {'key': 'k'}, {'$push': {'log': {'$each': [2]}}}),
+            batcher.write('items', {'key': 'k'}, {'$set': {'a': 2}}),
+        )
+
+    _, flushed = batcher_run(steps)
+    assert [writes[0][1] for _, writes in flushed] == [
+        {'$set': {'a': 1}}, {'$push': {'log': {'$each': [1]}}}, {'$push': {'log': {'$each': [2]}}}, {'$set': {'a': 2}}]
+
+
+def test_a_failed_flush_raises_in_its_writers_only():
+    async def steps(batcher):
+        return await asyncio.gather(
+            batcher.write('items', {'key': 'k', 'fail': True}, {'$set': {'a': 1}}),
+            batcher.write('items', {'key': 'k', 'fail': True}, {'$set': {'b': 1}}),
+            batcher.write('logs', {'key': 'k'}, {'$set': {'a': 1}}),
+            return_exceptions=True)
+
+    results, _ = batcher_run(steps)
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError, type(None)]
+
+
+def test_writes_without_waiting_are_flushed_by_drain():
+    async def steps(batcher):
+        await batcher.write('items', {'key': 'k'}, {'$set': {'a': 1}}, wait=False)
+        return batcher.pending
+
+    queued, flushed = batcher_run(steps, window=60)
+    assert queued == 1
+    assert flushed == [('items', [({'key': 'k'}, {'$set': {'a': 1}})])]
+
+
+def test_cache_evicts_least_recently_used():
+    cache = QueryCache(max_entries=2)
+    cache.set('items', {'k': 1}, {'v': 1})
+    cache.set('items', {'k': 2}, {'v': 2})
+    assert cache.get('items', {'k': 1}) == {'v': 1}
+    cache.set('items', {'k': 3}, {'v': 3})
+    assert cache.get('items', {'k': 2}) is None
+    assert cache.get('items', {'k': 1}) == {'v': 1} and cache.get('items', {'k': 3}) == {'v': 3}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_cache_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = QueryCache(ttl=10)
+    cache.set('items', {'k': 1}, {'v': 1})
+    now[0] += 9
+    assert cache.get('items', {'k': 1}) == {'v': 1}
+    now[0] += 2
+    assert cache.get('items', {'k': 1}) is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_cache_invalidation_and_disabled_collections():
+    cache = QueryCache(disabled_collections=['session_buffers'])
+    cache.set('session_buffers', {'k': 1}, {'v': 1})
+    assert cache.get('session_buffers', {'k': 1}) is None
+    for k in range(3):
+        cache.set('items', {'k': k}, {'v': k})
+    cache.set('other', {'k': 0}, {'v': 0})
+    cache.invalidate('items', {'k': 0})
+    assert cache.get('items', {'k': 0}) is None and cache.get('items', {'k': 1}) == {'v': 1}
+    cache.invalidate_collection('items')
+    assert cache.get('items', {'k': 1}) is None and cache.get('items', {'k': 2}) is None
+    assert cache.get('other', {'k': 0}) == {'v': 0}
+
+
+def test_group_committed_writes_invalidate_cached_reads(dal):
+    query = {'key': 'k'}
+
+    async def steps():
+        await dal.create('items', {'key': 'k', 'n': 0, 'log': []})
+        before = await dal.get('items', query)
+        await dal.update('items', query, {'n': 1}, return_document=False)
+        after_update = await dal.get('items', query)
+        await dal.push_to_array('items', query, 'log', ['x'])
+        after_push = await dal.get('items', query)
+        await dal.increment('items', query, 'n', 5)
+        return before, after_update, after_push, await dal.get('items', query)
+
+    before, after_update, after_push, after_increment = dal.run(steps())
+    assert (before['n'], after_update['n'], after_push['log'], after_increment['n']) == (0, 1, ['x'], 6)
+    assert dal.cache.stats()['hits'] == 0
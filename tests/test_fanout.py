@@ -0,0 +1,136 @@
+import time
+
+import pytest
+import socketio
+from engineio import socket as eio_socket
+from socketio import packet
+
+from fanout import OUTPUT_BATCH_EVENT, OUTPUT_EVENT, SKIPPED_EVENT, FanoutManager, OutputFanout
+
+ROOM = 'session-1'
+
+
+@pytest.fixture
+def fanout():
+    return OutputFanout(max_queue_bytes=100, max_in_flight=2, poll_interval=0.01)
+
+
+@pytest.fixture
+def server(fanout):
+    manager = FanoutManager()
+    manager.fanout = fanout
+    server = socketio.Server(async_mode='threading', client_manager=manager)
+    fanout.bind(server)
+    return server
+
+
+def connect(server, eio_sid='eio-1'):
+    """Register a client whose Engine.IO send queue is only drained by the test"""
+    socket = eio_socket.Socket(server.eio, eio_sid)
+    server.eio.sockets[eio_sid] = socket
+    sid = server.manager.connect(eio_sid, '/')
+    server.manager.enter_room(sid, '/', ROOM)
+    return socket
+
+
+def publish(server, seq, output='x' * 30):
+    server.emit(OUTPUT_EVENT, {'session_id': ROOM, 'epoch': 'E', 'seq': seq, 'output': output}, room=ROOM)
+
+
+def drain(socket):
+    """Events sent to a client so far, as (event, data)"""
+    events = []
+    while not socket.queue.empty():
+        events.append(tuple(packet.Packet(encoded_packet=socket.queue.get().data).data))
+    return events
+
+
+def wait_caught_up(fanout, timeout=5):
+    deadline = time.monotonic() + timeout
+    while fanout.lagging and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not fanout.lagging
+
+
+def test_fast_client_gets_frames_directly(server, fanout):
+    socket = connect(server)
+    publish(server, 1)
+    assert drain(socket) == [(OUTPUT_EVENT, {'session_id': ROOM, 'epoch': 'E', 'seq': 1, 'output': 'x' * 30})]
+    assert fanout.lagging == 0
+
+
+def test_lagging_client_gets_frames_coalesced(server, fanout):
+    socket = connect(server)
+    for seq in range(1, 5):
+        publish(server, seq)
+    assert fanout.lagging == 1
+    events = drain(socket)
+    assert [data['seq'] for _, data in events] == [1, 2]
+    assert wait_caught_up(fanout)
+    assert drain(socket) == [(OUTPUT_BATCH_EVENT, {'session_id': ROOM, 'epoch': 'E',
+                                                    'frames': [[3, 'x' * 30], [4, 'x' * 30]]})]
+    assert fanout.coalesced_frames == 2
+    assert fanout.skipped_bytes == 0
+
+
+def test_slow_client_is_sent_a_skip_marker(server, fanout):
+    socket = connect(server)
+    for seq in range(1, 10):
+        publish(server, seq)
+    # Two frames went out directly; of the rest, four overflowed the 100 character queue
+    assert fanout.skipped_bytes == 120
+    assert [data['seq'] for _, data in drain(socket)] == [1, 2]
+    assert wait_caught_up(fanout)
+    events = drain(socket)
+    assert events[0] == (SKIPPED_EVENT, {'session_id': ROOM, 'epoch': 'E', 'seq': 6, 'skipped': 120})
+    assert events[1] == (OUTPUT_BATCH_EVENT, {'session_id': ROOM, 'epoch': 'E',
+                                              'frames': [[seq, 'x' * 30] for seq in (7, 8, 9)]})
+
+
+def test_slow_client_does_not_hold_up_others(server, fanout):
+    slow = connect(server, 'eio-slow')
+    fast = connect(server, 'eio-fast')
+    for seq in range(1, 10):
+        publish(server, seq)
+        assert [data['seq'] for _, data in drain(fast)] == [seq]
+    assert fanout.lagging == 1
+    assert slow.queue.qsize() == 2
+
+
+def test_resynced_client_is_not_sent_what_it_missed(server, fanout):
+    socket = connect(server)
+    for seq in range(1, 10):
+        publish(server, seq)
+    drain(socket)
+    sid = next(iter(server.manager.get_participants('/', ROOM)))[0]
+    fanout.resynced(ROOM, sid)
+    assert wait_caught_up(fanout)
+    assert drain(socket) == []
+
+
+def test_other_events_are_emitted_as_usual(server, fanout):
+    socket = connect(server)
+    server.emit('session_created', {'session_id': ROOM}, room=ROOM)
+    assert drain(socket) == [('session_created', {'session_id': ROOM})]
+
+
+def test_falls_back_to_emit_without_a_direct_send(fanout, monkeypatch):
+    monkeypatch.setattr(socketio.Server, '_send_eio_packet', None)
+    fanout.bind(socketio.Server(async_mode='threading'))
+    assert not fanout.supported
+    assert not fanout.deliver(None, OUTPUT_EVENT, {'seq': 1, 'output': 'x'}, '/', ROOM)
+
+
+def test_falls_back_to_emit_without_a_send_queue(server, fanout):
+    socket = connect(server)
+    queue = socket.queue
+    del socket.queue
+    socket.send = queue.put  # what the client manager's emit ends up calling
+    publish(server, 1)
+    assert not fanout.supported
+    publish(server, 2)
+    events = []
+    while not queue.empty():
+        events.append(packet.Packet(encoded_packet=queue.get().data).data[1]['seq'])
+    assert events == [1, 2]
+    assert fanout.lagging == 0
@@ -0,0 +1,136 @@
+import time
+
+import pytest
+
+from persistence import SessionBufferWriter
+from scrollback import Scrollback
+
+CHUNK = 8
+MAX_ENTRY = 4 * CHUNK
+
+
+@pytest.fixture
+def writer(dal):
+    writer = SessionBufferWriter(dal, flush_interval=60, chunk_size=CHUNK, max_entry_bytes=MAX_ENTRY)
+    yield writer
+    writer.stop()
+
+
+def new_scrollback():
+    return Scrollback(max_entry_bytes=MAX_ENTRY, chunk_size=CHUNK)
+
+
+def stored(dal, session_id='s'):
+    return dal.run(dal.get('session_buffers', {'session_id': session_id}, use_cache=False))
+
+
+def reload(dal, session_id='s'):
+    """Rebuild a scrollback from the stored buffer, as the server does"""
+    scrollback = new_scrollback()
+    for item in stored(dal, session_id)['output_buffer']:
+        scrollback.start_entry(item['cwd'], item['command'], ''.join(item['chunks']) + item.get('tail', ''),
+                               item['id'], item.get('truncated', 0))
+    return [(entry.id, entry.command, entry.output) for entry in scrollback]
+
+
+def test_small_appends_round_trip(dal, writer):
+    scrollback = new_scrollback()
+    entry = scrollback.start_entry('/tmp', 'make')
+    writer.start_entry('s', entry)
+    for n in range(300):
+        text = f'line {n}\n'
+        scrollback.append(entry, text)
+        writer.append('s', entry, text)
+        if n % 7 == 0:
+            writer.flush()
+    writer.flush()
+    assert reload(dal) == [(entry.id, 'make', entry.output)]
+    assert entry.truncated > 0
+
+
+def test_output_is_stored_as_full_chunks_and_a_tail(dal, writer):
+    scrollback = new_scrollback()
+    entry = scrollback.start_entry('/tmp', 'echo')
+    writer.start_entry('s', entry)
+    writer.flush()
+    for text in ('abc', 'defghij', 'klmnopqrs'):
+        writer.append('s', entry, text)
+        writer.flush()
+    item = stored(dal)['output_buffer'][0]
+    assert (item['chunks'], item['tail'], item['truncated']) == (['abcdefgh', 'ijklmnop'], 'qrs', 0)
+
+    # Only the last MAX_ENTRY characters of full chunks are kept
+    writer.append('s', entry, 'x' * (3 * CHUNK))
+    writer.flush()
+    item = stored(dal)['output_buffer'][0]
+    assert len(item['chunks']) == MAX_ENTRY // CHUNK
+    assert item['truncated'] == CHUNK
+    assert ''.join(item['chunks']) + item['tail'] == ('abcdefghijklmnopqrs' + 'x' * (3 * CHUNK))[CHUNK:]
+
+
+def test_appends_after_a_restart_extend_the_stored_tail(dal, writer):
+    scrollback = new_scrollback()
+    entry = scrollback.start_entry('/tmp', 'tail -f log')
+    writer.start_entry('s', entry)
+    for text in ('first ', 'second ', 'third ' * 10):
+        scrollback.append(entry, text)
+        writer.append('s', entry, text)
+        writer.flush()
+        # A new writer knows nothing of what is stored and reads it back
+        writer.stop()
+        writer = SessionBufferWriter(dal, flush_interval=60, chunk_size=CHUNK, max_entry_bytes=MAX_ENTRY)
+    writer.stop()
+    assert reload(dal) == [(entry.id, 'tail -f log', entry.output)]
+
+
+def test_reset_replaces_the_buffer(dal, writer):
+    scrollback = new_scrollback()
+    old = scrollback.start_entry('/tmp', 'old', 'old output\n')
+    writer.start_entry('s', old)
+    writer.flush()
+    scrollback.clear()
+    first = scrollback.start_entry('/srv', 'ls', 'a\nb\n')
+    second = scrollback.start_entry('/srv', 'big', 'y' * 100)
+    writer.reset('s', list(scrollback), '/srv')
+    writer.flush()
+    assert stored(dal)['cwd'] == '/srv'
+    assert reload(dal) == [(first.id, 'ls', first.output), (second.id, 'big', second.output)]
+
+
+def test_options_survive_later_writes_and_resets(dal, writer):
+    scrollback = new_scrollback()
+    writer.set_options('s', {'strip_ansi': False})
+    writer.start_entry('s', scrollback.start_entry('/tmp', 'ls', 'x\n'))
+    writer.flush()
+    # Dropped from memory and loaded back later: nothing but the stored buffer remains
+    writer.set_cwd('s', '/srv')
+    writer.flush()
+    assert stored(dal)['options'] == {'strip_ansi': False}
+
+    writer.set_options('s', {'strip_ansi': True, 'queue_commands': True})
+    writer.reset('s', [], '/srv')
+    writer.flush()
+    assert stored(dal)['options'] == {'strip_ansi': True, 'queue_commands': True}
+
+
+def test_expire_deletes_stale_buffers_and_returns_their_ids(dal, writer):
+    for session_id in ('stale', 'fresh'):
+        writer.touch(session_id)
+    writer.flush()
+    dal.run(dal.update('session_buffers', {'session_id': 'stale'}, {'updated_at': time.time() - 100}))
+    dal.run(dal.create('session_buffers', {'session_id': 'legacy'}))
+
+    assert dal.run(writer.expire(50)) == ['stale']
+    assert writer.expired == 1
+    assert stored(dal, 'stale') is None
+    # Buffers stored before updated_at existed start their clock now
+    assert stored(dal, 'fresh') and stored(dal, 'legacy')['updated_at'] > 0
+    assert dal.run(writer.expire(50)) == []
+
+
+def test_drop_pending_forgets_unwritten_changes(dal, writer):
+    scrollback = new_scrollback()
+    writer.start_entry('s', scrollback.start_entry('/tmp', 'ls', 'x\n'))
+    dal.run(writer.drop_pending('s'))
+    writer.flush()
+    assert stored(dal) is None
@@ -0,0 +1,96 @@
+import pytest
+
+from scrollback import ScrollbackEntry
+from search import SearchIndex
+
+
+@pytest.fixture
+def index():
+    return SearchIndex(max_cpu=1.0)
+
+
+def indexed(index):
+    assert index.wait_idle()
+    return index
+
+
+def texts(results):
+    return [result['text'] for result in results]
+
+
+@pytest.mark.parametrize('query', ['', 'a', 'ab', 'é€', 'two\nlines'])
+def test_short_queries_are_rejected(index, query):
+    with pytest.raises(ValueError):
+        index.search(query)
+
+
+def test_finds_lines_in_any_case_newest_first(index):
+    entry = ScrollbackEntry('/srv', 'make')
+    index.add_command('s', entry)
+    index.add_output('s', entry, 'Building module\nERROR: missing header\n')
+    index.add_output('s', entry, 'ok\nanother error here\n')
+    results = indexed(index).search('error')
+    assert texts(results) == ['another error here', 'ERROR: missing header']
+    assert [result['line'] for result in results] == [4, 2]
+    assert texts(index.search('ERROR', limit=1)) == ['another error here']
+    assert index.search('nothing like it') == []
+
+
+def test_commands_are_searchable(index):
+    entry = ScrollbackEntry('/srv/app', 'pytest -x')
+    index.add_command('s', entry)
+    [result] = indexed(index).search('pytest')
+    assert (result['text'], result['line'], result['entry_id']) == ('/srv/app $ pytest -x', 0, entry.id)
+
+
+def test_lines_split_across_chunks_are_found_whole(index):
+    entry = ScrollbackEntry('/srv', 'tail')
+    index.add_output('s', entry, 'first line\nsecond li', offset=100)
+    index.add_output('s', entry, 'ne with é', offset=121)
+    index.add_output('s', entry, 'drama\nthird\n', offset=131)
+    [result] = indexed(index).search('line with édra')
+    assert (result['text'], result['line'], result['offset']) == ('second line with édrama', 2, 111)
+    assert texts(index.search('first line')) == ['first line']
+
+
+def test_unterminated_last_line_is_indexed_when_the_command_ends(index):
+    entry = ScrollbackEntry('/srv', 'printf')
+    index.add_command('s', entry)
+    index.add_output('s', entry, 'no newline at the end')
+    assert indexed(index).search('newline') == []
+    index.end_session('s')
+    assert texts(indexed(index).search('newline')) == ['no newline at the end']
+
+    # A new command in the session completes the previous one's last line too
+    entry = ScrollbackEntry('/srv', 'printf')
+    index.add_command('s', entry)
+    index.add_output('s', entry, 'more without newline')
+    index.add_command('s', ScrollbackEntry('/srv', 'ls'))
+    assert texts(indexed(index).search('more without')) == ['more without newline']
+
+
+def test_results_are_filtered_by_session(index):
+    for session_id in ('a', 'b'):
+        index.add_output(session_id, ScrollbackEntry('/srv', 'echo'), f'shared text from {session_id}\n')
+    results = indexed(index).search('shared text', session_id='b')
+    assert [result['session_id'] for result in results] == ['b']
+
+
+def test_oldest_chunks_are_forgotten_past_max_bytes():
+    index = SearchIndex(max_bytes=2000, max_cpu=1.0)
+    entry = ScrollbackEntry('/srv', 'seq')
+    for n in range(20000):
+        index.add_output('s', entry, f'record {n:05d}\n')
+    indexed(index)
+    assert index.size <= 2000
+    assert index.search('record 00000') == []
+    assert texts(index.search('record 19999')) == ['record 19999']
+    # Postings of forgotten chunks are compacted away: without that they would hold 20000 * 11 ids
+    assert sum(len(postings) for postings in index._postings.values()) < 2 * 1024 * 11
+
+
+def test_output_beyond_the_pending_limit_is_skipped():
+    index = SearchIndex(max_pending_bytes=10)
+    entry = ScrollbackEntry('/srv', 'yes')
+    index.add_output('s', entry, 'x' * 11)
+    assert index.skipped_bytes == 11
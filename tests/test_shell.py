@@ -0,0 +1,67 @@
+import os
+import threading
+
+import pytest
+
+from shell import ShellSession
+from supervisor import ProcessSupervisor
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="persistent shells are POSIX only")
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = ProcessSupervisor(terminate_grace=0.2)
+    yield supervisor
+    supervisor.shutdown(timeout=1)
+
+
+@pytest.fixture(params=[False, True], ids=['pipe', 'pty'])
+def shell(request, supervisor, tmp_path):
+    shell = ShellSession(supervisor, str(tmp_path), use_pty=request.param)
+    yield shell
+    supervisor.terminate(shell.proc)
+
+
+def run(shell, command, timeout=10):
+    """Run a command in the shell and return (status, cwd, output)"""
+    output, done, result = [], threading.Event(), []
+
+    def on_done(status, cwd):
+        result.extend((status, cwd))
+        done.set()
+
+    shell.run(command, output.append, on_done)
+    assert done.wait(timeout), f"{command!r} never finished"
+    return result[0], result[1], ''.join(output)
+
+
+def test_state_persists_between_commands(shell, tmp_path):
+    (tmp_path / 'sub').mkdir()
+    assert run(shell, 'cd sub && export GREETING=hello')[:2] == (0, str(tmp_path / 'sub'))
+    status, _, output = run(shell, 'echo "$GREETING from $(basename "$PWD")"; false')
+    assert status == 1
+    assert 'hello from sub' in output
+
+
+@pytest.mark.parametrize('command', ['echo "unterminated', "echo 'unterminated", 'if true; then echo open'])
+def test_syntax_error_fails_without_hanging_the_shell(shell, command):
+    status, _, _ = run(shell, command)
+    assert status != 0
+    assert not shell.busy
+    status, _, output = run(shell, 'echo still alive')
+    assert status == 0
+    assert 'still alive' in output
+
+
+def test_unterminated_heredoc_ends_with_the_command(shell):
+    _, _, output = run(shell, 'cat <<EOF\nnever closed')
+    assert 'never closed' in output
+    assert 'printf' not in output
+    assert run(shell, 'echo still alive')[0] == 0
+
+
+def test_multiline_heredoc(shell):
+    status, _, output = run(shell, 'cat <<EOF\nfirst\nsecond\nEOF')
+    assert status == 0
+    assert 'first\r\nsecond' in output or 'first\nsecond' in output
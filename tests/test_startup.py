@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+from startup import Startup
+
+
+def wait_ready(startup, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not startup.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return startup.ready
+
+
+def test_not_ready_until_every_check_passes():
+    startup = Startup(retry_interval=0.01)
+    release = threading.Event()
+    startup.warm('fast', lambda: None)
+    startup.warm('slow', lambda: release.wait(5))
+    assert not startup.ready
+
+    startup.start()
+    assert not startup.ready
+    release.set()
+    assert wait_ready(startup)
+    status = startup.status()
+    assert status['ready'] and status['ready_seconds'] == status['checks']['slow']['seconds']
+
+
+def test_failing_check_is_retried():
+    startup = Startup(retry_interval=0.01)
+    failures = [ConnectionError(), ConnectionError()]
+
+    def check():
+        if failures:
+            raise failures.pop()
+
+    startup.warm('database', check)
+    startup.start()
+    assert wait_ready(startup)
+    assert startup.status()['checks']['database'] == {'ready': True, 'seconds': startup.ready_seconds,
+                                                      'attempts': 3, 'error': None}
+
+
+def test_checks_cannot_be_added_after_start():
+    startup = Startup()
+    startup.start()
+    assert startup.ready
+    with pytest.raises(RuntimeError):
+        startup.warm('late', lambda: None)
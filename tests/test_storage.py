@@ -0,0 +1,231 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from storage import DuplicateKeyError, SQLiteBackend, StorageBackend
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteBackend(str(tmp_path / 'test.sqlite3'))
+
+
+def run(store, steps):
+    """Run `await steps(store)` on a connected store"""
+    async def main():
+        await store.connect()
+        try:
+            return await steps(store)
+        finally:
+            await store.close()
+    return asyncio.run(main())
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+    class Partial(StorageBackend):
+        async def connect(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_insert_find_and_delete(store):
+    async def steps(store):
+        await store.insert_one('items', {'name': 'a', 'meta': {'kind': 'x'}})
+        await store.insert_one('items', {'name': 'b', 'meta': {'kind': 'y'}})
+        found = await store.find('items', {'meta.kind': 'y'}, 10)
+        deleted = [await store.delete_one('items', {'name': 'a'}), await store.delete_one('items', {'name': 'a'})]
+        return found, deleted, await store.find('items', {}, 10)
+
+    found, deleted, remaining = run(store, steps)
+    assert [doc['name'] for doc in found] == ['b']
+    assert isinstance(found[0]['_id'], str)
+    assert deleted == [True, False]
+    assert [doc['name'] for doc in remaining] == ['b']
+
+
+def test_none_matches_a_missing_field(store):
+    async def steps(store):
+        await store.insert_one('items', {'name': 'stamped', 'updated_at': 5})
+        await store.insert_one('items', {'name': 'legacy'})
+        await store.insert_one('items', {'name': 'null', 'updated_at': None})
+        return await store.find('items', {'updated_at': None}, 10)
+
+    assert sorted(doc['name'] for doc in run(store, steps)) == ['legacy', 'null']
+
+
+def test_lt_skips_missing_fields_and_drives_delete_many(store):
+    async def steps(store):
+        for n in range(5):
+            await store.insert_one('items', {'n': n})
+        await store.insert_one('items', {'name': 'no n'})
+        below = await store.find('items', {'n': {'$lt': 3}}, 10)
+        deleted = await store.delete_many('items', {'n': {'$lt': 3}})
+        return below, deleted, await store.find('items', {}, 10)
+
+    below, deleted, remaining = run(store, steps)
+    assert sorted(doc['n'] for doc in below) == [0, 1, 2]
+    assert deleted == 3
+    assert [doc.get('n', doc.get('name')) for doc in remaining] == [3, 4, 'no n']
+
+
+def test_unsupported_query_is_rejected(store):
+    with pytest.raises(ValueError):
+        run(store, lambda store: store.find('items', {'n': {'$gt': 1}}, 10))
+
+
+def test_set_fields_and_upsert(store):
+    async def steps(store):
+        missing = await store.set_fields('items', {'key': 'k'}, {'v': 1})
+        created = await store.set_fields('items', {'key': 'k', 'meta.owner': 'me'}, {'v': 1}, upsert=True)
+        updated = await store.set_fields('items', {'key': 'k'}, {'v': 2, 'meta.tag': 't'})
+        return missing, created, updated, await store.find('items', {}, 10)
+
+    missing, created, updated, docs = run(store, steps)
+    assert missing is None
+    assert (created['key'], created['meta'], created['v']) == ('k', {'owner': 'me'}, 1)
+    assert (updated['v'], updated['meta']) == (2, {'owner': 'me', 'tag': 't'})
+    assert len(docs) == 1
+
+
+def test_unique_index(store):
+    async def steps(store):
+        await store.create_index('items', 'key', unique=True)
+        await store.insert_one('items', {'key': 'k'})
+        await store.insert_one('items', {'key': 'k'})
+
+    with pytest.raises(DuplicateKeyError):
+        run(store, steps)
+
+
+def test_bulk_update_operators(store):
+    async def steps(store):
+        await store.bulk_update('items', [
+            ({'key': 'k'}, {'$set': {'name': 'n'}, '$inc': {'count': 2},
+                            '$addToSet': {'tags': {'$each': ['a', 'b']}}}, True, None),
+            ({'key': 'k'}, {'$inc': {'count': 3}, '$addToSet': {'tags': {'$each': ['b', 'c']}}}, False, None),
+            ({'key': 'missing'}, {'$set': {'name': 'x'}}, False, None),
+        ])
+        return await store.find('items', {}, 10)
+
+    docs = run(store, steps)
+    assert len(docs) == 1
+    assert (docs[0]['key'], docs[0]['name'], docs[0]['count'], docs[0]['tags']) == ('k', 'n', 5, ['a', 'b', 'c'])
+
+
+def test_push_each_and_slice(store):
+    async def push(store, values, limit=None):
+        argument = {'$each': values}
+        if limit is not None:
+            argument['$slice'] = limit
+        await store.bulk_update('items', [({'key': 'k'}, {'$push': {'log': argument}}, True, None)])
+        return (await store.find_one('items', {'key': 'k'}))['log']
+
+    async def steps(store):
+        return [await push(store, [1, 2, 3]), await push(store, [4, 5], -4), await push(store, [6], 2)]
+
+    assert run(store, steps) == [[1, 2, 3], [2, 3, 4, 5], [2, 3]]
+
+
+def test_array_filters(store):
+    async def steps(store):
+        await store.insert_one('buffers', {'session_id': 's', 'output_buffer': [
+            {'id': 'a', 'chunks': ['x']}, {'id': 'b', 'chunks': []}]})
+        await store.bulk_update('buffers', [(
+            {'session_id': 's'},
+            {'$push': {'output_buffer.$[e].chunks': {'$each': ['1', '2', '3'], '$slice': -2}},
+             '$set': {'output_buffer.$[e].tail': 't'}},
+            False, [{'e.id': 'b'}])])
+        updated = await store.find_one('buffers', {'session_id': 's'})
+        # A filter matching no element changes nothing
+        await store.bulk_update('buffers', [(
+            {'session_id': 's'}, {'$push': {'output_buffer.$[e].chunks': {'$each': ['z']}}}, False,
+            [{'e.id': 'zz'}])])
+        return updated, await store.find_one('buffers', {'session_id': 's'})
+
+    updated, unchanged = run(store, steps)
+    assert updated['output_buffer'] == [{'id': 'a', 'chunks': ['x']}, {'id': 'b', 'chunks': ['2', '3'], 'tail': 't'}]
+    assert unchanged['output_buffer'] == updated['output_buffer']
+
+
+def test_bulk_update_applies_the_rest_and_raises_the_first_error(store):
+    async def steps(store):
+        await store.create_index('items', 'key', unique=True)
+        await store.insert_one('items', {'key': 'a'})
+        await store.insert_one('items', {'key': 'b'})
+        try:
+            await store.bulk_update('items', [
+                ({'key': 'a'}, {'$set': {'key': 'b'}}, False, None),
+                ({'key': 'b'}, {'$set': {'seen': True}}, False, None),
+            ])
+        except DuplicateKeyError:
+            return await store.find_one('items', {'key': 'b'})
+
+    assert run(store, steps)['seen'] is True
+
+
+def test_replace_all(store):
+    async def steps(store):
+        await store.insert_one('items', {'n': 1})
+        await store.replace_all('items', [{'n': 2}, {'n': 3}])
+        return await store.find('items', {}, 10)
+
+    assert [doc['n'] for doc in run(store, steps)] == [2, 3]
+
+
+def test_writes_are_committed(store, tmp_path):
+    run(store, lambda store: store.insert_one('items', {'n': 1}))
+    reopened = SQLiteBackend(str(tmp_path / 'test.sqlite3'))
+    assert run(reopened, lambda store: store.find_one('items', {}))['n'] == 1
+
+
+class FailingCommit:
+    """Connection whose COMMIT fails, like a full disk would"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, *args):
+        if sql == "COMMIT":
+            raise sqlite3.OperationalError("database or disk is full")
+        return self.conn.execute(sql, *args)
+
+    def close(self):
+        self.conn.close()
+
+
+def test_failed_commit_fails_every_write_in_the_transaction(store):
+    async def steps(store):
+        await store.insert_one('items', {'n': 0})
+        conn, store.conn = store.conn, FailingCommit(store.conn)
+        results = await asyncio.gather(
+            store.insert_one('items', {'n': 1}),
+            store.set_fields('items', {'n': 0}, {'seen': True}),
+            store.bulk_update('items', [({'n': 2}, {'$set': {'n': 2}}, True, None)]),
+            store.delete_many('items', {'n': 0}),
+            return_exceptions=True)
+        store.conn = conn
+        return results, await store.find('items', {}, 10)
+
+    results, docs = run(store, steps)
+    assert all(isinstance(result, sqlite3.OperationalError) for result in results)
+    # All rolled back together
+    assert [(doc['n'], doc.get('seen')) for doc in docs] == [(0, None)]
+
+
+def test_write_returns_after_its_commit(store, tmp_path):
+    async def steps(store):
+        await store.insert_one('items', {'n': 1})
+        # Visible to another connection as soon as the write has returned
+        other = sqlite3.connect(str(tmp_path / 'test.sqlite3'))
+        try:
+            return other.execute("SELECT count(*) FROM items").fetchone()[0]
+        finally:
+            other.close()
+
+    assert run(store, steps) == 1
@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+from streaming import _ESCAPE_RE, MAX_KNOWN_ESCAPES, TerminalFilter
+
+
+def feed_all(term_filter, chunks):
+    return ''.join(term_filter.feed(chunk) for chunk in chunks) + term_filter.flush()
+
+
+SAMPLE = ('\x1b[1;32mok\x1b[0m plain \x1b]0;title\x07\x1b[2K\x1b[10;20Hmoved \x1bP1$r\x1b\\'
+          '\x1b(Bdone \x1b[38;5;208morange\x1b[m\n')
+
+
+def test_strips_escape_sequences():
+    assert TerminalFilter().feed(SAMPLE) == 'ok plain moved done orange\n'
+
+
+@pytest.mark.parametrize('split', range(1, len(SAMPLE)))
+def test_escapes_split_across_chunks(split):
+    assert feed_all(TerminalFilter(), [SAMPLE[:split], SAMPLE[split:]]) == 'ok plain moved done orange\n'
+
+
+def test_escapes_split_into_single_characters():
+    assert feed_all(TerminalFilter(), list(SAMPLE * 3)) == 'ok plain moved done orange\n' * 3
+
+
+def test_keeps_escapes_when_not_stripping():
+    assert feed_all(TerminalFilter(strip_ansi=False), [SAMPLE[:5], SAMPLE[5:]]) == SAMPLE
+
+
+def test_unterminated_escape_is_not_held_forever():
+    # Longer than any real escape sequence: the text after it is passed on rather than carried
+    text = '\x1b]' + 'x' * 5000
+    assert feed_all(TerminalFilter(), [text, 'after\n']) == 'x' * 5000 + 'after\n'
+
+
+def test_progress_bar_collapses_to_final_state():
+    term_filter = TerminalFilter()
+    out = [term_filter.feed(f'\r{percent}%') for percent in range(0, 101, 10)]
+    assert ''.join(out) == ''
+    assert term_filter.feed(' done\nnext\n') == '100% done\nnext\n'
+
+
+def test_carriage_return_overwrites_from_column_zero():
+    assert feed_all(TerminalFilter(), ['abcdef\rXY\n']) == 'XYcdef\n'
+    assert feed_all(TerminalFilter(), ['Downloading... 10%\r', 'Downloading... 99%\r\n']) == 'Downloading... 99%\n'
+
+
+def test_overwritten_prefix_is_shown_on_its_own_line():
+    term_filter = TerminalFilter()
+    assert term_filter.feed('building ') == 'building '
+    assert term_filter.feed('\rok\n') == '\nokilding \n'
+
+
+def test_progress_redraw_with_colour_codes():
+    chunks = [f'\x1b[2K\r\x1b[32m{percent}%\x1b[0m' for percent in (10, 50, 100)] + ['\n']
+    assert feed_all(TerminalFilter(), chunks) == '100%\n'
+
+
+def test_more_distinct_sequences_than_the_filter_remembers():
+    term_filter = TerminalFilter()
+    colours = ''.join(f'\x1b[38;5;{i}m{i % 10}' for i in range(MAX_KNOWN_ESCAPES * 4))
+    expected = ''.join(str(i % 10) for i in range(MAX_KNOWN_ESCAPES * 4))
+    for _ in range(3):
+        assert term_filter.feed(colours + '\n') == expected + '\n'
+    assert len(term_filter._known) == MAX_KNOWN_ESCAPES
+    # Sequences learned from the first chunks keep being stripped, as do new ones
+    assert term_filter.feed('\x1b[38;5;1ma\x1b[4;2Hb\x1b[?25lc\n') == 'abc\n'
+
+
+def test_matches_the_escape_regex_on_random_output():
+    rng = random.Random(1)
+    pieces = ['text ', '\n', '\x1b[0m', '\x1b[1;31m', '\x1b[2K', '\x1b[?25h', '\x1b]0;t\x07', '\x1b]8;;http://x\x1b\\',
+              '\x1bP1$r\x1b\\', '\x1b(B', 'é']
+    pieces += [f'\x1b[{n}G' for n in range(100)]
+    text = ''.join(rng.choice(pieces) for _ in range(20000))
+    cuts = sorted(rng.sample(range(1, len(text)), 200))
+    chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+    assert feed_all(TerminalFilter(), chunks) == _ESCAPE_RE.sub('', text)
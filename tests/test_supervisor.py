@@ -0,0 +1,85 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+from supervisor import ProcessSupervisor, _Termination
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="process groups and PTYs are POSIX only")
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = ProcessSupervisor(terminate_grace=0.2, reap_interval=0.05)
+    yield supervisor
+    supervisor.shutdown(timeout=1)
+
+
+def run(supervisor, command, use_pty, timeout=10):
+    """Run a command to completion and return (returncode, output)"""
+    output, done, result = [], threading.Event(), []
+
+    def on_exit(proc, returncode):
+        result.append(returncode)
+        done.set()
+
+    proc = supervisor.spawn(command, os.getcwd(), output.append, on_exit, use_pty=use_pty)
+    if not done.wait(timeout):
+        supervisor.terminate(proc, grace=0)
+        pytest.fail(f"{command!r} never finished")
+    return result[0], ''.join(output)
+
+
+@pytest.mark.parametrize('use_pty', [False, True], ids=['pipe', 'pty'])
+def test_output_and_exit_code(supervisor, use_pty):
+    assert run(supervisor, 'echo hello; exit 3', use_pty) == (3, 'hello\n')
+
+
+@pytest.mark.parametrize('use_pty', [False, True], ids=['pipe', 'pty'])
+@pytest.mark.parametrize('command', [
+    'read answer; echo "read returned $?"',
+    f'{sys.executable} -c "input()"',
+], ids=['read', 'input'])
+def test_prompt_reads_end_of_file_instead_of_hanging(supervisor, use_pty, command):
+    returncode, output = run(supervisor, command, use_pty)
+    assert 'read returned 1' in output or 'EOFError' in output
+
+
+def start_group(command):
+    """A session leader running `command`, and the psutil processes it started"""
+    proc = subprocess.Popen(['sh', '-c', command], start_new_session=True)
+    leader = psutil.Process(proc.pid)
+    for _ in range(200):
+        if leader.children():
+            return proc, leader.children()
+        time.sleep(0.01)
+    pytest.fail("the command started no children")
+
+
+def test_escalation_kills_the_group_while_the_leader_is_unreaped():
+    proc, children = start_group("trap '' TERM; sleep 30 & wait")
+    termination = _Termination(proc)
+    termination.signal(force=False)
+    termination.signal(force=True)
+    assert proc.wait(5) == -signal.SIGKILL
+    psutil.wait_procs(children, timeout=5)
+    assert not any(child.is_running() for child in children)
+
+
+def test_escalation_skips_the_group_once_the_leader_is_reaped(monkeypatch):
+    proc, children = start_group("sleep 30 & wait")
+    termination = _Termination(proc)
+    os.kill(proc.pid, signal.SIGKILL)
+    proc.wait(5)
+    killed_groups = []
+    monkeypatch.setattr(os, 'killpg', lambda pgid, sig: killed_groups.append(pgid))
+    termination.signal(force=True)
+    # Its group id could have been reused, but the children it left behind are still found
+    assert killed_groups == []
+    psutil.wait_procs(children, timeout=5)
+    assert not any(child.is_running() for child in children)